@@ -0,0 +1,385 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Offline benchmark of the FOV pipeline on synthetic data.
+
+For every scale, a synthetic dataset is generated (once, and reused on later runs), the whole pipeline is run on it,
+and the per-stage timings from the performance report are gathered into benchmark.json. The time it takes to import
+the package (i.e. the cold start of `fpp_process` and of every Dask worker) is measured too. Pass the benchmark.json of
+an earlier run with --compare to check for regressions.
+"""
+
+import argparse
+import json
+import logging
+import os
+import platform
+import shutil
+import subprocess
+import sys
+from pathlib import Path
+
+import numpy as np
+
+from fov_processing_pipeline import data, wrappers
+from fov_processing_pipeline.bin import process
+
+###############################################################################
+
+log = logging.getLogger()
+logging.basicConfig(
+    level=logging.INFO, format="[%(levelname)4s:%(lineno)4s %(asctime)s] %(message)s"
+)
+
+###############################################################################
+
+# shape is (C, Z, Y, X). "large" is about the size of a Pipeline 4 FOV.
+SCALES = {
+    "small": {"shape": (7, 16, 128, 192), "n_fovs": 4, "n_proteins": 2},
+    "medium": {"shape": (7, 40, 312, 462), "n_fovs": 4, "n_proteins": 2},
+    "large": {"shape": (7, 70, 624, 924), "n_fovs": 2, "n_proteins": 2},
+}
+
+# the stage metrics that are compared between runs
+BENCHMARK_METRICS = ["wall_time_p50", "wall_time_total", "peak_rss_max"]
+
+# modules whose import time is measured. wrappers is what every Dask worker imports.
+IMPORT_MODULES = [
+    "fov_processing_pipeline",
+    "fov_processing_pipeline.bin.process",
+    "fov_processing_pipeline.data",
+    "fov_processing_pipeline.wrappers",
+]
+
+
+def get_environment():
+    return {
+        "python": platform.python_version(),
+        "numpy": np.__version__,
+        "platform": platform.platform(),
+        "n_cpus": os.cpu_count(),
+    }
+
+
+def time_import(module, repeats=3):
+    """
+    Returns the smallest wall time (in seconds) it takes to import module in a fresh interpreter
+    """
+
+    code = (
+        "import time; start = time.perf_counter(); import {}; "
+        "print(time.perf_counter() - start)".format(module)
+    )
+
+    times = list()
+    for repeat in range(repeats):
+        output = subprocess.run(
+            [sys.executable, "-c", code],
+            check=True,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+            universal_newlines=True,
+        )
+        times.append(float(output.stdout.strip().splitlines()[-1]))
+
+    return min(times)
+
+
+def time_imports(modules=IMPORT_MODULES, repeats=3):
+    import_times = dict()
+    for module in modules:
+        import_times[module] = time_import(module, repeats=repeats)
+
+        log.info("Importing {} takes {:.3f} s".format(module, import_times[module]))
+
+    return import_times
+
+
+def prepare_scale(data_dir, scale, dtype="uint16", overwrite=False):
+    """
+    Generates the synthetic images and data tables of a scale in data_dir, unless they are already there
+    """
+
+    cell_data_path = f"{data_dir}/cell_data.parquet"
+    fov_data_path = f"{data_dir}/fov_data.parquet"
+
+    if os.path.exists(fov_data_path) and not overwrite:
+        return cell_data_path, fov_data_path
+
+    log.info("Generating synthetic data in {}".format(data_dir))
+
+    cell_data, fov_data = data.synthetic.get_data(
+        save_dir=f"{data_dir}/images",
+        n_fovs=scale["n_fovs"],
+        protein_list=data.utils.DEFAULT_PROTEIN_LIST[: scale["n_proteins"]],
+        overwrite=overwrite,
+        shape=scale["shape"],
+        dtype=dtype,
+    )
+
+    data.utils.save_table(cell_data, cell_data_path)
+    data.utils.save_table(fov_data, fov_data_path)
+
+    return cell_data_path, fov_data_path
+
+
+def run_scale(save_dir, scale_name, scale, repeats=1, dtype="uint16"):
+    """
+    Runs the pipeline on a scale repeats times and returns the best (smallest) value of every stage metric
+    """
+
+    data_dir = f"{save_dir}/data/{scale_name}"
+    run_dir = f"{save_dir}/runs/{scale_name}"
+
+    cell_data_path, fov_data_path = prepare_scale(data_dir, scale, dtype=dtype)
+
+    results = {
+        "shape": list(scale["shape"]),
+        "dtype": dtype,
+        "n_fovs": scale["n_fovs"],
+        "n_proteins": scale["n_proteins"],
+        "run_wall_time": None,
+        "stages": dict(),
+    }
+
+    for repeat in range(repeats):
+        # start every run from scratch, with only the data tables in place
+        if os.path.exists(run_dir):
+            shutil.rmtree(run_dir)
+
+        raw_dir = f"{run_dir}/{wrappers.RAW_DIR}"
+        os.makedirs(raw_dir)
+        shutil.copy(cell_data_path, f"{raw_dir}/cell_data.parquet")
+        shutil.copy(fov_data_path, f"{raw_dir}/fov_data.parquet")
+
+        log.info("Running {} ({}/{})".format(scale_name, repeat + 1, repeats))
+
+        process.process(
+            Path(run_dir),
+            overwrite=False,
+            use_current_results=False,
+            n_fovs=scale["n_fovs"],
+            dataset="synthetic",
+        )
+
+        with open(
+            f"{run_dir}/{wrappers.QC_DIR}/{wrappers.PERFORMANCE_DIR}/performance.json",
+            "r",
+        ) as f:
+            report = json.load(f)
+
+        if results["run_wall_time"] is None:
+            results["run_wall_time"] = report["run_wall_time"]
+        else:
+            results["run_wall_time"] = min(
+                results["run_wall_time"], report["run_wall_time"]
+            )
+
+        for stage, stage_summary in report["stages"].items():
+            best = results["stages"].setdefault(stage, dict())
+            for metric in BENCHMARK_METRICS:
+                value = stage_summary.get(metric)
+                if value is None:
+                    continue
+
+                best[metric] = value if metric not in best else min(best[metric], value)
+
+    return results
+
+
+def compare(benchmark, baseline, tolerance=0.2, min_time=0.05):
+    """
+    Compares the median wall time of every stage in benchmark with baseline
+
+    Parameters
+    ----------
+    benchmark: dict
+        contents of benchmark.json of this run
+
+    baseline: dict
+        contents of benchmark.json of an earlier run
+
+    tolerance: float
+        fraction that a stage can be slower than the baseline before it is a regression
+
+    min_time: float
+        stages that took less than this many seconds in the baseline are too noisy to compare
+
+    Returns
+    -------
+    regressions: list of dicts
+        scale, stage, baseline and current time of every stage that is slower than the baseline
+    """
+
+    regressions = list()
+
+    for module, current_time in benchmark.get("imports", dict()).items():
+        baseline_time = baseline.get("imports", dict()).get(module)
+        if baseline_time is None or baseline_time < min_time:
+            continue
+
+        if current_time > baseline_time * (1 + tolerance):
+            regressions.append(
+                {
+                    "scale": "imports",
+                    "stage": module,
+                    "baseline": baseline_time,
+                    "current": current_time,
+                }
+            )
+
+    for scale_name, scale_results in benchmark["scales"].items():
+        if scale_name not in baseline["scales"]:
+            continue
+
+        baseline_stages = baseline["scales"][scale_name]["stages"]
+
+        for stage, stage_results in scale_results["stages"].items():
+            if stage not in baseline_stages:
+                continue
+
+            baseline_time = baseline_stages[stage]["wall_time_p50"]
+            current_time = stage_results["wall_time_p50"]
+
+            log.info(
+                "{:>8} {:>16}: {:8.3f} s (baseline {:8.3f} s)".format(
+                    scale_name, stage, current_time, baseline_time
+                )
+            )
+
+            if baseline_time < min_time:
+                continue
+
+            if current_time > baseline_time * (1 + tolerance):
+                regressions.append(
+                    {
+                        "scale": scale_name,
+                        "stage": stage,
+                        "baseline": baseline_time,
+                        "current": current_time,
+                    }
+                )
+
+    return regressions
+
+
+def benchmark(
+    save_dir: Path,
+    scales: list = ["small", "medium"],
+    repeats: int = 1,
+    dtype: str = "uint16",
+    baseline_path: Path = None,
+    tolerance: float = 0.2,
+):
+    """
+    Times the imports and benchmarks the pipeline at each of the scales, and saves the results to
+    save_dir/benchmark.json
+
+    Returns
+    -------
+    regressions: list of dicts
+        stages that are slower than in baseline_path, see compare()
+    """
+
+    save_dir = str(save_dir.resolve())
+
+    if not os.path.exists(save_dir):
+        os.makedirs(save_dir)
+
+    # read the baseline first, since it could be the benchmark.json that is about to be replaced
+    baseline = None
+    if baseline_path is not None:
+        with open(baseline_path, "r") as f:
+            baseline = json.load(f)
+
+    results = {
+        "environment": get_environment(),
+        "imports": time_imports(repeats=max(repeats, 3)),
+        "scales": dict(),
+    }
+
+    for scale_name in scales:
+        results["scales"][scale_name] = run_scale(
+            save_dir, scale_name, SCALES[scale_name], repeats=repeats, dtype=dtype
+        )
+
+    save_path = f"{save_dir}/benchmark.json"
+    with open(save_path, "w") as f:
+        json.dump(results, f, indent=2)
+
+    log.info("Saved benchmark in {}".format(save_path))
+
+    regressions = list()
+    if baseline is not None:
+        regressions = compare(results, baseline, tolerance=tolerance)
+
+        for regression in regressions:
+            log.warning(
+                "{scale} {stage} is slower: {current:.3f} s vs {baseline:.3f} s".format(
+                    **regression
+                )
+            )
+
+    return regressions
+
+
+###############################################################################
+# Allow caller to directly run this module (usually in development scenarios)
+
+
+def main():
+
+    p = argparse.ArgumentParser(
+        prog="benchmark",
+        description="Benchmark the FOV pipeline on synthetic data. Works offline.",
+    )
+    p.add_argument(
+        "-s",
+        "--save_dir",
+        action="store",
+        type=Path,
+        default=Path("./benchmark/"),
+        help="Save directory for the synthetic data and benchmark results",
+    )
+    p.add_argument(
+        "--scales",
+        nargs="*",
+        choices=list(SCALES.keys()),
+        default=["small", "medium"],
+        help="Which scales to run. Leave empty to only time the imports.",
+    )
+    p.add_argument(
+        "--repeats",
+        type=int,
+        default=1,
+        help="Number of times to run each scale. The fastest run of each stage is kept.",
+    )
+    p.add_argument(
+        "--dtype", type=str, default="uint16", help="Pixel type of the synthetic images"
+    )
+    p.add_argument(
+        "--compare",
+        dest="baseline_path",
+        type=Path,
+        default=None,
+        help="benchmark.json of an earlier run to compare with. Exits with an error if any stage is slower.",
+    )
+    p.add_argument(
+        "--tolerance",
+        type=float,
+        default=0.2,
+        help="Fraction a stage can be slower than the baseline before it counts as a regression",
+    )
+
+    args = p.parse_args()
+    args = vars(args)
+
+    regressions = benchmark(**args)
+
+    if len(regressions) > 0:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -10,6 +10,8 @@ from dask_jobqueue import SLURMCluster
 import dask
 import dask.distributed
 
+from fov_processing_pipeline import memory, utils
+
 ###############################################################################
 
 log = logging.getLogger()
@@ -38,14 +40,31 @@ def main():
     p.add_argument(
         "--up_time", type=int, default=10, help="up time for the scheduler in hours",
     )
+    p.add_argument(
+        "--cores", type=int, default=2, help="Number of cores per job",
+    )
+    p.add_argument(
+        "--memory",
+        type=str,
+        default="16GB",
+        help=(
+            "Memory per job. This is also advertised as the workers' MEMORY resource, "
+            "so use the same value for fpp_process --worker_memory"
+        ),
+    )
 
     args = p.parse_args()
 
     cluster = SLURMCluster(
-        cores=2,
-        memory="16GB",
+        cores=args.cores,
+        memory=args.memory,
         walltime="{}:00:00".format(args.walltime),
         queue="aics_cpu_general",
+        extra=[
+            "--resources {}={}".format(
+                memory.RESOURCE_NAME, utils.str2bytes(args.memory)
+            )
+        ],
     )
 
     cluster.adapt(minimum_jobs=args.min_jobs, maximum_jobs=args.max_jobs)
@@ -72,7 +91,11 @@ def main():
     log.info(connection_str)
     log.info(" ")
     log.info("Then use the following command to kick off your FPP jobs:")
-    log.info("fpp_process --distributed 1 --port {PORT}".format(**connection_info))
+    log.info(
+        "fpp_process --distributed 1 --port {PORT} --worker_memory {MEMORY}".format(
+            MEMORY=args.memory, **connection_info
+        )
+    )
     log.info(" ")
     log.info("You can see the dashboard on:")
     log.info("localhost:{PORT}".format(**connection_info))
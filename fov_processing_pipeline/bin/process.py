@@ -4,13 +4,12 @@
 import argparse
 import logging
 import os
+import time
+import tracemalloc
+import uuid
 from pathlib import Path
 
-from prefect import Flow, unmapped
-from prefect.engine.executors import LocalExecutor
-
-from fov_processing_pipeline import wrappers, utils
-
+from fov_processing_pipeline import utils
 
 ###############################################################################
 
@@ -28,12 +27,82 @@ def process(
     use_current_results: bool,
     n_fovs: int = 100,
     dataset: str = "quilt",
-    executor=LocalExecutor(),
+    data_dir: Path = None,
+    sync: bool = False,
+    cache_dir: Path = None,
+    executor=None,
+    shard: tuple = None,
+    merge: bool = False,
+    memory_budget: int = None,
+    worker_memory: int = None,
+    report_workers: int = 1,
+    diagnostics_format: str = "pages",
+    diagnostics_tile_width: int = None,
+    fov_timeout: float = None,
+    fov_retries: int = 2,
+    profile_memory: bool = False,
 ):
     """
-    Dask/Prefect distributed command for running pipeline
+    Dask/Prefect distributed command for running pipeline. Runs locally if `executor` is None.
+
+    If `shard` is (i, N), only the per-FOV processing is done, and only for the i-th of N disjoint subsets of the
+    FOVs. This lets independent jobs (e.g. a SLURM job array) process the dataset without a shared scheduler. Once all
+    of the shards are done, run with `merge=True` to gather the per-FOV results and make the consolidated stats, QC,
+    plots, diagnostics and splits. The shards and the merge use the data tables that `prepare` wrote, even with
+    `overwrite` (which only applies to their results), so run `prepare` with `--overwrite True` to fetch the data again.
+
+    If `memory_budget` is set (in bytes), the FOVs that are processed at the same time in this process are limited
+    so that their estimated memory use fits in the budget.
+
+    If `worker_memory` is set (in bytes), each FOV is annotated with a Dask "MEMORY" resource based on its estimated
+    memory use, so that the Dask scheduler doesn't put more on a worker than it can hold. The Dask workers must be
+    started with `--resources MEMORY=<worker_memory>` (see bin/distributed_scheduler.py).
+
+    Loading an FOV image is tried again up to `fov_retries` times if it hits an I/O error or takes longer than
+    `fov_timeout` seconds. FOVs that still fail are quarantined: the error is recorded next to the FOV's results, the
+    FOV is skipped on later runs (unless `overwrite`), and everything downstream runs on the FOVs that succeeded.
+
+    The diagnostic montages are rendered `report_workers` pages at a time, in separate processes (within
+    `memory_budget`, if it is set). Pages whose images haven't changed since they were made are kept, unless
+    `overwrite`. With `diagnostics_format="pyramid"`, they are zoomable tile pyramids with an HTML viewer instead
+    (see reports/pyramid.py). If `diagnostics_tile_width` is set, the pages show each FOV at the smallest of its
+    thumbnails (see thumbnails.py) that is at least that many pixels wide. The plots are rendered `report_workers` at
+    a time too, each (protein, kind of plot) in a separate process.
+
+    The plots, diagnostics, summary table and data splits are only made again if what they are made from (the rows and
+    columns of the tables they read, the files they read, their parameters and the code) changed since they were made,
+    unless `overwrite` (see cache.py). So when FOVs of one protein are added, only that protein's plots and diagnostics
+    (and the plots of all of the FOVs, like the PCA) are made again.
+
+    The time, I/O and memory use of every stage (and every step of every FOV) are saved in a performance report in
+    the qc directory. If `profile_memory`, the peak memory of each stage is also traced with tracemalloc, which makes
+    everything slower.
+
+    `data_dir` is the directory of images and manifest for `dataset="local"` (see data/local.py). `cache_dir` is the
+    directory of the caches (of the quilt metadata and LabKey responses) that are shared between runs, by default the
+    user's cache directory (see data/sources.py).
+
+    If `sync`, the data are retrieved again and compared with the stored tables, and only the FOVs that are new or
+    changed upstream are processed. Only the plots and diagnostics of the proteins with new, changed or removed FOVs
+    are remade. With `shard`, sync in `prepare` instead.
     """
 
+    # imported here so that `fpp_process -h` doesn't have to load Prefect and Dask
+    from prefect import Flow, unmapped
+    from prefect.engine.executors import LocalExecutor
+
+    from fov_processing_pipeline import wrappers, memory, profiling, filesystem
+
+    if shard is not None and merge:
+        raise ValueError("shard and merge can not be used at the same time.")
+
+    if executor is None:
+        executor = LocalExecutor()
+
+    # the FOVs are processed in this process one after the other, so their results can be written in the background
+    # while the next one is processed. Otherwise each FOV waits for its own results to be written.
+    defer_writes = isinstance(executor, LocalExecutor)
+
     save_dir = str(save_dir.resolve())
 
     log.info("Saving in {}".format(save_dir))
@@ -41,6 +110,24 @@ def process(
     if not os.path.exists(save_dir):
         os.makedirs(save_dir)
 
+    if shard is not None and not os.path.exists(
+        f"{save_dir}/{wrappers.RAW_DIR}/fov_data.parquet"
+    ):
+        # otherwise every shard would try to download the data and write the same tables at once
+        raise FileNotFoundError(
+            f"No data found in {save_dir}. Run `fpp_process -s {save_dir} prepare` before running shards."
+        )
+
+    memory.set_memory_budget(memory_budget)
+
+    # files could have been added or removed since an earlier run in this process. The workers forget their listings
+    # once per run, see filesystem.FileIndex.start_run
+    filesystem.file_index.invalidate()
+    run_id = uuid.uuid4().hex
+
+    process_fovs = not use_current_results and not merge
+    make_figures = not use_current_results or merge
+
     # This is the main function
     with Flow("FOV_processing_pipeline") as flow:
         # for every FOV, do the processing steps
@@ -48,14 +135,28 @@ def process(
         ###########
         # load data
         ###########
+        # shards and merges read the tables that `prepare` wrote, since every shard fetching and writing them again at
+        # the same time would race
         data = wrappers.save_load_data(
-            save_dir, n_fovs=n_fovs, overwrite=overwrite, dataset=dataset
+            save_dir,
+            n_fovs=n_fovs,
+            overwrite=overwrite and shard is None and not merge,
+            dataset=dataset,
+            dataset_kwargs=get_dataset_kwargs(data_dir),
+            sync=sync and shard is None and not merge,
+            cache_dir=get_cache_dir(cache_dir),
         )
 
         # we have to unpack this way because of Prefect-reasons
         cell_data = data[0]
         fov_data = data[1]
 
+        ###########
+        # If we're only doing part of the data, select the FOVs for this shard
+        ###########
+        if shard is not None:
+            fov_data = wrappers.shard_data(fov_data, shard)
+
         ###########
         # get all of the save paths
         ###########
@@ -65,66 +166,195 @@ def process(
         summary_path = paths[0]
         stats_paths = paths[1]
         proj_paths = paths[2]
+        failure_paths = paths[3]
+
+        ###########
+        # When syncing, only the new and changed FOVs are processed
+        ###########
+        if sync:
+            process_fov_data = wrappers.get_sync_fovs(save_dir, fov_data)
+            process_paths = wrappers.get_save_paths(save_dir, process_fov_data)
+            sync_proteins = wrappers.get_sync_proteins(
+                save_dir, upstream_tasks=[process_fov_data]
+            )
+        else:
+            process_fov_data = fov_data
+            process_paths = paths
+            sync_proteins = None
 
         ###########
         # Summary Table
         ###########
-        wrappers.cell_data_to_summary_table(cell_data, summary_path)
+        if shard is None:
+            wrappers.cell_data_to_summary_table(
+                cell_data, summary_path, overwrite=overwrite
+            )
 
         ###########
         # The per-fov map step
         ###########
-        fov_rows = wrappers.get_data_rows(fov_data)
-
-        if not use_current_results:
+        fov_rows = wrappers.get_data_rows(process_fov_data)
+
+        if process_fovs and worker_memory is not None:
+            # Map each memory class separately, since Dask resources are set per task
+            memory_estimates = wrappers.get_memory_estimates(process_fov_data)
+            memory_classes = memory.get_memory_classes(worker_memory)
+
+            upstream_tasks = list()
+            for memory_class in memory_classes:
+                class_args = wrappers.select_memory_class(
+                    fov_rows,
+                    process_paths[1],
+                    process_paths[2],
+                    process_paths[3],
+                    memory_estimates,
+                    memory_class,
+                    memory_classes,
+                )
+
+                process_fov_row_class = wrappers.process_fov_row.copy(
+                    tags={f"dask-resource:{memory.RESOURCE_NAME}={memory_class}"}
+                )
+
+                process_fov_row_map = process_fov_row_class.map(
+                    fov_row=class_args[0],
+                    stats_path=class_args[1],
+                    proj_path=class_args[2],
+                    failure_path=class_args[3],
+                    overwrite=unmapped(overwrite),
+                    memory_estimate=class_args[4],
+                    load_timeout=unmapped(fov_timeout),
+                    load_retries=unmapped(fov_retries),
+                    wait_for_writes=unmapped(not defer_writes),
+                    run_id=unmapped(run_id),
+                )
+                upstream_tasks.append(process_fov_row_map)
+
+        elif process_fovs:
             process_fov_row_map = wrappers.process_fov_row.map(
                 fov_row=fov_rows,
-                stats_path=stats_paths,
-                proj_path=proj_paths,
+                stats_path=process_paths[1],
+                proj_path=process_paths[2],
+                failure_path=process_paths[3],
                 overwrite=unmapped(overwrite),
+                load_timeout=unmapped(fov_timeout),
+                load_retries=unmapped(fov_retries),
+                wait_for_writes=unmapped(not defer_writes),
+                run_id=unmapped(run_id),
             )
             upstream_tasks = [process_fov_row_map]
         else:
             upstream_tasks = None
 
-        ###########
-        # Load relevant data as a reduce step
-        ###########
-        df_stats = wrappers.load_stats(
-            fov_data, stats_paths, upstream_tasks=upstream_tasks
-        )
+        if process_fovs:
+            upstream_tasks = [wrappers.flush_outputs(upstream_tasks=upstream_tasks)]
 
-        ###########
-        # QC data based on previous thresholds, etc
-        ###########
-        df_stats_qc = wrappers.qc_stats(df_stats, save_dir)
+        if shard is None:
+            # Everything from here on needs the results for all of the FOVs, so the shards stop here
 
-        if not use_current_results:
+            ###########
+            # Record the FOVs that failed
+            ###########
+            wrappers.save_failures(
+                failure_paths, save_dir, upstream_tasks=upstream_tasks
+            )
 
             ###########
-            # Make Plots
+            # Load relevant data as a reduce step
             ###########
-            wrappers.stats2plots(
-                df_stats_qc, parent_dir=save_dir, upstream_tasks=[df_stats_qc]
+            df_stats = wrappers.load_stats(
+                fov_data, stats_paths, upstream_tasks=upstream_tasks
             )
 
             ###########
-            # Make diagnostic images
+            # QC data based on previous thresholds, etc
+            ###########
+            df_stats_qc = wrappers.qc_stats(df_stats, save_dir)
+
+            if make_figures:
+
+                ###########
+                # Make Plots
+                ###########
+                plots = wrappers.stats2plots(
+                    df_stats_qc,
+                    parent_dir=save_dir,
+                    proteins=sync_proteins,
+                    n_workers=report_workers,
+                    overwrite=overwrite,
+                    fov_data=fov_data,
+                    stats_paths=stats_paths,
+                    upstream_tasks=[df_stats_qc],
+                )
+
+                ###########
+                # Make diagnostic images
+                ###########
+                diagnostics = wrappers.im2diagnostics(
+                    fov_data,
+                    proj_paths,
+                    parent_dir=save_dir,
+                    overwrite=overwrite,
+                    proteins=sync_proteins,
+                    n_workers=report_workers,
+                    max_bytes=memory_budget,
+                    diagnostics_format=diagnostics_format,
+                    tile_width=diagnostics_tile_width,
+                    upstream_tasks=[df_stats],
+                )
+
+            ###########
+            # Do data splits for the data that survived QC
             ###########
-            wrappers.im2diagnostics(
-                fov_data, proj_paths, parent_dir=save_dir, upstream_tasks=[df_stats]
+            splits_dict = wrappers.data_splits(
+                df_stats_qc,
+                parent_dir=save_dir,
+                overwrite=overwrite,
+                upstream_tasks=[df_stats_qc],
             )
 
-        ###########
-        # Do data splits for the data that survived QC
-        ###########
-        splits_dict = wrappers.data_splits(
-            df_stats_qc, parent_dir=save_dir, upstream_tasks=[df_stats_qc]
-        )
+            ###########
+            # Everything that the sync found has been processed
+            ###########
+            if sync and (process_fovs or merge):
+                finish_upstream_tasks = [splits_dict]
+                if make_figures:
+                    finish_upstream_tasks += [plots, diagnostics]
+
+                wrappers.finish_sync(save_dir, upstream_tasks=finish_upstream_tasks)
 
+    if profile_memory:
+        tracemalloc.start()
+
+    run_start = time.perf_counter()
     state = flow.run(executor=executor)
+    run_wall_time = time.perf_counter() - run_start
+
+    if profile_memory:
+        tracemalloc.stop()
+
+    ###########
+    # Save the performance report
+    ###########
+    # the records come back in the states of the tasks, wherever they ran, see profiling.attach_records
+    task_records = [
+        profiling.get_state_records(task_state) for task_state in state.result.values()
+    ]
+
+    run_name = "shard_{}_of_{}".format(*shard) if shard is not None else None
+    wrappers.save_performance_report(
+        task_records, save_dir, run_wall_time=run_wall_time, run_name=run_name
+    )
 
     fov_data = state.result[flow.get_tasks(name="save_load_data")[0]].result[1]
+
+    if shard is not None:
+        fov_data = state.result[flow.get_tasks(name="shard_data")[0]].result
+
+        log.info("Done with shard {}/{}!".format(*shard))
+
+        return fov_data, None, None
+
     df_stats = state.result[flow.get_tasks(name="load_stats")[0]].result
     splits_dict = state.result[flow.get_tasks(name="data_splits")[0]].result
 
@@ -133,6 +363,54 @@ def process(
     return fov_data, df_stats, splits_dict
 
 
+def get_cache_dir(cache_dir=None):
+    return None if cache_dir is None else str(cache_dir.resolve())
+
+
+def get_dataset_kwargs(data_dir=None):
+    # keyword arguments for the data source, see data/sources.py
+    dataset_kwargs = dict()
+    if data_dir is not None:
+        dataset_kwargs["data_dir"] = str(data_dir.resolve())
+
+    return dataset_kwargs
+
+
+def prepare(
+    save_dir: Path,
+    overwrite: bool,
+    n_fovs: int = 100,
+    dataset: str = "quilt",
+    data_dir: Path = None,
+    sync: bool = False,
+    cache_dir: Path = None,
+):
+    """
+    Retrieves the data and writes the data tables without doing any processing. Run this once before running shards.
+    """
+
+    from fov_processing_pipeline import wrappers
+
+    save_dir = str(save_dir.resolve())
+
+    log.info("Preparing data in {}".format(save_dir))
+
+    if not os.path.exists(save_dir):
+        os.makedirs(save_dir)
+
+    wrappers.save_load_data.run(
+        save_dir,
+        n_fovs=n_fovs,
+        overwrite=overwrite,
+        dataset=dataset,
+        dataset_kwargs=get_dataset_kwargs(data_dir),
+        sync=sync,
+        cache_dir=get_cache_dir(cache_dir),
+    )
+
+    log.info("Done!")
+
+
 ###############################################################################
 # Allow caller to directly run this module (usually in development scenarios)
 
@@ -144,6 +422,7 @@ def main():
         "-s",
         "--save_dir",
         action="store",
+        type=Path,
         default=Path("./results/"),
         help="Save directory for results",
     )
@@ -151,11 +430,40 @@ def main():
         "--dataset",
         type=str,
         default="quilt",
-        help='Which dataset to use, current can be "quilt", or "labkey"',
+        help='Which dataset to use, current can be "quilt", "labkey", "synthetic" or "local"',
+    )
+    p.add_argument(
+        "--data_dir",
+        type=Path,
+        default=None,
+        help="Directory of OME-TIFFs and their manifest.csv (or manifest.parquet) for --dataset local",
+    )
+
+    p.add_argument(
+        "--cache_dir",
+        type=Path,
+        default=None,
+        help=(
+            "Directory of the quilt metadata and LabKey caches, which are shared between runs. "
+            "Defaults to ~/.cache/fov_processing_pipeline."
+        ),
+    )
+
+    p.add_argument(
+        "--sync",
+        type=utils.str2bool,
+        default=False,
+        help=(
+            "Retrieve the data again and only process the FOVs that are new or changed since the last run. "
+            "Only the plots and diagnostics of the proteins with changes are remade."
+        ),
     )
 
     p.add_argument(
-        "--n_fovs", type=int, default=100, help="Number of fov's per cell line to use.",
+        "--n_fovs",
+        type=int,
+        default=100,
+        help="Number of fov's per cell line to use.",
     )
     p.add_argument(
         "--overwrite", type=utils.str2bool, default=False, help="overwite saved results"
@@ -166,6 +474,96 @@ def main():
         default=False,
         help="Dont do any processing. just make figures. Set to True by default so you don't overwrite your stuff.",
     )
+    p.add_argument(
+        "--shard",
+        type=utils.str2shard,
+        default=None,
+        help=(
+            'Only process the FOVs in shard "i/N" (0 <= i < N), e.g. "$SLURM_ARRAY_TASK_ID/300". '
+            "Run the prepare command first, and the merge command after all of the shards are done."
+        ),
+    )
+
+    subparsers = p.add_subparsers(
+        dest="command",
+        help="(optional) Only run part of the pipeline. Put the options above before the command.",
+    )
+    subparsers.add_parser(
+        "prepare", help="Retrieve the data and write the data tables, then stop."
+    )
+    subparsers.add_parser(
+        "merge",
+        help="Gather the results from all shards into the consolidated stats, QC, plots, diagnostics and splits.",
+    )
+
+    # failure handling stuff
+    p.add_argument(
+        "--fov_timeout",
+        type=float,
+        default=None,
+        help="Seconds to wait for an FOV image to load before trying again.",
+    )
+    p.add_argument(
+        "--fov_retries",
+        type=int,
+        default=2,
+        help="Number of times to retry loading an FOV image after an I/O error or timeout before quarantining it.",
+    )
+
+    p.add_argument(
+        "--profile_memory",
+        type=utils.str2bool,
+        default=False,
+        help="Trace the peak memory of each stage with tracemalloc for the performance report. Slows everything down.",
+    )
+
+    # resource stuff
+    p.add_argument(
+        "--n_workers",
+        type=int,
+        default=1,
+        help="Number of FOVs to process at the same time when running locally.",
+    )
+    p.add_argument(
+        "--memory_budget",
+        type=utils.str2bytes,
+        default=None,
+        help=(
+            'Memory budget (e.g. "32GB") for the FOVs processed at the same time when running locally. '
+            "FOVs wait until their estimated memory use fits in the budget."
+        ),
+    )
+    p.add_argument(
+        "--diagnostics_format",
+        type=str,
+        default="pages",
+        choices=["pages", "pyramid"],
+        help=(
+            'Format of the diagnostic montages: "pages" of PNGs, or a zoomable "pyramid" of tiles per protein '
+            "with a viewer in qc/diagnostics/pyramid/index.html."
+        ),
+    )
+    p.add_argument(
+        "--diagnostics_tile_width",
+        type=int,
+        default=None,
+        help="Show each FOV on the diagnostic pages at the smallest of its thumbnails that is at least this wide.",
+    )
+    p.add_argument(
+        "--report_workers",
+        type=int,
+        default=1,
+        help="Number of diagnostic montage pages and plots to render at the same time, each in its own process.",
+    )
+    p.add_argument(
+        "--worker_memory",
+        type=utils.str2bytes,
+        default=None,
+        help=(
+            'Memory of each Dask worker (e.g. "16GB"). If set, FOVs are scheduled on workers according to their '
+            "estimated memory use. Use with fpp_scheduler --memory."
+        ),
+    )
 
     # distributed stuff
     p.add_argument(
@@ -186,6 +584,20 @@ def main():
 
     distributed = args.pop("distributed")
     port = args.pop("port")
+    n_workers = args.pop("n_workers")
+    command = args.pop("command")
+
+    if command == "prepare":
+        prepare(
+            args["save_dir"],
+            args["overwrite"],
+            args["n_fovs"],
+            args["dataset"],
+            args["data_dir"],
+            args["sync"],
+            args["cache_dir"],
+        )
+        return
 
     # For distributed instructions see:
     # https://github.com/AllenCellModeling/fov_processing_pipeline/blob/master/docs/distributed_instructions.md
@@ -194,10 +606,16 @@ def main():
 
         executor = DaskExecutor(address=f"tcp://localhost:{port}")
 
+    elif n_workers > 1:
+        from prefect.engine.executors import LocalDaskExecutor
+
+        executor = LocalDaskExecutor(scheduler="threads", num_workers=n_workers)
+
     else:
-        executor = LocalExecutor()
+        executor = None
 
     args["executor"] = executor
+    args["merge"] = command == "merge"
 
     process(**args)
 
@@ -0,0 +1,196 @@
+"""
+cache.py: Render-on-change for the plots and reports.
+
+Each artifact (e.g. a protein's plot or diagnostics, the summary table) is keyed by a digest of exactly what it is
+made from: the rows and columns of the tables it reads, the size and modification time of the files it reads, its
+parameters and the version of the code. The digest that each artifact was made from is recorded in an ArtifactCache
+(a JSON file), along with the files it wrote. An artifact whose digest is the same as when it was made, and whose files
+are all still there, doesn't have to be made again.
+
+Each pipeline step has its own cache file, so that steps that run at the same time in different processes don't
+overwrite each other's records.
+"""
+
+import functools
+import hashlib
+import json
+import os
+
+import numpy as np
+import pandas as pd
+
+from . import filesystem, get_module_version
+
+
+def update_frame_digest(hasher, df):
+    # the column names, dtypes and values, column by column
+    for i, column in enumerate(df.columns):
+        values = df.iloc[:, i].values
+
+        hasher.update(repr((str(column), str(values.dtype), len(values))).encode())
+
+        if (
+            values.dtype == object
+            and len(values) > 0
+            and isinstance(values[0], np.ndarray)
+        ):
+            # arrays of stats, which hash_pandas_object would hash by their (abbreviated) str
+            try:
+                hasher.update(np.ascontiguousarray(np.stack(values)).tobytes())
+            except ValueError:
+                # of different lengths
+                for value in values:
+                    hasher.update(repr(value.shape).encode())
+                    hasher.update(np.ascontiguousarray(value).tobytes())
+        else:
+            hasher.update(
+                pd.util.hash_pandas_object(
+                    pd.Series(values), index=False, categorize=False
+                ).values.tobytes()
+            )
+
+
+def update_files_digest(hasher, paths):
+    # the size and modification time of each file, or None if it doesn't exist
+    for path in paths:
+        stat_result = filesystem.file_index.stat(path)
+
+        if stat_result is None:
+            hasher.update(repr((str(path), None)).encode())
+        else:
+            hasher.update(
+                repr((str(path), stat_result.st_size, stat_result.st_mtime_ns)).encode()
+            )
+
+
+@functools.lru_cache()
+def get_code_version():
+    """
+    Returns the package version and a digest of its source, so that artifacts are made again after the code changes,
+    even if the version wasn't bumped
+    """
+
+    package_dir = os.path.dirname(os.path.abspath(__file__))
+
+    hasher = hashlib.sha1()
+    for root, dirs, filenames in os.walk(package_dir):
+        dirs[:] = sorted(d for d in dirs if d not in ["tests", "__pycache__"])
+
+        for filename in sorted(filenames):
+            if filename.endswith(".py"):
+                path = os.path.join(root, filename)
+
+                hasher.update(os.path.relpath(path, package_dir).encode())
+                with open(path, "rb") as f:
+                    hasher.update(f.read())
+
+    return "{}-{}".format(get_module_version(), hasher.hexdigest()[:12])
+
+
+def get_digest(frames=(), paths=(), params=None):
+    """
+    Returns the digest of an artifact
+
+    Parameters
+    ----------
+    frames: list of pd.DataFrame
+        the tables, with only the rows and columns that the artifact is made from
+
+    paths: list of str
+        the files the artifact is made from, by their size and modification time
+
+    params: dict
+        the parameters the artifact is made with, anything json.dumps can serialize (with str as the default)
+
+    Returns
+    -------
+    digest: str
+    """
+
+    hasher = hashlib.sha1()
+
+    hasher.update(get_code_version().encode())
+    hasher.update(json.dumps(params, sort_keys=True, default=str).encode())
+
+    for df in frames:
+        hasher.update(b"frame")
+        update_frame_digest(hasher, df)
+
+    hasher.update(b"paths")
+    update_files_digest(hasher, paths)
+
+    return hasher.hexdigest()
+
+
+def get_group_digests(df, group_inds):
+    """
+    Returns the digest of the rows of each group of df, e.g. each plate's, from a single pass over all of the rows
+
+    Parameters
+    ----------
+    df: pd.DataFrame
+        with only the columns that the artifacts are made from, and no arrays
+
+    group_inds: dict
+        group -> positions of its rows, e.g. from df.groupby(column).indices
+
+    Returns
+    -------
+    digests: dict
+        group -> digest
+    """
+
+    row_hashes = pd.util.hash_pandas_object(df, index=False, categorize=False).values
+    prefix = (
+        get_code_version() + repr([str(column) for column in df.columns])
+    ).encode()
+
+    return {
+        group: hashlib.sha1(prefix + row_hashes[inds].tobytes()).hexdigest()
+        for group, inds in group_inds.items()
+    }
+
+
+class ArtifactCache:
+    """
+    The digest each artifact was made from and the files it wrote, stored in a JSON file at path
+    """
+
+    def __init__(self, path):
+        self.path = path
+
+        # key -> {"digest": str, "outputs": list of paths}
+        self.records = dict()
+        if os.path.exists(path):
+            with open(path, "r") as f:
+                self.records = json.load(f)
+
+    def is_current(self, key, digest):
+        # True if the artifact was made from digest and its files are all still there
+        record = self.records.get(key)
+
+        return (
+            record is not None
+            and record["digest"] == digest
+            and all(filesystem.file_index.exists(path) for path in record["outputs"])
+        )
+
+    def update(self, key, digest, outputs):
+        self.records[key] = {"digest": digest, "outputs": [str(o) for o in outputs]}
+
+    def remove(self, key):
+        # forgets an artifact and deletes its files
+        for path in self.records.pop(key, {"outputs": []})["outputs"]:
+            filesystem.file_index.remove(path)
+
+    def save(self):
+        # written to a temporary file first, so an interrupted run doesn't leave a broken cache
+        directory = os.path.dirname(self.path)
+        if directory and not os.path.exists(directory):
+            os.makedirs(directory)
+
+        with open(f"{self.path}.tmp", "w") as f:
+            json.dump(self.records, f, indent=2, sort_keys=True)
+
+        os.replace(f"{self.path}.tmp", self.path)
+        filesystem.file_index.add(self.path)
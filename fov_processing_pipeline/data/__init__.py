@@ -1,3 +1,3 @@
-from . import quilt, labkey
+from . import download, quilt, labkey, local, synthetic, sources, utils
 
-__all__ = ["quilt", "labkey"]
+__all__ = ["download", "quilt", "labkey", "local", "synthetic", "sources", "utils"]
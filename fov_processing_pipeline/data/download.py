@@ -0,0 +1,346 @@
+"""
+download.py: Concurrent, resumable downloads of package files.
+
+Files are fetched by a pool of threads. Each file is written to a temporary ".part" file, checked against the size and
+hash in the package manifest, and only then renamed to its target path, so a file that exists at its target path is
+complete. Runs that are interrupted pick up where they left off.
+
+The manifest hash of each file that was downloaded is recorded in a RECORD_NAME file in its directory, so that a file
+is downloaded again if the package has a different version of it, even if its size is the same. Checking the record
+is much cheaper than hashing the file again.
+
+Entries can be anything with the interface of a quilt3.PackageEntry: a `fetch(dest)` method, and `size` and `hash`
+attributes.
+"""
+
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+from .. import failures, filesystem, output
+
+log = logging.getLogger(__name__)
+
+PARTIAL_SUFFIX = ".part"
+
+# Name of the record of the files that were downloaded to a directory, see load_records
+RECORD_NAME = ".downloads.json"
+
+
+def file_sha256(path, chunk_size=2 ** 20):
+    # hex digest of the SHA256 of a file, read in chunks so large images don't have to fit in memory
+    sha256 = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            sha256.update(chunk)
+
+    return sha256.hexdigest()
+
+
+def verify_file(path, size=None, file_hash=None):
+    """
+    Raises an OSError if the file at path doesn't have the expected size or hash
+
+    Parameters
+    ----------
+    path: str
+        path to the file
+
+    size: int or None
+        expected size in bytes. Not checked if None.
+
+    file_hash: dict or None
+        expected hash, in the format of the quilt manifest, e.g. {"type": "SHA256", "value": "bb08a..."}. Only SHA256
+        hashes are checked, other types (e.g. quilt's newer chunked hashes) are only checked by size.
+    """
+
+    if size is not None and os.path.getsize(path) != size:
+        raise OSError(
+            f"{path} is {os.path.getsize(path)} bytes, expected {size} bytes."
+        )
+
+    if file_hash is not None and file_hash.get("type") == "SHA256":
+        if file_sha256(path) != file_hash["value"]:
+            raise OSError(f"{path} does not match its SHA256 hash.")
+
+
+def load_records(target_paths):
+    """
+    Returns the records of the directories of target_paths, as {directory: {file name: record}}. The record of a file
+    is the manifest "hash" of the entry it was downloaded from, and the "size" and "mtime_ns" of the file after it was
+    downloaded, so a file that was replaced since doesn't match its record.
+    """
+
+    records = dict()
+    for target_dir in {os.path.dirname(target_path) for target_path in target_paths}:
+        records[target_dir] = dict()
+
+        record_path = os.path.join(target_dir, RECORD_NAME)
+        if filesystem.file_index.exists(record_path):
+            with open(record_path, "r") as f:
+                records[target_dir] = json.load(f)
+
+    return records
+
+
+def write_record(path, record):
+    with open(path, "w") as f:
+        json.dump(record, f, indent=2)
+
+
+def save_records(records, target_dirs):
+    # writes the records of target_dirs, see load_records
+    for target_dir in target_dirs:
+        output.atomic_write(
+            os.path.join(target_dir, RECORD_NAME), write_record, records[target_dir]
+        )
+
+
+def get_record(records, target_path):
+    # the record of the file at target_path, or None if it hasn't been recorded
+    target_dir, name = os.path.split(target_path)
+
+    return records[target_dir].get(name)
+
+
+def make_record(entry, target_path):
+    stat_result = filesystem.file_index.stat(target_path)
+
+    return {
+        "hash": entry.hash,
+        "size": stat_result.st_size,
+        "mtime_ns": stat_result.st_mtime_ns,
+    }
+
+
+def is_downloaded(entry, target_path, record=None):
+    """
+    Cheap check for resuming, since only complete files are renamed to their target path: the file has the size of
+    the entry, and if the entry has a hash, the record of its download (see load_records) has the same hash and
+    matches the file. The target directories are listed once instead of checking every file, see filesystem.py
+    """
+
+    stat_result = filesystem.file_index.stat(target_path)
+    if stat_result is None or (
+        entry.size is not None and stat_result.st_size != entry.size
+    ):
+        return False
+
+    if entry.hash is None:
+        return True
+
+    return record is not None and record == make_record(entry, target_path)
+
+
+def download_file(entry, target_path, verify_hash=True, reuse_existing=False):
+    """
+    Downloads an entry to target_path once, via a temporary file that is verified and then renamed. If reuse_existing
+    is True and there is already a file at target_path that matches the size and SHA256 hash of the entry (e.g. one
+    that was downloaded before its download was recorded), it is kept instead.
+
+    Returns
+    -------
+    n_bytes: int
+        number of bytes that were downloaded
+    """
+
+    target_dir = os.path.dirname(target_path)
+    if target_dir:
+        filesystem.file_index.makedirs(target_dir)
+
+    if (
+        reuse_existing
+        and verify_hash
+        and entry.hash is not None
+        and entry.hash.get("type") == "SHA256"
+        and filesystem.file_index.exists(target_path)
+    ):
+        try:
+            verify_file(target_path, size=entry.size, file_hash=entry.hash)
+            return 0
+        except OSError:
+            pass
+
+    partial_path = f"{target_path}{PARTIAL_SUFFIX}"
+
+    try:
+        remove_partial(partial_path)
+
+        entry.fetch(partial_path)
+        verify_file(
+            partial_path, size=entry.size, file_hash=entry.hash if verify_hash else None
+        )
+
+        os.replace(partial_path, target_path)
+        filesystem.file_index.add(target_path)
+    finally:
+        remove_partial(partial_path)
+
+    return os.path.getsize(target_path)
+
+
+def remove_partial(partial_path):
+    # removes a partial download, without checking if it is there first
+    try:
+        os.remove(partial_path)
+    except FileNotFoundError:
+        pass
+
+
+class DownloadProgress:
+    """
+    Thread-safe count of the files and bytes that have been downloaded, which is logged every `interval` seconds
+    """
+
+    def __init__(self, n_files, interval=10):
+        self.n_files = n_files
+        self.interval = interval
+
+        self.n_done = 0
+        self.n_failed = 0
+        self.n_bytes = 0
+
+        self.start_time = time.perf_counter()
+        self._last_report_time = self.start_time
+        self._lock = threading.Lock()
+
+    def update(self, n_bytes=0, failed=False):
+        with self._lock:
+            self.n_done += 1
+            self.n_failed += int(failed)
+            self.n_bytes += n_bytes
+
+            now = time.perf_counter()
+            if (
+                now - self._last_report_time >= self.interval
+                or self.n_done == self.n_files
+            ):
+                self._last_report_time = now
+                log.info(self.status())
+
+    def status(self):
+        wall_time = max(time.perf_counter() - self.start_time, 1e-9)
+
+        return "Downloaded {}/{} files ({} failed), {:.1f} MB at {:.1f} MB/s".format(
+            self.n_done - self.n_failed,
+            self.n_files,
+            self.n_failed,
+            self.n_bytes / 1e6,
+            self.n_bytes / 1e6 / wall_time,
+        )
+
+
+def download_files(
+    entries,
+    target_paths,
+    n_workers=8,
+    overwrite=False,
+    max_retries=3,
+    retry_delay=1,
+    verify_hash=True,
+    progress_interval=10,
+):
+    """
+    Downloads entries to target_paths with a pool of threads. Files that are already at their target path are
+    skipped unless overwrite is True.
+
+    Parameters
+    ----------
+    entries: list
+        quilt3.PackageEntry (or similar) objects to download
+
+    target_paths: list of strs
+        where to save each entry
+
+    n_workers: int
+        number of files to download at the same time
+
+    overwrite: bool
+        download files even if they already exist
+
+    max_retries: int
+        number of times to try a file again after an error or a failed verification
+
+    retry_delay: float
+        seconds to wait before the first retry, doubled for each retry after that
+
+    verify_hash: bool
+        check the hash of each file. The size is always checked.
+
+    progress_interval: float
+        seconds between progress reports
+
+    Returns
+    -------
+    download_failures: list of dicts
+        target path, exception type and message of every file that could not be downloaded
+    """
+
+    records = load_records(target_paths)
+
+    todo = [
+        (entry, target_path)
+        for entry, target_path in zip(entries, target_paths)
+        if overwrite
+        or not is_downloaded(entry, target_path, get_record(records, target_path))
+    ]
+
+    if len(todo) == 0:
+        return list()
+
+    log.info(
+        "Downloading {} files ({} already present)".format(
+            len(todo), len(target_paths) - len(todo)
+        )
+    )
+
+    progress = DownloadProgress(len(todo), interval=progress_interval)
+    download_failures = list()
+
+    # the records are saved even if the downloads are interrupted, so the files that were downloaded are kept
+    changed_dirs = set()
+    try:
+        with ThreadPoolExecutor(max_workers=n_workers) as executor:
+            futures = {
+                executor.submit(
+                    failures.call_with_retries,
+                    download_file,
+                    entry,
+                    target_path,
+                    verify_hash=verify_hash,
+                    reuse_existing=not overwrite,
+                    max_retries=max_retries,
+                    retry_delay=retry_delay,
+                    transient_errors=(Exception,),
+                ): (entry, target_path)
+                for entry, target_path in todo
+            }
+
+            for future in as_completed(futures):
+                entry, target_path = futures[future]
+
+                try:
+                    n_bytes = future.result()
+                except Exception as e:
+                    download_failures.append(
+                        {
+                            "target_path": target_path,
+                            "exception": type(e).__name__,
+                            "message": str(e),
+                        }
+                    )
+                    progress.update(failed=True)
+                else:
+                    target_dir, name = os.path.split(target_path)
+                    records[target_dir][name] = make_record(entry, target_path)
+                    changed_dirs.add(target_dir)
+
+                    progress.update(n_bytes)
+    finally:
+        save_records(records, changed_dirs)
+
+    return download_failures
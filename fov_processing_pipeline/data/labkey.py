@@ -1,39 +1,158 @@
+import os
+import re
+import time
+
 import pandas as pd
 import numpy as np
 
 from . import utils as data_utils
+from .. import output
+
+
+# Seconds that cached LabKey responses are used for before they are requested again
+CACHE_EXPIRY = 24 * 60 * 60
 
+# Host of the cache files of the production server, which get_labkey connects to when no host is given
+PRODUCTION_HOST = "production"
 
-def get_cell_data():
-    # returns a datframe where every row is a cell
+
+def get_labkey(host=None):
+    # Returns a LabKey connection to the production server, or to host
 
     # Move this to top-level imports if/when lkaccess becomes open source
     import lkaccess
     import lkaccess.contexts
 
-    use_staging = False
+    if host is not None:
+        return lkaccess.LabKey(host=host)
 
-    ############################################
-    # Get the basic cell-level data from Labkey
-    ############################################
+    use_staging = False
 
-    # Create labkey connection
     if use_staging:
         # I dont know what this is
-        lk = lkaccess.LabKey(server_context=lkaccess.contexts.STAGE)
+        return lkaccess.LabKey(server_context=lkaccess.contexts.STAGE)
     else:
-        lk = lkaccess.LabKey(server_context=lkaccess.contexts.PROD)
+        return lkaccess.LabKey(server_context=lkaccess.contexts.PROD)
+
+
+def get_cache_path(cache_dir, name, host=None):
+    # the responses of each server are cached separately, with the host made safe for a file name
+    host = PRODUCTION_HOST if host is None else re.sub(r"[^\w.-]", "_", host)
+
+    return f"{cache_dir}/labkey_{host}_{name}.pkl"
+
+
+def cached_query(name, query_fn, host=None, cache_dir=None, cache_expiry=CACHE_EXPIRY):
+    """
+    Returns the response of query_fn() to the server host (see get_labkey) as a dataframe. If cache_dir is set, the
+    response is cached there and reused until it is older than cache_expiry seconds.
+    """
+
+    if cache_dir is None:
+        return pd.DataFrame(query_fn())
+
+    cache_path = get_cache_path(cache_dir, name, host=host)
+
+    if (
+        os.path.exists(cache_path)
+        and time.time() - os.path.getmtime(cache_path) < cache_expiry
+    ):
+        return pd.read_pickle(cache_path)
+
+    df = pd.DataFrame(query_fn())
+
+    if not os.path.exists(cache_dir):
+        os.makedirs(cache_dir)
+
+    # so that a query that is interrupted (or that runs at the same time) never leaves half of a cache file
+    output.atomic_write(cache_path, lambda path, obj: obj.to_pickle(path), df)
+
+    return df
+
+
+def first_annotation(mito_data, cell_ids, missing):
+    """
+    Returns the first annotation of each cell in cell_ids, or `missing` if it has none. The annotations are in the
+    order LabKey returns them (sorted by MitoticAnnotation), so the same one is picked every time.
+    """
+
+    first_states = mito_data.drop_duplicates(subset="CellId", keep="first")
+    first_states = first_states.set_index("CellId")["MitoticStateId/Name"]
+
+    mito_states = pd.Series(cell_ids).map(first_states).fillna(missing)
+
+    return mito_states.values.astype(str)
+
+
+def get_cell_data(
+    lk=None,
+    lk_mito=None,
+    host=None,
+    mito_host="aics",
+    cache_dir=None,
+    cache_expiry=CACHE_EXPIRY,
+):
+    """
+    Returns a datframe where every row is a cell
+
+    Parameters
+    ----------
+    lk: lkaccess.LabKey or None
+        connection for the cell and cell line data. Defaults to a connection to host.
+
+    lk_mito: lkaccess.LabKey or None
+        connection for the mitotic annotations. Defaults to a connection to mito_host.
+
+    host: str or None
+        host of lk, or None for the production server. The cached responses are kept per host.
+
+    mito_host: str or None
+        host of lk_mito
+
+    cache_dir: str or None
+        directory to cache the LabKey responses in, see cached_query
+
+    cache_expiry: float
+        seconds that cached responses are used for
+    """
+
+    # connect only if something isn't cached
+    def get_lk():
+        return lk if lk is not None else get_labkey(host=host)
+
+    def get_lk_mito():
+        return lk_mito if lk_mito is not None else get_labkey(host=mito_host)
+
+    ############################################
+    # Get the basic cell-level data from Labkey
+    ############################################
 
     # Get pipeline 4 data
-    data = pd.DataFrame(lk.dataset.get_pipeline_4_production_data())
+    data = cached_query(
+        "pipeline_4_production_data",
+        lambda: get_lk().dataset.get_pipeline_4_production_data(),
+        host=host,
+        cache_dir=cache_dir,
+        cache_expiry=cache_expiry,
+    )
 
     # Get cell line data from some other location in labkey
-    cell_line_data = lk.select_rows_as_list(
-        schema_name="celllines",
-        query_name="CellLineDefinition",
-        columns=["CellLineId", "CellLineId/Name", "StructureId/Name", "ProteinId/Name"],
+    cell_line_data = cached_query(
+        "cell_line_definition",
+        lambda: get_lk().select_rows_as_list(
+            schema_name="celllines",
+            query_name="CellLineDefinition",
+            columns=[
+                "CellLineId",
+                "CellLineId/Name",
+                "StructureId/Name",
+                "ProteinId/Name",
+            ],
+        ),
+        host=host,
+        cache_dir=cache_dir,
+        cache_expiry=cache_expiry,
     )
-    cell_line_data = pd.DataFrame(cell_line_data)
 
     # Merge the pipeline 4 and cell line data
     data = data.merge(cell_line_data, how="left", on="CellLineId")
@@ -46,16 +165,19 @@ def get_cell_data():
     ############################################
     # Get the mitosis data Labkey
     ############################################
-    lk = lkaccess.LabKey(host="aics")
-    mito_data = lk.select_rows_as_list(
-        schema_name="processing",
-        query_name="MitoticAnnotation",
-        sort="MitoticAnnotation",
-        columns=["CellId", "MitoticStateId", "MitoticStateId/Name", "Complete"],
+    mito_data = cached_query(
+        "mitotic_annotation",
+        lambda: get_lk_mito().select_rows_as_list(
+            schema_name="processing",
+            query_name="MitoticAnnotation",
+            sort="MitoticAnnotation",
+            columns=["CellId", "MitoticStateId", "MitoticStateId/Name", "Complete"],
+        ),
+        host=mito_host,
+        cache_dir=cache_dir,
+        cache_expiry=cache_expiry,
     )
 
-    mito_data = pd.DataFrame(mito_data)
-
     # get both binary mitosis labels and resolved (m1, m2, etc) labels
 
     mito_binary_inds = mito_data["MitoticStateId/Name"] == "Mitosis"
@@ -64,32 +186,17 @@ def get_cell_data():
     mito_data_binary = mito_data[mito_binary_inds | not_mito_inds]
     mito_data_resolved = mito_data[~mito_binary_inds]
 
-    mito_states = list()
-    for cellId in data["CellId"]:
-        mito_state = mito_data_binary["MitoticStateId/Name"][
-            mito_data_binary["CellId"] == cellId
-        ].values
-        if len(mito_state) == 0:
-            mito_state = "unknown"
+    # cells without an annotation have always been labeled "u"
+    mito_states = first_annotation(mito_data_binary, data["CellId"], "u")
 
-        mito_states.append(mito_state[0])
-
-    data["mito_state_binary"] = np.array(mito_states)
+    data["mito_state_binary"] = mito_states
     data["mito_state_binary_ind"] = np.array(
         np.unique(mito_states, return_inverse=True)[1]
     )
 
-    mito_states = list()
-    for cellId in data["CellId"]:
-        mito_state = mito_data_resolved["MitoticStateId/Name"][
-            mito_data_resolved["CellId"] == cellId
-        ].values
-        if len(mito_state) == 0:
-            mito_state = "u"
-
-        mito_states.append(mito_state[0])
+    mito_states = first_annotation(mito_data_resolved, data["CellId"], "u")
 
-    data["mito_state_resolved"] = np.array(mito_states)
+    data["mito_state_resolved"] = mito_states
     data["mito_state_resolved_ind"] = np.array(
         np.unique(mito_states, return_inverse=True)[1]
     )
@@ -97,13 +204,15 @@ def get_cell_data():
     return data
 
 
-def get_data(n_fovs=100, protein_list=None):
+def get_data(n_fovs=100, protein_list=None, cache_dir=None, **kwargs):
 
     # Returns dataframe containing image paths and metadata for pipeline4
     #
     # trim_data - use a canned data subset
+    # cache_dir - directory to cache the LabKey responses in
+    # kwargs - passed to get_cell_data
 
-    cell_data = get_cell_data()
+    cell_data = get_cell_data(cache_dir=cache_dir, **kwargs)
 
     cell_data, fov_data = data_utils.clean_cell_data(
         cell_data, protein_list=protein_list, n_fovs=n_fovs
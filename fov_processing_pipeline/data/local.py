@@ -0,0 +1,181 @@
+"""
+local.py: Data source for FOV images that are already on a local or parallel filesystem, described by a manifest.
+
+The manifest is a table (CSV or Parquet) with a row per cell or per FOV. It needs the columns in
+data.utils.REQUIRED_COLUMNS, "PlateId", and either "SourceReadPath" or "SourceFilename", the path of the FOV image
+relative to the data directory (or absolute). Everything else (e.g. CellId, ChannelNumber*) is optional. The image
+dimensions are read from the image headers.
+"""
+
+import os
+import warnings
+
+import pandas as pd
+
+from .. import memory
+from . import synthetic
+from . import utils as data_utils
+
+MANIFEST_FILENAMES = ["manifest.parquet", "manifest.csv"]
+
+IMAGE_EXTENSIONS = (".ome.tiff", ".ome.tif", ".tiff", ".tif")
+
+# the output paths of each FOV are per-plate, so the manifest needs a PlateId too
+MANIFEST_COLUMNS = data_utils.REQUIRED_COLUMNS + ["PlateId"]
+
+# values of the columns that the reports use, for manifests that don't have them
+DEFAULT_VALUES = {
+    "Workflow": "Unknown",
+    "Clone": "Unknown",
+    "Gene": "Unknown",
+    "StructureShortName": "Unknown",
+}
+
+
+def find_manifest(data_dir):
+    for manifest_filename in MANIFEST_FILENAMES:
+        manifest_path = f"{data_dir}/{manifest_filename}"
+        if os.path.exists(manifest_path):
+            return manifest_path
+
+    raise FileNotFoundError(
+        f"No manifest found in {data_dir}, expected one of {MANIFEST_FILENAMES}"
+    )
+
+
+def load_manifest(manifest_path):
+    if manifest_path.endswith(".parquet"):
+        return pd.read_parquet(manifest_path)
+
+    return pd.read_csv(manifest_path)
+
+
+def scan_images(data_dir):
+    """
+    Returns the paths of all of the images under data_dir, relative to data_dir
+    """
+
+    image_paths = list()
+    for root, dirs, filenames in os.walk(data_dir):
+        for filename in filenames:
+            if filename.lower().endswith(IMAGE_EXTENSIONS):
+                image_paths.append(
+                    os.path.relpath(os.path.join(root, filename), data_dir)
+                )
+
+    return image_paths
+
+
+def get_image_dims(image_paths):
+    """
+    Returns a dataframe of the dimensions (SizeC, SizeZ, SizeY, SizeX) and PixelType of each image, from the headers
+    """
+
+    rows = list()
+    for image_path in image_paths:
+        dims, dtype = memory.read_image_header(image_path)
+
+        row = {"SourceReadPath": image_path}
+        for dim in ["C", "Z", "Y", "X"]:
+            row[f"Size{dim}"] = dims.get(dim, 1)
+        row["PixelType"] = str(dtype)
+
+        rows.append(row)
+
+    return pd.DataFrame(
+        rows,
+        columns=["SourceReadPath", "SizeC", "SizeZ", "SizeY", "SizeX", "PixelType"],
+    )
+
+
+def get_data(data_dir=None, manifest_path=None, n_fovs=100, protein_list=None):
+    """
+    Function to index a directory of FOV images and return pandas dataframes containing per-fov and per-cell info
+
+    Parameters
+    ----------
+    data_dir: str
+        directory of the images
+
+    manifest_path: str or None
+        path to the manifest. Defaults to manifest.parquet or manifest.csv in data_dir.
+
+    n_fovs: int
+        Number of images per protein to retain
+
+    protein_list:
+        Protein names to retain
+
+    Returns
+    -------
+    cell_data: pandas.DataFrame
+        Dataframe where each row corresponds to a single cell (or FOV, if the manifest is per-FOV)
+
+    fov_data: pandas.DataFrame
+        Dataframe where each row corresponds to an FOV
+    """
+
+    if data_dir is None:
+        raise ValueError('The "local" dataset needs a data_dir.')
+
+    data_dir = os.path.abspath(data_dir)
+
+    if manifest_path is None:
+        manifest_path = find_manifest(data_dir)
+
+    cell_data = load_manifest(manifest_path)
+
+    missing_columns = [column for column in MANIFEST_COLUMNS if column not in cell_data]
+    if len(missing_columns) > 0:
+        raise ValueError(f"{manifest_path} is missing the columns {missing_columns}")
+
+    if "SourceReadPath" not in cell_data.columns:
+        cell_data["SourceReadPath"] = cell_data["SourceFilename"]
+
+    # a manifest with a row per FOV counts each FOV as one cell
+    if "CellId" not in cell_data.columns:
+        cell_data["CellId"] = cell_data["FOVId"]
+
+    # keep only the rows whose images are there
+    image_paths = set(scan_images(data_dir))
+    relative_paths = [
+        os.path.relpath(path, data_dir) if os.path.isabs(path) else path
+        for path in cell_data["SourceReadPath"]
+    ]
+    found = [path in image_paths for path in relative_paths]
+
+    if not all(found):
+        missing_fov_ids = pd.unique(cell_data["FOVId"][[not f for f in found]])
+        warnings.warn(
+            f"{len(missing_fov_ids)} FOVs in {manifest_path} have no image in {data_dir} and are skipped."
+        )
+
+    cell_data["SourceReadPath"] = [
+        os.path.join(data_dir, path) for path in relative_paths
+    ]
+    cell_data = cell_data[found]
+
+    # add the dimensions of each image
+    fov_paths = pd.unique(cell_data["SourceReadPath"])
+    cell_data = cell_data.merge(
+        get_image_dims(fov_paths), how="left", on="SourceReadPath"
+    )
+
+    if "CellLineId" not in cell_data.columns:
+        cell_data["CellLineId"] = pd.factorize(cell_data["CellLine"])[0] + 1
+
+    for column, value in DEFAULT_VALUES.items():
+        if column not in cell_data.columns:
+            cell_data[column] = value
+
+    # assume the Pipeline 4 channel layout unless the manifest says otherwise
+    for column, channel_number in synthetic.PIPELINE_4_CHANNELS.items():
+        if column not in cell_data.columns:
+            cell_data[column] = channel_number
+
+    # clean the data up
+    cell_data, fov_data = data_utils.clean_cell_data(
+        cell_data, protein_list=protein_list, n_fovs=n_fovs
+    )
+
+    return cell_data, fov_data
@@ -1,8 +1,43 @@
 import os
+import warnings
 
-import quilt3
-
+from . import download
 from . import utils as data_utils
+from .. import output
+
+
+def get_metadata(package, cache_dir=None):
+    """
+    Returns the per-cell metadata table of a package.
+
+    Parsing metadata.csv takes a while for the whole Pipeline 4 dataset, so if cache_dir is set the table is cached
+    there as Parquet, keyed by the top hash of the package. The cache is used until the package changes.
+    """
+
+    top_hash = getattr(package, "top_hash", None)
+
+    cache_path = None
+    if cache_dir is not None and top_hash is not None:
+        cache_path = f"{cache_dir}/metadata_{top_hash}.parquet"
+
+        if os.path.exists(cache_path):
+            return data_utils.load_table(cache_path)
+
+    metadata_fn = package["metadata.csv"]
+
+    cell_data = metadata_fn()  # noqa
+
+    if cache_path is not None:
+        if not os.path.exists(cache_dir):
+            os.makedirs(cache_dir)
+
+        # so that an interrupted run (or one that runs at the same time) never leaves half of a cache file, which
+        # would be used until the package changes
+        output.atomic_write(
+            cache_path, lambda path, obj: data_utils.save_table(obj, path), cell_data
+        )
+
+    return cell_data
 
 
 def get_data(
@@ -11,6 +46,9 @@ def get_data(
     protein_list=None,
     overwrite=False,
     use_current_results=False,
+    package=None,
+    n_workers=8,
+    cache_dir=None,
 ):
     """
     Function to pull data from quilt3 and return pandas dataframes containing per-fov and per-cell info
@@ -32,6 +70,15 @@ def get_data(
     use_current_results: bool
         do we skip downloading data, and just use whatever data already present on disc
 
+    package: quilt3.Package or None
+        package to get the data from. Defaults to aics/pipeline_integrated_cell on s3://allencell.
+
+    n_workers: int
+        number of images to download at the same time
+
+    cache_dir: str or None
+        directory to cache the package metadata in, see get_metadata
+
     Returns
     -------
     cell_data: pandas.DataFrame
@@ -41,13 +88,15 @@ def get_data(
         Dataframe where each row corresponds to an FOV
     """
 
-    aics_pipeline = quilt3.Package.browse(
-        "aics/pipeline_integrated_cell", registry="s3://allencell"
-    )
+    if package is None:
+        # imported here so that only the data-fetch stage pays for loading quilt3
+        import quilt3
 
-    metadata_fn = aics_pipeline["metadata.csv"]
+        package = quilt3.Package.browse(
+            "aics/pipeline_integrated_cell", registry="s3://allencell"
+        )
 
-    cell_data = metadata_fn()  # noqa
+    cell_data = get_metadata(package, cache_dir=cache_dir)
 
     image_source_paths = cell_data[
         "SourceReadPath"
@@ -72,16 +121,24 @@ def get_data(
 
     # now use the unique paths from the cell_data to copy over everything to the right location
     if not use_current_results:
-        for image_source_path, image_target_path in zip(
-            fov_data["SourceReadPath_quilt"], fov_data["SourceReadPath"]
-        ):
-            if os.path.exists(image_target_path) and not overwrite:
-                continue
-
-            # We only do this because T4 hates our filesystem. It probably wont affect you.
-            try:
-                aics_pipeline[image_source_path].fetch(image_target_path)
-            except OSError:
-                pass
+        download_failures = download.download_files(
+            [
+                package[image_source_path]
+                for image_source_path in fov_data["SourceReadPath_quilt"]
+            ],
+            list(fov_data["SourceReadPath"]),
+            n_workers=n_workers,
+            overwrite=overwrite,
+        )
+
+        if len(download_failures) > 0:
+            # these FOVs fail to load, and are quarantined when they are processed
+            warnings.warn(
+                "{} images could not be downloaded, e.g. {}: {}".format(
+                    len(download_failures),
+                    download_failures[0]["target_path"],
+                    download_failures[0]["message"],
+                )
+            )
 
     return cell_data, fov_data
@@ -0,0 +1,109 @@
+"""
+sources.py: The data sources that wrappers.save_load_data can get the cell and FOV tables from.
+
+A data source is a function that is called as
+
+    source(save_dir, protein_list=None, n_fovs=100, overwrite=False, cache_dir=None, **kwargs)
+
+where save_dir is the directory for the raw data of a run (e.g. downloaded images), cache_dir is the directory for
+caches that are shared between runs (e.g. of the quilt metadata and LabKey responses, see get_cache_dir) and kwargs are
+the dataset_kwargs given to save_load_data. It returns (cell_data, fov_data), which have at least the columns in
+data.utils.REQUIRED_COLUMNS, "SourceReadPath" and the "ChannelNumber*" columns. New sources are added with
+@register_data_source("name").
+"""
+
+import os
+
+from . import labkey, local, quilt, synthetic
+
+DATA_SOURCES = dict()
+
+
+def register_data_source(name):
+    # decorator that makes a data source available as dataset=name
+    def decorator(source):
+        DATA_SOURCES[name] = source
+        return source
+
+    return decorator
+
+
+def get_cache_dir(cache_dir=None):
+    # cache_dir, or the user's cache directory (~/.cache/fov_processing_pipeline on Linux), so that every run of the
+    # user can use the caches, even in a new results directory
+    if cache_dir is not None:
+        return str(cache_dir)
+
+    cache_home = os.environ.get("XDG_CACHE_HOME") or os.path.join(
+        os.path.expanduser("~"), ".cache"
+    )
+
+    return os.path.join(cache_home, "fov_processing_pipeline")
+
+
+def get_data(
+    dataset,
+    save_dir,
+    protein_list=None,
+    n_fovs=100,
+    overwrite=False,
+    cache_dir=None,
+    **kwargs,
+):
+    if dataset not in DATA_SOURCES:
+        raise ValueError(
+            f"unrecognized dataset parameter {dataset}, must be one of {list(DATA_SOURCES.keys())}"
+        )
+
+    return DATA_SOURCES[dataset](
+        save_dir,
+        protein_list=protein_list,
+        n_fovs=n_fovs,
+        overwrite=overwrite,
+        cache_dir=get_cache_dir(cache_dir),
+        **kwargs,
+    )
+
+
+@register_data_source("quilt")
+def quilt_source(
+    save_dir, protein_list=None, n_fovs=100, overwrite=False, cache_dir=None, **kwargs
+):
+    return quilt.get_data(
+        save_dir=f"{save_dir}/images/",
+        protein_list=protein_list,
+        n_fovs=n_fovs,
+        overwrite=overwrite,
+        cache_dir=cache_dir,
+        **kwargs,
+    )
+
+
+@register_data_source("labkey")
+def labkey_source(
+    save_dir, protein_list=None, n_fovs=100, overwrite=False, cache_dir=None, **kwargs
+):
+    return labkey.get_data(
+        protein_list=protein_list, n_fovs=n_fovs, cache_dir=cache_dir, **kwargs
+    )
+
+
+@register_data_source("synthetic")
+def synthetic_source(
+    save_dir, protein_list=None, n_fovs=100, overwrite=False, cache_dir=None, **kwargs
+):
+    return synthetic.get_data(
+        save_dir=f"{save_dir}/images/",
+        protein_list=protein_list,
+        n_fovs=n_fovs,
+        overwrite=overwrite,
+        **kwargs,
+    )
+
+
+@register_data_source("local")
+def local_source(
+    save_dir, protein_list=None, n_fovs=100, overwrite=False, cache_dir=None, **kwargs
+):
+    # the images stay where they are, so there is nothing to save or overwrite
+    return local.get_data(protein_list=protein_list, n_fovs=n_fovs, **kwargs)
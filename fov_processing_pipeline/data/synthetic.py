@@ -0,0 +1,340 @@
+"""
+synthetic.py: Generates a synthetic dataset of multi-channel OME-TIFF FOVs and the matching cell/FOV tables, so the
+pipeline can be run (and benchmarked) without access to quilt or LabKey.
+
+The images look enough like Pipeline 4 FOVs for every stage of the pipeline to do real work: nuclei with a DNA
+intensity that peaks in the middle of the stack (so they pass QC), cell membranes, structure puncta, a brightfield
+background and the segmentation channels, all with camera-like noise.
+"""
+
+import os
+
+import numpy as np
+import pandas as pd
+
+from .. import filesystem
+from . import utils as data_utils
+
+# C, Z, Y, X
+DEFAULT_SHAPE = (7, 16, 128, 192)
+
+# Channel indices of the Pipeline 4 source images. The other channels are segmentations.
+PIPELINE_4_CHANNELS = {
+    "ChannelNumber638": 1,
+    "ChannelNumberStruct": 3,
+    "ChannelNumber405": 5,
+    "ChannelNumberBrightfield": 6,
+}
+
+WORKFLOWS = ["Pipeline 4", "Pipeline 4.1", "Pipeline 4.2"]
+
+
+def get_channel_numbers(n_channels):
+    """
+    Returns the ChannelNumber* columns for an image with n_channels channels. Images with at least 7 channels use the
+    Pipeline 4 layout, smaller ones put the imaging channels first.
+    """
+
+    if n_channels >= 7:
+        return dict(PIPELINE_4_CHANNELS)
+
+    if n_channels < 4:
+        raise ValueError(f"At least 4 channels are needed, got {n_channels}.")
+
+    return {
+        "ChannelNumber638": 0,
+        "ChannelNumberStruct": 1,
+        "ChannelNumber405": 2,
+        "ChannelNumberBrightfield": 3,
+    }
+
+
+def _full_scale(dtype):
+    # brightest value of a pixel, like a 12-bit camera for 16-bit images
+    dtype = np.dtype(dtype)
+
+    if dtype.kind in "ui":
+        return float(min(np.iinfo(dtype).max, 4095))
+
+    return 1.0
+
+
+def make_fov_image(shape=DEFAULT_SHAPE, dtype="uint16", n_cells=8, seed=0):
+    """
+    Makes a synthetic FOV image
+
+    Parameters
+    ----------
+    shape: tuple of ints
+        (C, Z, Y, X) size of the image. C must be at least 4.
+
+    dtype: str or np.dtype
+        pixel type of the image
+
+    n_cells: int
+        number of cells in the image
+
+    seed: int or sequence of ints
+        seed of the random number generator
+
+    Returns
+    -------
+    im: np.array
+        CZYX image
+    """
+
+    n_channels, n_z, n_y, n_x = shape
+    channel_numbers = get_channel_numbers(n_channels)
+    rng = np.random.default_rng(seed)
+
+    full_scale = _full_scale(dtype)
+    background = 0.1 * full_scale
+    amplitude = 0.6 * full_scale
+    noise = 0.02 * full_scale
+
+    # Cells are the Voronoi regions around random centers, with a round nucleus in the middle
+    yy, xx = np.ogrid[0:n_y, 0:n_x]
+    centers = rng.uniform([0, 0], [n_y, n_x], size=(n_cells, 2))
+    radius = 0.5 * np.sqrt(n_y * n_x / n_cells)
+
+    dist = np.full((n_y, n_x), np.inf, dtype=np.float32)
+    labels = np.zeros((n_y, n_x), dtype=np.int32)
+    for i, (y, x) in enumerate(centers):
+        dist_cell = np.sqrt((yy - y) ** 2 + (xx - x) ** 2).astype(np.float32)
+        closer = dist_cell < dist
+        dist[closer] = dist_cell[closer]
+        labels[closer] = i + 1
+
+    dist = dist / radius
+    cell_mask = dist < 1
+    labels[~cell_mask] = 0
+
+    dna = np.exp(-(dist ** 2) / (2 * 0.3 ** 2))
+    membrane = np.exp(-((dist - 0.9) ** 2) / (2 * 0.08 ** 2))
+    structure = (
+        cell_mask * (rng.random((n_y, n_x)) < 0.02) * rng.uniform(0.5, 1, (n_y, n_x))
+    )
+    brightfield = 0.8 - 0.3 * cell_mask
+
+    # Intensity through the stack. The DNA peaks a bit above the middle of the stack, like the cells in Pipeline 4.
+    z = np.arange(n_z, dtype=np.float32)
+    z_center = 0.55 * (n_z - 1)
+    z_in_focus = np.exp(-((z - z_center) ** 2) / (2 * max(n_z / 6, 1) ** 2))
+
+    channels_xy = {
+        "ChannelNumber405": (dna, z_in_focus),
+        "ChannelNumber638": (membrane, z_in_focus ** 0.5),
+        "ChannelNumberStruct": (structure, z_in_focus),
+        "ChannelNumberBrightfield": (brightfield, 1 - 0.5 * z_in_focus),
+    }
+
+    segmentations = [
+        labels * (dist < 0.5),  # nucleus
+        labels,  # cell
+        (structure > 0).astype(np.int32),  # structure
+    ]
+
+    im = np.zeros(shape, dtype=dtype)
+
+    for column, (im_xy, z_profile) in channels_xy.items():
+        channel = (
+            amplitude * im_xy[np.newaxis, :, :] * z_profile[:, np.newaxis, np.newaxis]
+        ).astype(np.float32)
+        channel += background
+        channel += noise * rng.standard_normal(channel.shape, dtype=np.float32)
+
+        im[channel_numbers[column]] = np.clip(channel, 0, full_scale)
+
+    # Everything else is a segmentation, only present in the middle of the stack
+    z_segmentation = z_in_focus > 0.1
+    other_channels = [c for c in range(n_channels) if c not in channel_numbers.values()]
+    for i, c in enumerate(other_channels):
+        segmentation = segmentations[i % len(segmentations)]
+        im[c] = (
+            segmentation[np.newaxis, :, :] * z_segmentation[:, np.newaxis, np.newaxis]
+        )
+
+    return im
+
+
+def make_cell_data(
+    image_dir, n_fovs=10, protein_list=None, n_channels=7, n_cells=(4, 12), seed=0
+):
+    """
+    Makes a table of synthetic cells with the same columns as the raw quilt/LabKey metadata that the pipeline uses
+
+    Parameters
+    ----------
+    image_dir: str
+        directory the images will be saved in
+
+    n_fovs: int
+        number of FOVs per protein
+
+    protein_list: list of strs
+        names of the proteins. Defaults to data.utils.DEFAULT_PROTEIN_LIST
+
+    n_channels: int
+        number of channels of the images
+
+    n_cells: tuple of ints
+        (min, max) number of cells per FOV
+
+    seed: int
+        seed of the random number generator
+
+    Returns
+    -------
+    cell_data: pandas.DataFrame
+        Dataframe where each row corresponds to a single cell
+    """
+
+    if protein_list is None:
+        protein_list = data_utils.DEFAULT_PROTEIN_LIST
+
+    rng = np.random.default_rng(seed)
+    channel_numbers = get_channel_numbers(n_channels)
+
+    fovs_per_plate = 6
+
+    rows = list()
+    fov_id = 1
+    cell_id = 1
+    for i, protein in enumerate(protein_list):
+        cell_line_id = i + 1
+        gene = "".join(protein.split()).upper()
+
+        for j in range(n_fovs):
+            plate_id = 1000 + cell_line_id * 100 + j // fovs_per_plate
+            well_id = plate_id * 10 + j % fovs_per_plate
+            workflow_id = j % len(WORKFLOWS)
+
+            fov_n_cells = int(rng.integers(n_cells[0], n_cells[1] + 1))
+            source_filename = f"{fov_id}.ome.tiff"
+
+            for k in range(fov_n_cells):
+                row = {
+                    "CellId": cell_id,
+                    "CellIndex": k + 1,
+                    "FOVId": fov_id,
+                    "PlateId": plate_id,
+                    "WellId": well_id,
+                    "WellName": f"{chr(ord('A') + j % fovs_per_plate)}{j // fovs_per_plate + 1}",
+                    "CellLine": f"SYN-{cell_line_id}",
+                    "CellLineId": cell_line_id,
+                    "Clone": 1,
+                    "Gene": gene,
+                    "ProteinDisplayName": protein,
+                    "StructureShortName": protein,
+                    "StructureId": cell_line_id,
+                    "Workflow": WORKFLOWS[workflow_id],
+                    "WorkflowId": workflow_id + 1,
+                    "DataSetId": 1,
+                    "PixelScaleX": 0.108,
+                    "PixelScaleY": 0.108,
+                    "PixelScaleZ": 0.29,
+                    "SourceFilename": source_filename,
+                    "SourceReadPath": f"{image_dir}/plate_{plate_id}/{source_filename}",
+                    "StructEducationName": protein,
+                    "StructureSegmentationAlgorithmVersion": "synthetic",
+                    "RunId": 1,
+                }
+                row.update(channel_numbers)
+                rows.append(row)
+
+                cell_id += 1
+            fov_id += 1
+
+    return pd.DataFrame(rows)
+
+
+def get_data(
+    save_dir=None,
+    n_fovs=10,
+    protein_list=None,
+    overwrite=False,
+    use_current_results=False,
+    shape=DEFAULT_SHAPE,
+    dtype="uint16",
+    n_cells=(4, 12),
+    seed=0,
+):
+    """
+    Function to generate synthetic data and return pandas dataframes containing per-fov and per-cell info
+
+    Parameters
+    ----------
+    save_dir: str
+        save directory of images
+
+    n_fovs: int
+        Number of images per protein
+
+    protein_list:
+        Protein names. Defaults to data.utils.DEFAULT_PROTEIN_LIST
+
+    overwrite: bool
+        do we overwrite the images if they exist?
+
+    use_current_results: bool
+        do we skip making images, and just use whatever images are already present on disc
+
+    shape: tuple of ints
+        (C, Z, Y, X) size of the images
+
+    dtype: str or np.dtype
+        pixel type of the images
+
+    n_cells: tuple of ints
+        (min, max) number of cells per FOV
+
+    seed: int
+        seed of the random number generator. Each image depends only on the seed and its FOVId.
+
+    Returns
+    -------
+    cell_data: pandas.DataFrame
+        Dataframe where each row corresponds to a single cell
+
+    fov_data: pandas.DataFrame
+        Dataframe where each row corresponds to an FOV
+    """
+
+    cell_data = make_cell_data(
+        save_dir,
+        n_fovs=n_fovs,
+        protein_list=protein_list,
+        n_channels=shape[0],
+        n_cells=n_cells,
+        seed=seed,
+    )
+
+    # this is a new dataset, so it can use the fast ID hash
+    cell_data, fov_data = data_utils.clean_cell_data(
+        cell_data, protein_list=protein_list, n_fovs=n_fovs, rng_method="hash"
+    )
+
+    if not use_current_results:
+        from aicsimageio import writers
+
+        n_cells_per_fov = cell_data.groupby("FOVId").size()
+
+        for i, fov_row in fov_data.iterrows():
+            image_path = fov_row["SourceReadPath"]
+            if filesystem.file_index.exists(image_path) and not overwrite:
+                continue
+
+            filesystem.file_index.makedirs(os.path.dirname(image_path))
+
+            im = make_fov_image(
+                shape=shape,
+                dtype=dtype,
+                n_cells=n_cells_per_fov[fov_row["FOVId"]],
+                seed=[seed, fov_row["FOVId"]],
+            )
+
+            with writers.OmeTiffWriter(image_path, overwrite_file=True) as writer:
+                writer.save(im[np.newaxis], dimension_order="TCZYX")
+            filesystem.file_index.add(image_path)
+
+    return cell_data, fov_data
@@ -1,15 +1,36 @@
+import os
 import warnings
 from sys import platform
 
-import pandas as pd
 import numpy as np
+import pandas as pd
 
-from ..utils import int2rand
+from ..utils import ids2rand
 
 REQUIRED_COLUMNS = ["ProteinDisplayName", "CellLine", "FOVId"]
 
+# Columns that are always stored as categoricals. So are image path columns (*ReadPath*), and any other text column
+# where values repeat (e.g. per-FOV file names in the cell table).
+CATEGORICAL_COLUMNS = ["ProteinDisplayName", "CellLine", "Workflow"]
+
+# Column of fov_data with the fingerprint of each FOV's source data, see get_fov_fingerprints
+FINGERPRINT_COLUMN = "SourceFingerprint"
+
+# preset cell lines are: ER, Fibrillarin (Nucleolus), Golgi, Nucleophosmin (Nucleolus), Alpha Actinin, ...
+# listing of cell lines by ID can be found at: https://www.allencell.org/cell-catalog.html
+DEFAULT_PROTEIN_LIST = [
+    "Sec61 beta",  # er
+    "Fibrillarin",  # nucleolus, DFC
+    "Nucleophosmin",  # nucleolus, GC
+    "Sialyltransferase 1",  # golgi,
+    "Alpha-actinin-1",  # alpha actinin
+    "Non-muscle myosin heavy chain IIB",  # actomyosin bundles
+    "Lamin B1",  # nuclear lamin
+    "Alpha-tubulin",
+]
 
-def clean_columns(cell_data):
+
+def clean_columns(cell_data, rng_method="pcg64"):
     ############################################
     # Adjust file paths
     ############################################
@@ -44,26 +65,30 @@ def clean_columns(cell_data):
         "RunId",
     ]
 
-    cell_data = cell_data.drop(drop_columns, axis=1)
+    # not every data source has all of these
+    cell_data = cell_data.drop(drop_columns, axis=1, errors="ignore")
 
     ############################################
     # Assign random numbers to IDs
+    # The data splits are made from the *_rng columns (e.g. FOVId_rng, CellId_rng), so keep rng_method="pcg64" for
+    # existing datasets. rng_method="hash" is much faster for columns with many IDs (e.g. CellId, which is different for
+    # every cell), but gives different numbers, see utils.ids2rand
     ############################################
 
     id_columns = [column for column in cell_data.columns if column[-2:] == "Id"]
 
     for id_column in id_columns:
-        cell_data["{}_rng".format(id_column)] = [
-            int2rand(int(my_id)) for my_id in cell_data[id_column]
-        ]
+        cell_data["{}_rng".format(id_column)] = ids2rand(
+            cell_data[id_column].astype(int), method=rng_method
+        )
 
     return cell_data
 
 
 def cell_data_to_fov_data(cell_data):
-    _, FOVId_index = np.unique(cell_data["FOVId"], return_index=True)
-
-    fov_data = cell_data.iloc[FOVId_index]
+    # the first row of each FOV, in order of FOVId
+    fov_data = cell_data.drop_duplicates(subset="FOVId", keep="first")
+    fov_data = fov_data.sort_values("FOVId", kind="stable")
 
     # Drop any columns that are per-cell information
     drop_columns = [
@@ -81,25 +106,26 @@ def cell_data_to_fov_data(cell_data):
 def trim_data_by_cellline_fov_count(df, n_fovs):
 
     ############################################
-    # For all cell lines, trim number of FOVS to n_fovs (or less)
+    # For all cell lines, trim number of FOVS to n_fovs (or less), keeping the lowest FOVIds
     ############################################
 
-    keep_fov_ids = []
-    for id in pd.unique(df["CellLine"]):
-        df_struct = df[df["CellLine"] == id]
+    df_fovs = df[["CellLine", "FOVId"]].drop_duplicates()
 
-        # make sure the desired number of fovs isn't greater than the number of available fovs
-        if n_fovs <= pd.unique(df_struct["FOVId"]).shape[0]:
-            keep_fov_ids.extend(list(np.sort(pd.unique(df_struct["FOVId"]))[:n_fovs],))
+    fov_rank = df_fovs.groupby("CellLine", observed=True, sort=False)["FOVId"].rank(
+        method="first"
+    )
+    keep_fov_ids = df_fovs["FOVId"][fov_rank <= n_fovs]
 
-        else:
+    # make sure the desired number of fovs isn't greater than the number of available fovs
+    n_cell_line_fovs = df_fovs.groupby("CellLine", observed=True, sort=False).size()
+    for id in pd.unique(df_fovs["CellLine"]):
+        if n_cell_line_fovs[id] < n_fovs:
             warnings.warn(
                 "Desired number FOVs is greater than original number FOVS for "
                 + id
                 + "."
             )
             warnings.warn("Keeping all FOVs for this cell line.")
-            keep_fov_ids.extend(pd.unique(df_struct["FOVId"]))
 
     return df[df["FOVId"].isin(keep_fov_ids)]
 
@@ -108,36 +134,209 @@ def trim_data(df, protein_list=None, n_fovs=100):
 
     ############################################
     # Trim dataset to contain only the given cell lines, with only the set number of FOVs or less
-    # preset cell line IDs are: ER, Fibrillarin (Nucleolus), Golgi, Nucleophosmin (Nucleolus), Alpha Actinin
-    # listing of cell lines by ID can be found at: https://www.allencell.org/cell-catalog.html
+    # The default cell lines are in DEFAULT_PROTEIN_LIST
     ############################################
 
     if protein_list is None:
-        protein_list = [
-            "Sec61 beta",  # er
-            "Fibrillarin",  # nucleolus, DFC
-            "Nucleophosmin",  # nucleolus, GC
-            "Sialyltransferase 1",  # golgi,
-            "Alpha-actinin-1",  # alpha actinin
-            "Non-muscle myosin heavy chain IIB",  # actomyosin bundles
-            "Lamin B1",  # nuclear lamin
-            "Alpha-tubulin",
-        ]
+        protein_list = DEFAULT_PROTEIN_LIST
 
     cell_line_trim = df[df["ProteinDisplayName"].isin(protein_list)]
 
     # cell_line_trim = trim_data_by_cellline(df, cell_line_ids)
+    fov_trim = cell_line_trim
     if n_fovs is not None and n_fovs != -1:
         fov_trim = trim_data_by_cellline_fov_count(cell_line_trim, n_fovs)
 
     return fov_trim
 
 
-def clean_cell_data(cell_data: pd.DataFrame, protein_list=None, n_fovs=100):
-    cell_data = clean_columns(cell_data)
+def shard_data(df, shard_index, n_shards, shard_column="FOVId"):
+    """
+    Deterministically partition a dataframe into `n_shards` disjoint subsets and return one of them. Rows are assigned
+    to shards by the integer value of `shard_column` modulo `n_shards`, so every job that is given the same table and
+    number of shards agrees on the assignment without having to talk to each other.
+
+    Parameters
+    ----------
+    df: pandas.DataFrame
+        Dataframe to partition, usually fov_data
+
+    shard_index: int
+        Which shard to return. Must be in the range [0, n_shards)
+
+    n_shards: int
+        Total number of shards
+
+    shard_column: str
+        Integer column to partition on, e.g. "FOVId" or "PlateId". Partitioning on "PlateId" keeps all of the FOVs
+        from a plate in the same shard.
+
+    Returns
+    -------
+    df: pandas.DataFrame
+        Subset of rows of df that belong to shard `shard_index`
+    """
+
+    if n_shards < 1:
+        raise ValueError(f"n_shards must be >= 1, got {n_shards}")
+
+    if shard_index < 0 or shard_index >= n_shards:
+        raise ValueError(f"shard_index must be in [0, {n_shards}), got {shard_index}")
+
+    shard_inds = df[shard_column].astype(int) % n_shards == shard_index
+
+    return df[shard_inds]
+
+
+def clean_cell_data(
+    cell_data: pd.DataFrame, protein_list=None, n_fovs=100, rng_method="pcg64"
+):
+    cell_data = clean_columns(cell_data, rng_method=rng_method)
 
     cell_data = trim_data(cell_data, protein_list=protein_list, n_fovs=n_fovs)
 
     fov_data = cell_data_to_fov_data(cell_data)
 
     return cell_data, fov_data
+
+
+def set_column_types(df):
+    """
+    Returns a copy of df with the columns in CATEGORICAL_COLUMNS, the image path columns, and text columns with at
+    least two rows per value on average as categoricals, which is how they are stored by save_table
+    """
+
+    df = df.copy()
+
+    for column in df.columns:
+        if column in CATEGORICAL_COLUMNS or "ReadPath" in column:
+            df[column] = df[column].astype("category")
+        elif df[column].dtype == object and df[column].nunique() <= df.shape[0] // 2:
+            df[column] = df[column].astype("category")
+
+    return df
+
+
+def save_table(df, save_path):
+    # Saves a cell or FOV table as Parquet, which keeps the column types and the index
+    set_column_types(df).to_parquet(save_path)
+
+
+def load_table(load_path):
+    df = pd.read_parquet(load_path)
+
+    # a subset of a table keeps the categories of the whole table
+    for column in df.select_dtypes("category").columns:
+        df[column] = df[column].cat.remove_unused_categories()
+
+    return df
+
+
+def convert_csv_tables(save_dir, names=("fov_data", "cell_data")):
+    """
+    Converts the tables in save_dir that were saved as CSV (before they were saved with save_table) to Parquet, once,
+    so that they don't have to be retrieved again. The CSVs are kept. The cell table is written last, since
+    wrappers.save_load_data takes its existence to mean that both tables are there.
+    """
+
+    csv_paths = [f"{save_dir}/{name}.csv" for name in names]
+    if not all(os.path.exists(csv_path) for csv_path in csv_paths):
+        return
+
+    for name, csv_path in zip(names, csv_paths):
+        save_table(pd.read_csv(csv_path, index_col=0), f"{save_dir}/{name}.parquet")
+
+    warnings.warn(f"Converted the CSV tables in {save_dir} to Parquet.")
+
+
+def get_fov_fingerprints(cell_data, stat_images=True):
+    """
+    Returns a fingerprint of the source data of each FOV, which changes if anything about the FOV changes upstream
+
+    Parameters
+    ----------
+    cell_data: pandas.DataFrame
+        Dataframe where each row corresponds to a single cell
+
+    stat_images: bool
+        include the size and modification time of each FOV's image (SourceReadPath), so images that are replaced
+        under the same name count as changed
+
+    Returns
+    -------
+    fingerprints: pandas.Series
+        uint64 fingerprint of each FOV, indexed by FOVId
+    """
+
+    # the random numbers and any earlier fingerprint are derived from the other columns
+    columns = sorted(
+        column
+        for column in cell_data.columns
+        if not column.endswith("_rng") and column != FINGERPRINT_COLUMN
+    )
+
+    # hashes of the rows of each FOV are summed (mod 2**64), so the order of the cells doesn't matter
+    row_hashes = pd.util.hash_pandas_object(cell_data[columns], index=False).values
+
+    fov_ids = cell_data["FOVId"].values
+    order = np.argsort(fov_ids, kind="stable")
+    fov_ids = fov_ids[order]
+    starts = np.flatnonzero(np.r_[True, fov_ids[1:] != fov_ids[:-1]])
+
+    fingerprints = np.add.reduceat(row_hashes[order], starts)
+
+    if stat_images:
+        image_paths = cell_data["SourceReadPath"].values[order][starts]
+
+        image_stats = list()
+        for image_path in image_paths:
+            try:
+                image_stat = os.stat(image_path)
+                image_stats.append((image_stat.st_size, image_stat.st_mtime_ns))
+            except OSError:
+                image_stats.append((-1, -1))
+
+        fingerprints += pd.util.hash_pandas_object(
+            pd.DataFrame(image_stats, columns=["size", "mtime"]), index=False
+        ).values
+
+    return pd.Series(fingerprints, index=pd.Index(fov_ids[starts], name="FOVId"))
+
+
+def add_fov_fingerprints(fov_data, cell_data, stat_images=True):
+    # Returns a copy of fov_data with the fingerprint of each FOV in FINGERPRINT_COLUMN
+
+    fingerprints = get_fov_fingerprints(cell_data, stat_images=stat_images)
+
+    fov_data = fov_data.copy()
+    fov_data[FINGERPRINT_COLUMN] = fingerprints[fov_data["FOVId"]].values
+
+    return fov_data
+
+
+def diff_fov_data(old_fov_data, new_fov_data):
+    """
+    Compares two versions of fov_data by FOVId and FINGERPRINT_COLUMN
+
+    Returns
+    -------
+    changes: dict
+        lists of the FOVIds that are "new" (only in new_fov_data), "changed" (in both, with different fingerprints)
+        and "removed" (only in old_fov_data)
+    """
+
+    old_fingerprints = old_fov_data.set_index("FOVId")[FINGERPRINT_COLUMN]
+    new_fingerprints = new_fov_data.set_index("FOVId")[FINGERPRINT_COLUMN]
+
+    common_ids = new_fingerprints.index.intersection(old_fingerprints.index)
+    changed = new_fingerprints[common_ids].values != old_fingerprints[common_ids].values
+
+    return {
+        "new": sorted(
+            int(i) for i in new_fingerprints.index.difference(old_fingerprints.index)
+        ),
+        "changed": sorted(int(i) for i in common_ids[changed]),
+        "removed": sorted(
+            int(i) for i in old_fingerprints.index.difference(new_fingerprints.index)
+        ),
+    }
@@ -0,0 +1,140 @@
+"""
+failures.py: Timeouts, retries and quarantine records for per-FOV processing, so that one bad FOV doesn't take down
+the rest of the run.
+"""
+
+import errno
+import json
+import threading
+import time
+import traceback
+
+import pandas as pd
+
+from . import filesystem
+
+# Errors that are worth trying again, e.g. network hiccups on a mounted filesystem, see is_transient_error. Other
+# OSErrors (e.g. a missing file or a permission error) and anything else (e.g. a corrupt image) fail the same way every
+# time.
+TRANSIENT_ERRORS = (TimeoutError, ConnectionError)
+TRANSIENT_ERRNOS = (errno.EIO, errno.ESTALE, errno.ETIMEDOUT, errno.EAGAIN)
+
+# Running out of memory, disk space or file handles isn't the fault of the FOV, so it shouldn't be quarantined, see
+# is_resource_error
+RESOURCE_ERRNOS = (errno.ENOMEM, errno.ENOSPC, errno.EMFILE, errno.ENFILE)
+
+
+def is_resource_error(exception):
+    return isinstance(exception, MemoryError) or (
+        isinstance(exception, OSError) and exception.errno in RESOURCE_ERRNOS
+    )
+
+
+def is_transient_error(exception, transient_errors=TRANSIENT_ERRORS):
+    return isinstance(exception, transient_errors) or (
+        isinstance(exception, OSError) and exception.errno in TRANSIENT_ERRNOS
+    )
+
+
+def run_with_timeout(fn, timeout, *args, abandoned=None, **kwargs):
+    """
+    Runs fn(*args, **kwargs) and raises a TimeoutError if it takes longer than timeout seconds.
+
+    Python can't kill a thread that is stuck in a read, so on a timeout the call is left to finish (or not) in a
+    daemon thread and its result is thrown away. The thread is appended to the list abandoned, if it is given, e.g. to
+    hold on to its memory until it finishes (see memory.MemoryBudget.reserve).
+    """
+
+    if timeout is None:
+        return fn(*args, **kwargs)
+
+    result = dict()
+
+    def target():
+        try:
+            result["value"] = fn(*args, **kwargs)
+        except BaseException as e:
+            result["error"] = e
+
+    thread = threading.Thread(target=target, daemon=True)
+    thread.start()
+    thread.join(timeout)
+
+    if thread.is_alive():
+        if abandoned is not None:
+            abandoned.append(thread)
+
+        raise TimeoutError(f"{fn.__name__} did not finish within {timeout} seconds")
+
+    if "error" in result:
+        raise result["error"]
+
+    return result["value"]
+
+
+def call_with_retries(
+    fn,
+    *args,
+    timeout=None,
+    max_retries=0,
+    retry_delay=1,
+    transient_errors=TRANSIENT_ERRORS,
+    abandoned=None,
+    **kwargs,
+):
+    """
+    Calls fn(*args, **kwargs), and tries again up to max_retries times if it raises one of transient_errors (or an
+    OSError with one of TRANSIENT_ERRNOS) or takes longer than timeout seconds. The delay between attempts starts at
+    retry_delay seconds and doubles every attempt. Anything else is raised immediately. The threads of the attempts
+    that timed out are appended to abandoned, see run_with_timeout.
+    """
+
+    for attempt in range(max_retries + 1):
+        try:
+            return run_with_timeout(fn, timeout, *args, abandoned=abandoned, **kwargs)
+        except Exception as e:
+            if attempt == max_retries or not is_transient_error(e, transient_errors):
+                raise
+
+            time.sleep(retry_delay * 2 ** attempt)
+
+
+def save_failure(failure_path, fov_id, exception):
+    # Writes a record of why an FOV failed, which also marks it as quarantined
+    failure = {
+        "FOVId": int(fov_id),
+        "exception": type(exception).__name__,
+        "message": str(exception),
+        "traceback": "".join(
+            traceback.format_exception(
+                type(exception), exception, exception.__traceback__
+            )
+        ),
+        "time": time.strftime("%Y-%m-%d %H:%M:%S"),
+    }
+
+    with open(failure_path, "w") as f:
+        json.dump(failure, f, indent=2)
+
+    return failure
+
+
+def load_failure(failure_path):
+    with open(failure_path, "r") as f:
+        return json.load(f)
+
+
+def load_failures(failure_paths):
+    """
+    Returns a dataframe of the failure records that exist in failure_paths, with one row per quarantined FOV.
+    """
+
+    failures = [
+        load_failure(failure_path)
+        for failure_path in failure_paths
+        if filesystem.file_index.exists(failure_path)
+    ]
+
+    return pd.DataFrame(
+        failures, columns=["FOVId", "exception", "message", "traceback", "time"]
+    )
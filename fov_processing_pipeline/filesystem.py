@@ -0,0 +1,166 @@
+"""
+filesystem.py: Existence checks from directory listings.
+
+On network filesystems (NFS/SMB), every os.path.exists or os.makedirs is a round trip to the server, and the pipeline
+makes several per FOV. Instead, each directory is listed once with os.scandir, and later checks of files in that
+directory are looked up in the listing. The listings are kept up to date as the pipeline writes and deletes files
+through add() and discard().
+
+The listings are per process, and files that are written by other processes (e.g. other Dask workers, or the
+processes that render plots) after a directory was listed are not seen until it is listed again. A Dask worker lives
+for many tasks and runs, so the per-FOV tasks call start_run() with the ID of their run, which forgets the listings of
+an earlier run once, and the FOVs of a run share the listings of their plate directories. The steps that read files
+that other processes wrote during the run (e.g. the digests of wrappers.im2diagnostics) call invalidate() on their
+directories first.
+
+Only the names are cached. The size and modification time of a file (stat()) are always read from the filesystem,
+since a file can be rewritten without its name changing.
+"""
+
+import os
+import threading
+
+
+class FileIndex:
+    """
+    Thread-safe cache of the names of the files in directories, each listed with a single os.scandir
+    """
+
+    def __init__(self):
+        # directory -> set of names, or None if the directory doesn't exist
+        self._listings = dict()
+        self._lock = threading.Lock()
+        self._run_id = None
+
+    def _listing(self, directory):
+        directory = os.path.abspath(directory)
+
+        with self._lock:
+            if directory in self._listings:
+                return self._listings[directory]
+
+        try:
+            with os.scandir(directory) as entries:
+                listing = {entry.name for entry in entries}
+        except (FileNotFoundError, NotADirectoryError):
+            listing = None
+
+        with self._lock:
+            # another thread could have listed it or added files to it in the meantime
+            return self._listings.setdefault(directory, listing)
+
+    def listdir(self, directory):
+        # names of the files in directory, or an empty list if it doesn't exist
+        listing = self._listing(directory)
+
+        return list() if listing is None else list(listing)
+
+    def exists(self, path):
+        directory, name = os.path.split(os.path.abspath(path))
+
+        listing = self._listing(directory)
+
+        return listing is not None and name in listing
+
+    def isdir(self, directory):
+        return self._listing(directory) is not None
+
+    def stat(self, path):
+        """
+        Returns the os.stat_result of a file, or None if it doesn't exist. Files that aren't in the listing aren't
+        stat'ed, but the stat of the ones that are is not cached, since the file could have been rewritten since.
+        """
+
+        if not self.exists(path):
+            return None
+
+        try:
+            return os.stat(path)
+        except FileNotFoundError:
+            # deleted by another process since the directory was listed
+            self.discard(path)
+            return None
+
+    def getsize(self, path):
+        # size of a file in bytes, or None if it doesn't exist
+        stat_result = self.stat(path)
+
+        return None if stat_result is None else stat_result.st_size
+
+    def getmtime_ns(self, path):
+        # modification time of a file in nanoseconds, or None if it doesn't exist
+        stat_result = self.stat(path)
+
+        return None if stat_result is None else stat_result.st_mtime_ns
+
+    def makedirs(self, directory):
+        # creates directory (and its parents) unless it is known to exist
+        if self.isdir(directory):
+            return
+
+        os.makedirs(directory, exist_ok=True)
+
+        # another thread could have made it and added files to it in the meantime
+        directory = os.path.abspath(directory)
+        with self._lock:
+            if self._listings.get(directory) is None:
+                self._listings[directory] = set()
+
+    def add(self, path):
+        # records that a file was written. Directories that haven't been listed yet are listed when they are used.
+        directory, name = os.path.split(os.path.abspath(path))
+
+        with self._lock:
+            listing = self._listings.get(directory)
+            if directory in self._listings and listing is None:
+                listing = self._listings[directory] = set()
+
+            if listing is not None:
+                listing.add(name)
+
+    def discard(self, path):
+        # records that a file was deleted
+        directory, name = os.path.split(os.path.abspath(path))
+
+        with self._lock:
+            listing = self._listings.get(directory)
+            if listing is not None:
+                listing.discard(name)
+
+    def remove(self, path):
+        # deletes a file if it exists
+        if not self.exists(path):
+            return
+
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+        self.discard(path)
+
+    def invalidate(self, directory=None):
+        # forgets the listings of directory and the directories in it (or of every directory), so they are listed
+        # again when they are next used
+        with self._lock:
+            if directory is None:
+                self._listings.clear()
+                return
+
+            directory = os.path.abspath(directory)
+            for listed in list(self._listings.keys()):
+                if listed == directory or listed.startswith(directory + os.sep):
+                    del self._listings[listed]
+
+    def start_run(self, run_id):
+        # forgets every listing the first time run_id is seen, so that each directory is listed once per run
+        with self._lock:
+            if run_id == self._run_id:
+                return
+
+            self._run_id = run_id
+            self._listings.clear()
+
+
+# The index of this process
+file_index = FileIndex()
@@ -0,0 +1,208 @@
+"""
+memory.py: Estimates how much memory it takes to process an FOV, and limits how many FOVs are processed at once.
+
+Estimates are made from the image header (dims and dtype) so that no pixels have to be decoded.
+"""
+
+import threading
+from contextlib import contextmanager
+
+import numpy as np
+import tifffile
+
+# Number of channels that wrappers.row2im keeps
+N_PROCESSED_CHANNELS = 4
+
+# Fudge factor for everything we don't account for (stats, projections, interpreter overhead, etc)
+OVERHEAD_FACTOR = 1.25
+
+# Name of the Dask worker resource that tasks are annotated with, see:
+# https://distributed.dask.org/en/latest/resources.html
+RESOURCE_NAME = "MEMORY"
+
+
+def read_image_header(image_path):
+    """
+    Reads the dimensions and dtype of an image without decoding any pixels
+
+    Parameters
+    ----------
+    image_path: str
+        path to a (OME-)TIFF image
+
+    Returns
+    -------
+    dims: dict
+        Dictionary of dimension name (e.g. "C", "Z", "Y", "X") to size
+
+    dtype: np.dtype
+        pixel type of the image
+    """
+
+    with tifffile.TiffFile(image_path) as tif:
+        series = tif.series[0]
+        dims = dict(zip(series.axes, series.shape))
+        dtype = np.dtype(series.dtype)
+
+    return dims, dtype
+
+
+def estimate_fov_memory(image_path, n_channels=N_PROCESSED_CHANNELS):
+    """
+    Estimates the peak number of bytes used by wrappers.process_fov_row for an image.
+
+    At the peak we hold the full multi-channel image from disk and the reordered copy of the processed channels, and
+    then a copy of the channels for the projections.
+
+    Parameters
+    ----------
+    image_path: str
+        path to the source image of an FOV
+
+    n_channels: int
+        number of channels that are processed
+
+    Returns
+    -------
+    n_bytes: int
+        estimated peak memory in bytes
+    """
+
+    dims, dtype = read_image_header(image_path)
+
+    image_bytes = np.prod(list(dims.values()), dtype=np.int64) * dtype.itemsize
+    channel_bytes = image_bytes // dims.get("C", 1)
+
+    n_bytes = image_bytes + 2 * n_channels * channel_bytes
+
+    return int(n_bytes * OVERHEAD_FACTOR)
+
+
+def get_memory_classes(worker_memory, n_classes=4):
+    """
+    Returns memory classes that evenly divide the memory of a worker, i.e. [worker_memory/8, ..., worker_memory/2,
+    worker_memory] for n_classes=4.
+    """
+
+    return [int(worker_memory / 2 ** i) for i in reversed(range(n_classes))]
+
+
+def get_memory_class(n_bytes, memory_classes):
+    """
+    Returns the smallest memory class that is at least n_bytes. Anything bigger than the largest class is assigned the
+    largest class, so that it runs alone on a worker rather than never being scheduled.
+    """
+
+    for memory_class in sorted(memory_classes):
+        if n_bytes <= memory_class:
+            return memory_class
+
+    return max(memory_classes)
+
+
+class Reservation:
+    """
+    Bytes of a MemoryBudget that are held until they are released, see MemoryBudget.reserve
+    """
+
+    def __init__(self, budget, n_bytes):
+        self.budget = budget
+        self.n_bytes = n_bytes
+        self._lock = threading.Lock()
+
+    def release(self):
+        with self._lock:
+            n_bytes, self.n_bytes = self.n_bytes, 0
+
+        self.budget._release(n_bytes)
+
+    def split(self, n_bytes):
+        # moves up to n_bytes of this reservation into a new one, e.g. to hold on to the memory of results that are
+        # still being written after the rest is released
+        with self._lock:
+            n_bytes = min(n_bytes, self.n_bytes)
+            self.n_bytes -= n_bytes
+
+        return Reservation(self.budget, n_bytes)
+
+    def release_after(self, threads):
+        # releases the bytes once all of threads have finished, without waiting for them
+        threads = [thread for thread in threads if thread.is_alive()]
+
+        if len(threads) == 0:
+            self.release()
+            return
+
+        def wait_and_release():
+            for thread in threads:
+                thread.join()
+
+            self.release()
+
+        threading.Thread(
+            target=wait_and_release, daemon=True, name="memory_release"
+        ).start()
+
+
+class MemoryBudget:
+    """
+    Limits the total estimated memory of the FOVs that are being processed at the same time within a process.
+    Anything that needs more than the whole budget is run by itself.
+
+    Parameters
+    ----------
+    n_bytes: int or None
+        Size of the budget in bytes. If None, there is no limit.
+    """
+
+    def __init__(self, n_bytes=None):
+        self.n_bytes = n_bytes
+        self.n_bytes_used = 0
+        self._condition = threading.Condition()
+
+    def _acquire(self, n_bytes):
+        # blocks until n_bytes are available and takes them. Returns the number of bytes taken.
+        if self.n_bytes is None or n_bytes is None:
+            return 0
+
+        n_bytes = min(n_bytes, self.n_bytes)
+
+        with self._condition:
+            self._condition.wait_for(
+                lambda: self.n_bytes_used + n_bytes <= self.n_bytes
+            )
+            self.n_bytes_used += n_bytes
+
+        return n_bytes
+
+    def _release(self, n_bytes):
+        if n_bytes == 0:
+            return
+
+        with self._condition:
+            self.n_bytes_used -= n_bytes
+            self._condition.notify_all()
+
+    @contextmanager
+    def reserve(self, n_bytes, hold_for=None):
+        """
+        Blocks until n_bytes are available, and holds on to them for the duration of the context.
+
+        hold_for is a list of threads (that can be added to in the context) that use the memory too, e.g. image loads
+        that were abandoned after a timeout but are still running. The bytes are held until they have finished.
+        """
+
+        reservation = Reservation(self, self._acquire(n_bytes))
+
+        try:
+            yield reservation
+        finally:
+            reservation.release_after(hold_for or list())
+
+
+# The budget that is shared between all of the threads of this process
+memory_budget = MemoryBudget()
+
+
+def set_memory_budget(n_bytes):
+    memory_budget.n_bytes = n_bytes
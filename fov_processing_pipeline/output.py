@@ -0,0 +1,188 @@
+"""
+output.py: Writes results (stats pickles, projection PNGs) in background threads, so that encoding and writing them
+overlaps with the processing of the next FOV.
+
+Every file is written to a temporary file in the same directory and renamed when it is complete, so a result that
+exists is never half-written. The results that are waiting to be written are limited by a byte budget: when it is
+used up, submit() blocks until enough has been written.
+"""
+
+import os
+import pickle
+import threading
+import uuid
+from concurrent.futures import ThreadPoolExecutor, wait
+
+from . import filesystem, profiling
+
+# Defaults for the writer of this process
+N_WRITER_THREADS = 2
+MAX_QUEUED_BYTES = 2 ** 30
+
+
+def write_pickle(path, obj):
+    with open(path, "wb") as f:
+        pickle.dump(obj, f)
+
+
+def write_png(path, im):
+    from aicsimageio import writers
+
+    with writers.PngWriter(path, overwrite_file=True) as writer:
+        writer.save(im)
+
+
+def atomic_write(path, write_fn, obj):
+    # writes obj to path with write_fn(path, obj), via a temporary file that keeps the extension of path
+    directory, name = os.path.split(path)
+    tmp_path = os.path.join(directory, f".tmp_{uuid.uuid4().hex[:8]}_{name}")
+
+    try:
+        write_fn(tmp_path, obj)
+        os.replace(tmp_path, path)
+    except BaseException:
+        try:
+            os.remove(tmp_path)
+        except FileNotFoundError:
+            pass
+
+        raise
+
+    filesystem.file_index.add(path)
+
+
+class OutputWriter:
+    """
+    Pool of threads that write groups of files. The files of a group are written in order, and if one of them fails,
+    the ones that were already written are removed again.
+
+    Parameters
+    ----------
+    n_workers: int
+        number of groups that are written at the same time
+
+    max_bytes: int or None
+        budget for the size of the objects that are waiting to be written. If None, there is no limit.
+    """
+
+    def __init__(self, n_workers=N_WRITER_THREADS, max_bytes=MAX_QUEUED_BYTES):
+        self.n_workers = n_workers
+        self.max_bytes = max_bytes
+        self.n_bytes_queued = 0
+
+        self._condition = threading.Condition()
+        self._futures = set()
+        self._executor = None
+        self._pid = None
+
+    def _get_executor(self):
+        # the threads don't survive a fork (e.g. into a Dask worker process), so each process starts its own
+        with self._condition:
+            if self._executor is None or self._pid != os.getpid():
+                self._executor = ThreadPoolExecutor(
+                    max_workers=self.n_workers, thread_name_prefix="output_writer"
+                )
+                self._futures = set()
+                self._pid = os.getpid()
+
+            return self._executor
+
+    def submit(self, files, n_bytes=0, on_error=None, records=None, **info):
+        """
+        Queues a group of files to be written. Blocks while the queued objects are over the byte budget.
+
+        Parameters
+        ----------
+        files: list of tuples
+            (stage, path, write_fn, obj) of each file, see atomic_write. stage is the name of its timing record.
+
+        n_bytes: int
+            size of the objects, for the budget
+
+        on_error: callable or None
+            called with the exception if a file fails to be written. If None, the exception is raised by the future
+            (and by flush).
+
+        records: list or None
+            list to append the timing record of each file to, see profiling.measure. If None, they aren't kept.
+
+        **info:
+            extra fields for the timing records, e.g. FOVId=1234
+
+        Returns
+        -------
+        future: concurrent.futures.Future
+        """
+
+        executor = self._get_executor()
+
+        if records is None:
+            records = list()
+
+        with self._condition:
+            if self.max_bytes is not None:
+                # anything that needs more than the whole budget is written by itself
+                self._condition.wait_for(
+                    lambda: self.n_bytes_queued == 0
+                    or self.n_bytes_queued + n_bytes <= self.max_bytes
+                )
+            self.n_bytes_queued += n_bytes
+
+        future = executor.submit(self._write, files, n_bytes, on_error, records, info)
+
+        with self._condition:
+            self._futures.add(future)
+
+        future.add_done_callback(self._done)
+
+        return future
+
+    def _done(self, future):
+        # failed groups are kept until flush() raises their exception
+        if future.exception() is None:
+            with self._condition:
+                self._futures.discard(future)
+
+    def _write(self, files, n_bytes, on_error, records, info):
+        written = list()
+
+        try:
+            for stage, path, write_fn, obj in files:
+                with profiling.measure(stage, records, **info):
+                    atomic_write(path, write_fn, obj)
+
+                written.append(path)
+
+        except Exception as e:
+            for path in written:
+                filesystem.file_index.remove(path)
+
+            if on_error is None:
+                raise
+
+            on_error(e)
+
+        finally:
+            with self._condition:
+                self.n_bytes_queued -= n_bytes
+                self._condition.notify_all()
+
+    def flush(self):
+        """
+        Waits until everything that was submitted in this process is written, and raises the first exception of a
+        group that failed without an on_error
+        """
+
+        with self._condition:
+            futures = list(self._futures)
+            self._futures.difference_update(futures)
+
+        wait(futures)
+
+        for future in futures:
+            if future.exception() is not None:
+                raise future.exception()
+
+
+# The writer that is shared between all of the threads of this process
+output_writer = OutputWriter()
@@ -25,13 +25,15 @@ def fov_qc(df):
     return df[df["QC"]]
 
 
-def zsize_qc(df):
+def zsize_qc(df, set_size=None):
     """
     Given a stats dataframe, use interpolation to make sure all zslice data has the same number of z measurements
     Parameters
     ----------
     df: Dataframe
         Stats dataframe, with rows corresponding to FOVs and a column for the mean DNA intensity, for each zslice
+    set_size: int or None
+        number of z measurements to interpolate to. The median number of z slices of df if None.
     Returns
     -------
     df: Dataframe
@@ -39,8 +41,9 @@ def zsize_qc(df):
     """
 
     # get median number of z slices
-    z_sizes = [len(df.iloc[i]["Ch0_mean_by_z"]) for i in range(df.shape[0])]
-    set_size = int(np.median(z_sizes))
+    if set_size is None:
+        z_sizes = [len(df.iloc[i]["Ch0_mean_by_z"]) for i in range(df.shape[0])]
+        set_size = int(np.median(z_sizes))
 
     # cycle through channels to make a new list of values for each channel
     for ch in range(4):
@@ -0,0 +1,305 @@
+"""
+profiling.py: Timing and memory instrumentation for pipeline stages, and the run performance report.
+
+Each measurement is a record (dictionary) of the stage name, any extra info (e.g. the FOVId), and:
+    - wall_time: seconds
+    - cpu_time: seconds of CPU time used by this process
+    - read_bytes, write_bytes: bytes read and written by this process (Linux only, NaN elsewhere)
+    - peak_rss: peak resident memory of this process so far, in bytes (NaN on Windows)
+    - tracemalloc_peak: peak traced memory during the stage in bytes, if tracemalloc is running (NaN otherwise)
+
+CPU time and I/O are counted for the whole process, so stages running at the same time on different threads will
+count each other's work.
+
+The records of a Prefect task get back to the flow runner, even if the task ran in another process (e.g. on a Dask
+worker), in the context of its final state: the task sets them with set_task_records, and the attach_records state
+handler moves them to the state, see get_state_records.
+"""
+
+import functools
+import json
+import os
+import sys
+import threading
+import time
+import tracemalloc
+from contextlib import contextmanager
+
+import numpy as np
+import pandas as pd
+
+try:
+    import resource
+except ImportError:
+    # Windows
+    resource = None
+
+METRICS = [
+    "wall_time",
+    "cpu_time",
+    "read_bytes",
+    "write_bytes",
+    "peak_rss",
+    "tracemalloc_peak",
+]
+
+PERCENTILES = [50, 90, 99]
+
+# Key of the records in the context of a task's state, see attach_records
+RECORDS_CONTEXT_KEY = "profiling_records"
+
+# The records of the task that is running in each thread
+_task_records = threading.local()
+
+
+def _io_counters():
+    # characters read and written by this process, including network filesystems
+    try:
+        with open("/proc/self/io", "r") as f:
+            counters = dict(line.split(": ") for line in f.read().splitlines())
+        return int(counters["rchar"]), int(counters["wchar"])
+    except (OSError, KeyError, ValueError):
+        return np.nan, np.nan
+
+
+def _peak_rss():
+    if resource is None:
+        return np.nan
+
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    # kilobytes on Linux, bytes on macOS
+    if sys.platform != "darwin":
+        peak_rss = peak_rss * 1024
+
+    return peak_rss
+
+
+@contextmanager
+def measure(stage, records, **info):
+    """
+    Measures the code in the context and appends a record of it to records
+
+    Parameters
+    ----------
+    stage: str
+        name of the stage
+
+    records: list
+        list to append the record to
+
+    **info:
+        extra fields for the record, e.g. FOVId=1234
+
+    """
+
+    tracing = tracemalloc.is_tracing()
+    if tracing and hasattr(tracemalloc, "reset_peak"):
+        tracemalloc.reset_peak()
+
+    read_start, write_start = _io_counters()
+    cpu_start = time.process_time()
+    wall_start = time.perf_counter()
+
+    try:
+        yield
+    finally:
+        wall_time = time.perf_counter() - wall_start
+        cpu_time = time.process_time() - cpu_start
+        read_end, write_end = _io_counters()
+
+        record = {"stage": stage}
+        record.update(info)
+        record.update(
+            {
+                "wall_time": wall_time,
+                "cpu_time": cpu_time,
+                "read_bytes": read_end - read_start,
+                "write_bytes": write_end - write_start,
+                "peak_rss": _peak_rss(),
+                "tracemalloc_peak": (
+                    tracemalloc.get_traced_memory()[1] if tracing else np.nan
+                ),
+            }
+        )
+
+        records.append(record)
+
+
+def set_task_records(records):
+    # sets the records of the task that is running in this thread, for attach_records to put in its state
+    _task_records.records = records
+
+
+def pop_task_records():
+    # the records of the task that ran last in this thread (or None), which are then forgotten
+    records = getattr(_task_records, "records", None)
+    _task_records.records = None
+
+    return records
+
+
+def attach_records(task, old_state, new_state):
+    """
+    Prefect state handler that puts the records of a task (see set_task_records) in the context of its final state,
+    which is sent back to the flow runner wherever the task ran
+    """
+
+    if new_state.is_running():
+        # left over from a task that ran in this thread without the handler, e.g. with task.run()
+        pop_task_records()
+
+    elif new_state.is_finished():
+        records = pop_task_records()
+        if records is not None:
+            new_state.context[RECORDS_CONTEXT_KEY] = records
+
+    return new_state
+
+
+def get_state_records(state):
+    # the records that attach_records put in the state of a task, and the states of its mapped children
+    records = list(state.context.get(RECORDS_CONTEXT_KEY, list()))
+
+    for map_state in getattr(state, "map_states", list()):
+        records += get_state_records(map_state)
+
+    return records
+
+
+def profiled(fn):
+    """
+    Decorator that measures every call of fn as a stage with the name of fn. The record is set as the records of the
+    task (see set_task_records), so a Prefect task that is decorated with it needs the attach_records state handler.
+    """
+
+    @functools.wraps(fn)
+    def wrapper(*args, **kwargs):
+        records = list()
+        try:
+            with measure(fn.__name__, records):
+                return fn(*args, **kwargs)
+        finally:
+            set_task_records(records)
+
+    return wrapper
+
+
+def summarize(df_records):
+    """
+    Summarizes the records by stage.
+
+    Returns
+    -------
+    df_summary: pd.DataFrame
+        One row per stage, with the count, total and percentiles of each metric, and the fraction of wall time that was
+        spent on CPU. A low cpu_fraction means the stage was waiting on I/O (or other threads).
+    """
+
+    summary = dict()
+    for stage, df_stage in df_records.groupby("stage", sort=False):
+        summary[stage] = {"count": df_stage.shape[0]}
+
+        for metric in METRICS:
+            values = df_stage[metric].values.astype(float)
+            if np.all(np.isnan(values)):
+                continue
+
+            if metric in ["wall_time", "cpu_time", "read_bytes", "write_bytes"]:
+                summary[stage][f"{metric}_total"] = np.nansum(values)
+
+            for percentile in PERCENTILES:
+                summary[stage][f"{metric}_p{percentile}"] = np.nanpercentile(
+                    values, percentile
+                )
+
+            summary[stage][f"{metric}_max"] = np.nanmax(values)
+
+        summary[stage]["cpu_fraction"] = summary[stage]["cpu_time_total"] / max(
+            summary[stage]["wall_time_total"], 1e-9
+        )
+
+    return pd.DataFrame.from_dict(summary, orient="index")
+
+
+def slowest_fovs(df_records, n=20, id_column="FOVId"):
+    """
+    Returns the n FOVs with the largest total wall time, with their wall time per stage
+    """
+
+    if id_column not in df_records.columns:
+        return pd.DataFrame()
+
+    # the stages that aren't per-FOV have no id
+    df_fovs = df_records[~df_records[id_column].isnull()].copy()
+    df_fovs[id_column] = df_fovs[id_column].astype(int)
+
+    df_fovs = df_fovs.pivot_table(
+        index=id_column, columns="stage", values="wall_time", aggfunc="sum"
+    )
+    df_fovs["total"] = df_fovs.sum(axis=1)
+
+    return df_fovs.sort_values("total", ascending=False).head(n)
+
+
+def save_report(records, save_dir, run_wall_time=None):
+    """
+    Saves the records, a per-stage summary (JSON and HTML) and the slowest FOVs to save_dir
+
+    Parameters
+    ----------
+    records: list of dicts
+        records from measure()
+
+    save_dir: str
+        directory to save the report in
+
+    run_wall_time: float or None
+        wall time of the whole run. For a serial run, the time that isn't accounted for by the stages
+        (run_wall_time - stage_wall_time) is overhead, e.g. scheduling.
+
+    Returns
+    -------
+    report: dict
+        what is saved in performance.json
+    """
+
+    if not os.path.exists(save_dir):
+        os.makedirs(save_dir)
+
+    df_records = pd.DataFrame(records)
+    df_records.to_csv(f"{save_dir}/performance_records.csv")
+
+    if df_records.shape[0] == 0:
+        df_summary = pd.DataFrame()
+        df_slowest = pd.DataFrame()
+    else:
+        df_summary = summarize(df_records)
+        df_slowest = slowest_fovs(df_records)
+
+    report = {
+        "run_wall_time": run_wall_time,
+        "stage_wall_time": (
+            float(df_records["wall_time"].sum()) if df_records.shape[0] > 0 else 0.0
+        ),
+        "stages": json.loads(df_summary.to_json(orient="index")),
+        "slowest_fovs": json.loads(df_slowest.to_json(orient="index")),
+    }
+
+    with open(f"{save_dir}/performance.json", "w") as f:
+        json.dump(report, f, indent=2)
+
+    html = ["<html><head><title>Performance report</title></head><body>"]
+    html.append("<h1>Performance report</h1>")
+    if run_wall_time is not None:
+        html.append(f"<p>Total run wall time: {run_wall_time:.1f} s</p>")
+    html.append("<h2>Stages</h2>")
+    html.append(df_summary.to_html(float_format="{:.3g}".format))
+    html.append("<h2>Slowest FOVs (wall time in s)</h2>")
+    html.append(df_slowest.to_html(float_format="{:.3g}".format))
+    html.append("</body></html>")
+
+    with open(f"{save_dir}/performance.html", "w") as f:
+        f.write("\n".join(html))
+
+    return report
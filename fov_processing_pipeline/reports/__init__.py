@@ -1,2 +1,3 @@
-from .im2bigim import im2bigim  # noqa
+from .im2bigim import im2bigim, get_page_outputs  # noqa
+from .pyramid import im2pyramid, get_pyramid_outputs  # noqa
 from .reports import *  # noqa
@@ -1,85 +1,360 @@
 #!/usr/bin/env python
 
+import json
+import multiprocessing
 import os
+import tempfile
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from contextlib import contextmanager
+
 import numpy as np
 
 from PIL import Image
 from PIL import ImageFont
 from PIL import ImageDraw
 
-from aicsimageio import writers
+from .. import filesystem, thumbnails
+
+FONT_PATH = os.path.dirname(__file__) + "/../../etc/dejavu-sans-mono/DejaVuSansMono.ttf"
+
+
+def read_tile_shape(impath):
+    # (Y, X, C) of an image, from its header
+    with Image.open(impath) as im:
+        return im.size[1], im.size[0], len(im.getbands())
+
+
+def get_page_layouts(n_tiles, nwide, ndeep):
+    """
+    Returns the (first tile, number of tiles, number of rows) of each page of a montage of n_tiles tiles, nwide tiles
+    per row and ndeep rows per page
+    """
+
+    tiles_per_page = nwide * ndeep
+
+    pages = list()
+    for start in range(0, n_tiles, tiles_per_page):
+        n_page_tiles = min(tiles_per_page, n_tiles - start)
+        pages.append((start, n_page_tiles, int(np.ceil(n_page_tiles / nwide))))
+
+    return pages
+
+
+@contextmanager
+def make_canvas(shape, memmap_dir=None):
+    # a zeroed uint8 page, in memory or (if memmap_dir is set) in a temporary file that is removed once it is done with
+    if memmap_dir is None:
+        yield np.zeros(shape, dtype="uint8")
+        return
+
+    fd, canvas_path = tempfile.mkstemp(dir=memmap_dir, suffix=".canvas")
+    try:
+        with os.fdopen(fd, "w+b") as f:
+            canvas = np.memmap(f, dtype="uint8", mode="w+", shape=shape)
+            yield canvas
+
+            del canvas
+    finally:
+        os.remove(canvas_path)
+
+
+def get_tiles(impaths, im_ids, verbose=True):
+    """
+    Returns [path, ID, modification time] of each of the images that exist, and the (Y, X, C) that fits all of them.
+    Sometimes the images come out different sizes, so every tile is the size of the largest image. Whether an image
+    exists is looked up in the listing of its directory, so the caller has to invalidate the listings of images that
+    other processes wrote (see filesystem.py).
+    """
+
+    tiles = list()
+    for proj_path, ind in zip(impaths, im_ids):
+        mtime_ns = filesystem.file_index.getmtime_ns(proj_path)
+        if mtime_ns is None:
+            if verbose:
+                print("Missing: " + proj_path)
+            continue
+
+        tiles.append([str(proj_path), str(ind), mtime_ns])
 
+    if len(tiles) == 0:
+        return tiles, None
 
-def im2bigim(impaths, im_ids, labels, save_parent_dir, nwide=5, ndeep=50, verbose=True):
-    font = ImageFont.truetype(
-        os.path.dirname(__file__) + "/../../etc/dejavu-sans-mono/DejaVuSansMono.ttf", 12
+    tile_shapes = np.array([read_tile_shape(tile[0]) for tile in tiles])
+
+    if verbose:
+        for tile, tile_shape in zip(tiles, tile_shapes):
+            if np.any(tile_shape != tile_shapes[0]):
+                print(tile[0] + " is not the same size as the others...")
+
+    return tiles, [int(size) for size in np.max(tile_shapes, 0)]
+
+
+def read_tile(proj_path, ind, font, factor=1):
+    # an image at 1/factor of its size (see thumbnails.py) as a (Y, X, C) array, with its ID written on it
+    if factor == 1:
+        im_proj = Image.open(proj_path)
+    else:
+        im_proj = thumbnails.read_projection(proj_path, factor)
+        im_proj = Image.fromarray(
+            im_proj[:, :, 0] if im_proj.shape[2] == 1 else im_proj
+        )
+
+    with im_proj:
+        draw = ImageDraw.Draw(im_proj)
+        draw.text((20 // factor, 20 // factor), ind, (255, 255, 255), font=font)
+
+        tile = np.asarray(im_proj)
+
+    if tile.ndim == 2:
+        tile = tile[:, :, np.newaxis]
+
+    return tile
+
+
+def get_label_pages(
+    impaths, im_ids, label, save_parent_dir, nwide, ndeep, verbose, tile_width=None
+):
+    """
+    Lays out the montage pages of a label from the image headers
+
+    Returns
+    -------
+    pages: list of dicts
+        "save_path", "shape" (Y, X, C) of the page, "tile_shape" (Y, X), "factor" the images are shrunk by, "nwide",
+        and "tiles": [path, ID, modification time] of each image on the page, in order
+    """
+
+    tiles, tile_shape = get_tiles(impaths, im_ids, verbose=verbose)
+
+    if len(tiles) == 0:
+        return list()
+
+    tile_y, tile_x, n_channels = tile_shape
+
+    # the smallest thumbnails that are at least tile_width wide
+    factor = thumbnails.get_factor(
+        (tile_y, tile_x), None if tile_width is None else (0, tile_width)
     )
+    tile_y, tile_x = [int(np.ceil(size / factor)) for size in (tile_y, tile_x)]
 
-    labels = np.array([str(label) for label in labels])
+    # rows are only as wide as they need to be if there are fewer than nwide images
+    page_width = min(nwide, len(tiles)) * tile_x
 
-    ulabels, uinds = np.unique(np.array(labels), return_inverse=True)
+    pages = list()
+    for c, (start, n_page_tiles, n_rows) in enumerate(
+        get_page_layouts(len(tiles), nwide, ndeep)
+    ):
+        pages.append(
+            {
+                "save_path": "{}/diagnostics_{}_{}.png".format(
+                    save_parent_dir, str(label), str(c)
+                ),
+                "shape": [n_rows * tile_y, page_width, n_channels],
+                "tile_shape": [tile_y, tile_x],
+                "factor": factor,
+                "nwide": nwide,
+                "tiles": tiles[start : (start + n_page_tiles)],  # noqa
+            }
+        )
 
-    for ulabel in ulabels:
-        if verbose:
-            print("Printing " + str(ulabel))
+    return pages
 
-        label_inds = labels == ulabel
 
-        proj_paths = np.array(impaths)[label_inds]
-        inds = im_ids[label_inds]
+def page_memory(page):
+    # estimated peak bytes of rendering a page: the canvas, and the copy that is handed to the PNG encoder
+    return 2 * int(np.prod(page["shape"]))
 
-        im_list = list()
-        for proj_path, ind in zip(proj_paths, inds):
-            if not os.path.exists(proj_path):
-                if verbose:
-                    print("Missing: " + proj_path)
-                continue
 
-            im_proj = Image.open(proj_path)
-            draw = ImageDraw.Draw(im_proj)
+def render_page(page, memmap_dir=None):
+    """
+    Decodes each image of a page straight into its place on the page, writes its ID on it, and saves the page
+    """
+
+    from aicsimageio import writers
+
+    font = ImageFont.truetype(FONT_PATH, 12)
+
+    tile_y, tile_x = page["tile_shape"]
+
+    with make_canvas(tuple(page["shape"]), memmap_dir=memmap_dir) as canvas:
+        for i, (proj_path, ind, _) in enumerate(page["tiles"]):
+            tile = read_tile(proj_path, ind, font, factor=page["factor"])
+
+            y = (i // page["nwide"]) * tile_y
+            x = (i % page["nwide"]) * tile_x
+            canvas[
+                y : (y + tile.shape[0]),  # noqa
+                x : (x + tile.shape[1]),  # noqa
+                : tile.shape[2],
+            ] = tile
+
+        # PngWriter transposes its input with (2, 1, 0), so this writes the canvas as it is, without a copy
+        with writers.PngWriter(page["save_path"], overwrite_file=True) as writer:
+            writer.save(canvas.transpose([2, 1, 0]))
+
+    return page["save_path"]
+
 
-            draw.text((20, 20), str(ind), (255, 255, 255), font=font)
+def render_pages(pages, n_workers=1, max_bytes=None, memmap_dir=None, verbose=True):
+    """
+    Renders pages, n_workers at the same time in separate processes. Pages are started only while the estimated
+    memory of the pages that are being rendered fits in max_bytes (a page that needs more is rendered by itself).
+    """
 
-            im_proj = np.asarray(im_proj)
+    if n_workers <= 1 or len(pages) <= 1:
+        for page in pages:
+            if verbose:
+                print("Printing " + page["save_path"])
+
+            render_page(page, memmap_dir=memmap_dir)
+            filesystem.file_index.add(page["save_path"])
+
+        return
+
+    # spawn rather than fork, since the parent has threads (e.g. the output writer and Prefect's)
+    executor = ProcessPoolExecutor(
+        max_workers=n_workers, mp_context=multiprocessing.get_context("spawn")
+    )
+
+    with executor:
+        running = dict()
+
+        def wait_for_one():
+            done, _ = wait(running.keys(), return_when=FIRST_COMPLETED)
+            for future in done:
+                running.pop(future)
+                save_path = future.result()
+                filesystem.file_index.add(save_path)
 
-            if len(im_list) > 0 and im_proj.shape != im_list[0].shape:
                 if verbose:
-                    print(proj_path + " is not the same size as the others...")
-                # continue
+                    print("Printed " + save_path)
+
+        # the biggest pages first, so they don't end up alone at the end
+        for page in sorted(pages, key=page_memory, reverse=True):
+            n_bytes = page_memory(page)
+
+            while len(running) > 0 and (
+                len(running) >= n_workers
+                or (
+                    max_bytes is not None
+                    and sum(running.values()) + n_bytes > max_bytes
+                )
+            ):
+                wait_for_one()
 
-            im_list.append(im_proj)
+            running[executor.submit(render_page, page, memmap_dir)] = n_bytes
 
-        #  sometimes the images come out different sizes, so we have to pad them
-        imsizes = [im.shape for im in im_list]
-        imsizes = np.asarray(imsizes)
+        while len(running) > 0:
+            wait_for_one()
 
-        maxsize = np.max(imsizes, 0)
-        padsize = np.subtract(maxsize, imsizes)
 
-        for i in range(0, len(im_list)):
-            pad = padsize[i]
-            im_list[i] = np.pad(
-                im_list[i], ((0, pad[0]), (0, pad[1]), (0, pad[2])), "constant"
-            )
+def get_page_outputs(save_parent_dir, label):
+    # the record and pages that im2bigim made for a label, or an empty list if it hasn't made them
+    record_path = "{}/diagnostics_{}.json".format(save_parent_dir, str(label))
+    if not filesystem.file_index.exists(record_path):
+        return list()
 
-        im_list = [
-            np.hstack(im_list[start : (start + nwide)])  # noqa
-            for start in range(0, len(im_list), nwide)
-        ]
+    with open(record_path, "r") as f:
+        pages = json.load(f)
 
-        pad = im_list[0].shape[1] - im_list[-1].shape[1]
-        im_list[-1] = np.pad(im_list[-1], ((0, 0), (0, pad), (0, 0)), "constant")
+    return [record_path] + [page["save_path"] for page in pages]
 
-        c = 0
-        for i in range(0, len(im_list), ndeep):
-            im_out = np.vstack(im_list[i : (i + ndeep)]).astype("uint8")  # noqa
 
-            im_out = im_out.transpose([2, 1, 0])
+def im2bigim(
+    impaths,
+    im_ids,
+    labels,
+    save_parent_dir,
+    nwide=5,
+    ndeep=50,
+    verbose=True,
+    memmap_dir=None,
+    n_workers=1,
+    max_bytes=None,
+    overwrite=True,
+    tile_width=None,
+):
+    """
+    Makes montages of the images of each label, with the ID of each image written on it, and saves them as
+    f"{save_parent_dir}/diagnostics_{label}_{page}.png" with nwide images per row and ndeep rows per page. Images
+    that are smaller than the largest one are padded on the bottom and right.
 
-            with writers.PngWriter(
-                "{}/diagnostics_{}_{}.png".format(save_parent_dir, str(ulabel), str(c)),
-                overwrite_file=True,
-            ) as writer:
-                writer.save(im_out)
+    The layout is computed from the image headers first, and each image is decoded straight into its place on the
+    page, so only one page (and one image) per worker is in memory at a time. If memmap_dir is set, the page is kept
+    in a memory mapped temporary file there instead.
+
+    Parameters
+    ----------
+    n_workers: int
+        number of pages to render at the same time, in separate processes
+
+    max_bytes: int or None
+        limit on the estimated memory of the pages that are rendered at the same time
+
+    overwrite: bool
+        if False, pages are only rendered if they don't exist or their images changed since they were rendered. The
+        images on each page are recorded in f"{save_parent_dir}/diagnostics_{label}.json".
+
+    tile_width: int or None
+        if set, the images are shown at the smallest of their thumbnail levels (see thumbnails.py) that is at least
+        this many pixels wide, instead of at full resolution
+    """
+
+    impaths = np.array(impaths)
+    im_ids = np.array(im_ids)
+    labels = np.array([str(label) for label in labels])
+
+    todo = list()
+    records = dict()
+
+    for ulabel in np.unique(labels):
+        label_inds = labels == ulabel
+
+        pages = get_label_pages(
+            impaths[label_inds],
+            im_ids[label_inds],
+            ulabel,
+            save_parent_dir,
+            nwide,
+            ndeep,
+            verbose,
+            tile_width=tile_width,
+        )
+
+        record_path = "{}/diagnostics_{}.json".format(save_parent_dir, str(ulabel))
+        previous_pages = list()
+        if filesystem.file_index.exists(record_path):
+            with open(record_path, "r") as f:
+                previous_pages = json.load(f)
+
+        for c, page in enumerate(pages):
+            unchanged = c < len(previous_pages) and previous_pages[c] == page
+
+            if (
+                overwrite
+                or not unchanged
+                or not filesystem.file_index.exists(page["save_path"])
+            ):
+                todo.append(page)
+            elif verbose:
+                print("Skipping " + page["save_path"])
+
+        # pages from before the label had fewer images
+        for previous_page in previous_pages[len(pages) :]:  # noqa
+            filesystem.file_index.remove(previous_page["save_path"])
+
+        records[record_path] = pages
+
+    render_pages(
+        todo,
+        n_workers=n_workers,
+        max_bytes=max_bytes,
+        memmap_dir=memmap_dir,
+        verbose=verbose,
+    )
 
-            c += 1
+    # only recorded once the pages are written, so an interrupted run renders them again
+    for record_path, pages in records.items():
+        with open(record_path, "w") as f:
+            json.dump(pages, f)
+        filesystem.file_index.add(record_path)
@@ -0,0 +1,595 @@
+"""
+pyramid.py: Zoomable diagnostic montages.
+
+Instead of pages, all of the projections of a label are laid out in one montage that is saved as a Deep Zoom image
+pyramid: f"{label}.dzi" describes it, and f"{label}_files/{level}/{column}_{row}.png" are its tiles. The highest level
+is the montage at full resolution, and each level below it is half the size of the one above, down to a single
+pixel. The full resolution tiles are rendered a strip at a time straight from the projections, and every lower level
+is built from the tiles of the level above it, so the whole montage is never in memory.
+
+index.html is a viewer for the montages of all labels that needs nothing but a browser (other Deep Zoom viewers,
+e.g. OpenSeadragon, can open the .dzi files too).
+"""
+
+import json
+import multiprocessing
+import os
+import shutil
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+from PIL import Image
+from PIL import ImageFont
+
+from .. import filesystem, utils
+from .im2bigim import FONT_PATH, get_tiles, read_tile
+
+TILE_SIZE = 256
+
+# full resolution tiles are rendered in strips of this many rows of tiles
+STRIP_TILES = 4
+
+DZI_TEMPLATE = """<?xml version="1.0" encoding="UTF-8"?>
+<Image xmlns="http://schemas.microsoft.com/deepzoom/2008" Format="{format}" Overlap="0" TileSize="{tile_size}">
+  <Size Width="{width}" Height="{height}"/>
+</Image>
+"""
+
+VIEWER_TEMPLATE = """<html>
+<head>
+<title>Diagnostics</title>
+<style>
+  body {{ margin: 0; background: #000; color: #fff; font-family: monospace; overflow: hidden; }}
+  #controls {{ position: absolute; top: 8px; left: 8px; z-index: 1; }}
+  #view {{ display: block; cursor: grab; }}
+</style>
+</head>
+<body>
+<div id="controls"><select id="label"></select> scroll to zoom, drag to pan, double click to fit</div>
+<canvas id="view"></canvas>
+<script>
+const PYRAMIDS = {pyramids};
+
+const canvas = document.getElementById("view");
+const context = canvas.getContext("2d");
+const select = document.getElementById("label");
+
+let pyramid = null;
+let scale = 1;
+let offset = [0, 0];
+let cache = new Map();
+
+for (const label of Object.keys(PYRAMIDS)) {{
+  const option = document.createElement("option");
+  option.value = label;
+  option.text = label + " (" + PYRAMIDS[label].n_images + ")";
+  select.add(option);
+}}
+
+function fit() {{
+  scale = Math.min(canvas.width / pyramid.width, canvas.height / pyramid.height);
+  offset = [0, 0];
+}}
+
+function getTile(level, column, row) {{
+  const src = encodeURIComponent(pyramid.files) + "/" + level + "/" + column + "_" + row + "." + pyramid.format;
+  if (!cache.has(src)) {{
+    const image = new Image();
+    image.onload = draw;
+    image.src = src;
+    cache.set(src, image);
+  }}
+  return cache.get(src);
+}}
+
+function drawLevel(level) {{
+  // montage pixels per pixel of this level
+  const factor = Math.pow(2, pyramid.max_level - level);
+  const levelWidth = Math.ceil(pyramid.width / factor);
+  const levelHeight = Math.ceil(pyramid.height / factor);
+  const span = pyramid.tile_size * factor;
+
+  // the tiles that are on the screen
+  const columns = [Math.max(0, Math.floor(offset[0] / span)),
+                   Math.min(Math.ceil(levelWidth / pyramid.tile_size),
+                            Math.ceil((offset[0] + canvas.width / scale) / span))];
+  const rows = [Math.max(0, Math.floor(offset[1] / span)),
+                Math.min(Math.ceil(levelHeight / pyramid.tile_size),
+                         Math.ceil((offset[1] + canvas.height / scale) / span))];
+
+  for (let row = rows[0]; row < rows[1]; row++) {{
+    for (let column = columns[0]; column < columns[1]; column++) {{
+      const image = getTile(level, column, row);
+      if (image.complete && image.naturalWidth > 0) {{
+        context.drawImage(image, (column * span - offset[0]) * scale, (row * span - offset[1]) * scale,
+                          image.naturalWidth * factor * scale, image.naturalHeight * factor * scale);
+      }}
+    }}
+  }}
+}}
+
+function draw() {{
+  if (pyramid === null) {{
+    return;
+  }}
+
+  context.fillStyle = "#000";
+  context.fillRect(0, 0, canvas.width, canvas.height);
+  context.imageSmoothingEnabled = scale < 1;
+
+  // the lowest level whose resolution is at least that of the screen
+  const level = Math.max(0, Math.min(pyramid.max_level, pyramid.max_level + Math.ceil(Math.log2(scale))));
+
+  // a coarser level is drawn under the tiles that are still loading
+  const fallback = Math.max(0, level - 3);
+  if (fallback < level) {{
+    drawLevel(fallback);
+  }}
+  drawLevel(level);
+}}
+
+function resize() {{
+  canvas.width = window.innerWidth;
+  canvas.height = window.innerHeight;
+  draw();
+}}
+
+function show(label) {{
+  pyramid = PYRAMIDS[label];
+  cache = new Map();
+  fit();
+  draw();
+}}
+
+canvas.addEventListener("wheel", (event) => {{
+  event.preventDefault();
+  const zoom = Math.exp(-event.deltaY / 500);
+  offset = [offset[0] + event.offsetX / scale * (1 - 1 / zoom), offset[1] + event.offsetY / scale * (1 - 1 / zoom)];
+  scale *= zoom;
+  draw();
+}});
+
+let dragging = null;
+canvas.addEventListener("mousedown", (event) => {{ dragging = [event.clientX, event.clientY]; }});
+window.addEventListener("mouseup", () => {{ dragging = null; }});
+window.addEventListener("mousemove", (event) => {{
+  if (dragging === null) {{
+    return;
+  }}
+  offset = [offset[0] - (event.clientX - dragging[0]) / scale, offset[1] - (event.clientY - dragging[1]) / scale];
+  dragging = [event.clientX, event.clientY];
+  draw();
+}});
+canvas.addEventListener("dblclick", () => {{ fit(); draw(); }});
+select.addEventListener("change", () => show(select.value));
+window.addEventListener("resize", resize);
+
+canvas.width = window.innerWidth;
+canvas.height = window.innerHeight;
+if (select.options.length > 0) {{
+  show(select.value);
+}}
+</script>
+</body>
+</html>
+"""
+
+
+def get_max_level(width, height):
+    # the level of the full resolution image; level 0 is a single pixel
+    return int(np.ceil(np.log2(max(width, height, 1))))
+
+
+def get_level_shape(width, height, level, max_level):
+    factor = 2 ** (max_level - level)
+
+    return int(np.ceil(height / factor)), int(np.ceil(width / factor))
+
+
+def get_tile_path(files_dir, level, column, row, tile_format="png"):
+    return f"{files_dir}/{level}/{column}_{row}.{tile_format}"
+
+
+def render_strip(job):
+    """
+    Renders the full resolution tiles job["tiles"] ((column, row) of each) of the strip of the montage between the
+    rows of pixels job["y_range"], from the projections that overlap them
+    """
+
+    font = ImageFont.truetype(FONT_PATH, 12)
+
+    tile_size = job["tile_size"]
+    tile_y, tile_x = job["tile_shape"]
+    y_start, y_stop = job["y_range"]
+
+    columns = [column for column, _ in job["tiles"]]
+    x_start = min(columns) * tile_size
+    x_stop = min((max(columns) + 1) * tile_size, job["width"])
+
+    canvas = np.zeros((y_stop - y_start, job["width"], job["n_channels"]), "uint8")
+
+    # the projections that overlap the tiles
+    for i, (proj_path, ind, _) in enumerate(job["images"]):
+        y = (i // job["nwide"]) * tile_y
+        x = (i % job["nwide"]) * tile_x
+
+        if y >= y_stop or y + tile_y <= y_start or x >= x_stop or x + tile_x <= x_start:
+            continue
+
+        tile = read_tile(proj_path, ind, font)
+
+        # the part of the projection that is in the strip
+        crop_start = max(y_start - y, 0)
+        crop_stop = min(y_stop - y, tile.shape[0])
+        if crop_stop <= crop_start:
+            continue
+
+        canvas[
+            (y + crop_start - y_start) : (y + crop_stop - y_start),  # noqa
+            x : (x + tile.shape[1]),  # noqa
+            : tile.shape[2],
+        ] = tile[crop_start:crop_stop]
+
+    for column, row in job["tiles"]:
+        y = row * tile_size - y_start
+        x = column * tile_size
+
+        tile = canvas[y : (y + tile_size), x : (x + tile_size)]  # noqa
+        if tile.shape[2] == 1:
+            tile = tile[:, :, 0]
+
+        Image.fromarray(tile).save(
+            get_tile_path(
+                job["files_dir"], job["level"], column, row, job["tile_format"]
+            )
+        )
+
+
+def downsample_tiles(job):
+    """
+    Builds the tiles job["tiles"] ((column, row) of each) of job["level"] from the tiles of the level above
+    """
+
+    tile_size = job["tile_size"]
+
+    # the number of columns and rows of tiles of the level above
+    n_rows, n_columns = [int(np.ceil(size / tile_size)) for size in job["child_shape"]]
+
+    for column, row in job["tiles"]:
+        child_rows = list()
+        for child_row in [2 * row, 2 * row + 1]:
+            if child_row >= n_rows:
+                continue
+
+            child_tiles = list()
+            for child_column in [2 * column, 2 * column + 1]:
+                if child_column >= n_columns:
+                    continue
+
+                with Image.open(
+                    get_tile_path(
+                        job["files_dir"],
+                        job["level"] + 1,
+                        child_column,
+                        child_row,
+                        job["tile_format"],
+                    )
+                ) as im:
+                    child_tile = np.asarray(im)
+
+                if child_tile.ndim == 2:
+                    child_tile = child_tile[:, :, np.newaxis]
+
+                child_tiles.append(child_tile)
+
+            child_rows.append(np.concatenate(child_tiles, axis=1))
+
+        tile = utils.downsample(np.concatenate(child_rows, axis=0))
+        if tile.shape[2] == 1:
+            tile = tile[:, :, 0]
+
+        Image.fromarray(tile).save(
+            get_tile_path(
+                job["files_dir"], job["level"], column, row, job["tile_format"]
+            )
+        )
+
+
+def run_jobs(fn, jobs, executor=None):
+    # runs fn on each job, in the processes of executor if there is one
+    if executor is None or len(jobs) <= 1:
+        for job in jobs:
+            fn(job)
+
+        return
+
+    # consuming the results raises the first exception of a job
+    list(executor.map(fn, jobs))
+
+
+def get_changed_images(record, previous_record):
+    # indices of the images of a montage that changed since previous_record, or None if the whole layout changed
+    layout_keys = [
+        "tile_size",
+        "tile_format",
+        "nwide",
+        "tile_shape",
+        "n_channels",
+        # the tiles of the lower levels can't be updated in place if the montage grew or shrank
+        "width",
+        "height",
+    ]
+
+    if previous_record is None or any(
+        record[key] != previous_record[key] for key in layout_keys
+    ):
+        return None
+
+    images = record["images"]
+    previous_images = previous_record["images"]
+
+    changed = [
+        i
+        for i, image in enumerate(images)
+        if i >= len(previous_images) or image != previous_images[i]
+    ]
+
+    # images that are no longer there leave an empty spot
+    changed += list(range(len(images), len(previous_images)))
+
+    return changed
+
+
+def render_pyramid(record, previous_record, files_dir, executor=None, verbose=True):
+    """
+    Renders (or updates) the tiles of the montage described by record, see im2pyramid. Only the tiles that show
+    images that changed since previous_record are rendered again.
+    """
+
+    tile_size = record["tile_size"]
+    tile_y, tile_x = record["tile_shape"]
+    nwide = record["nwide"]
+    max_level = record["max_level"]
+
+    height, width = record["height"], record["width"]
+    n_rows = int(np.ceil(height / tile_size))
+    n_columns = int(np.ceil(width / tile_size))
+
+    changed = get_changed_images(record, previous_record)
+    if changed is None:
+        # everything is rendered again
+        shutil.rmtree(files_dir, ignore_errors=True)
+        changed = list()
+
+        dirty = {(column, row) for column in range(n_columns) for row in range(n_rows)}
+    else:
+        # the full resolution tiles that show the images that changed
+        dirty = set()
+
+    for level in range(max_level + 1):
+        os.makedirs(f"{files_dir}/{level}", exist_ok=True)
+
+    for i in changed:
+        y = (i // nwide) * tile_y
+        x = (i % nwide) * tile_x
+
+        for row in range(
+            y // tile_size, min((y + tile_y - 1) // tile_size + 1, n_rows)
+        ):
+            for column in range(
+                x // tile_size, min((x + tile_x - 1) // tile_size + 1, n_columns)
+            ):
+                dirty.add((column, row))
+
+    if verbose:
+        print(f"Rendering {len(dirty)} of {n_rows * n_columns} tiles of {files_dir}")
+
+    # rendered in strips of rows of tiles, so each projection is decoded only about once
+    strips = dict()
+    for column, row in sorted(dirty):
+        strips.setdefault(row // STRIP_TILES, list()).append((column, row))
+
+    jobs = list()
+    for strip, strip_tiles in strips.items():
+        jobs.append(
+            {
+                "files_dir": files_dir,
+                "level": max_level,
+                "tile_size": tile_size,
+                "tile_format": record["tile_format"],
+                "tile_shape": record["tile_shape"],
+                "n_channels": record["n_channels"],
+                "nwide": nwide,
+                "width": width,
+                "images": record["images"],
+                "y_range": (
+                    strip * STRIP_TILES * tile_size,
+                    min((strip + 1) * STRIP_TILES * tile_size, height),
+                ),
+                "tiles": strip_tiles,
+            }
+        )
+
+    run_jobs(render_strip, jobs, executor=executor)
+
+    # each level from the one above it, a row of tiles per job
+    for level in range(max_level - 1, -1, -1):
+        dirty = {(column // 2, row // 2) for column, row in dirty}
+
+        rows = dict()
+        for column, row in sorted(dirty):
+            rows.setdefault(row, list()).append((column, row))
+
+        jobs = [
+            {
+                "files_dir": files_dir,
+                "level": level,
+                "tile_size": tile_size,
+                "tile_format": record["tile_format"],
+                "child_shape": get_level_shape(width, height, level + 1, max_level),
+                "tiles": row_tiles,
+            }
+            for row_tiles in rows.values()
+        ]
+
+        run_jobs(downsample_tiles, jobs, executor=executor)
+
+
+def im2pyramid(
+    impaths,
+    im_ids,
+    labels,
+    save_parent_dir,
+    nwide=None,
+    tile_size=TILE_SIZE,
+    tile_format="png",
+    n_workers=1,
+    overwrite=True,
+    verbose=True,
+):
+    """
+    Makes a zoomable montage of the images of each label, with the ID of each image written on it, as a Deep Zoom
+    image pyramid in save_parent_dir, and a viewer for all of them, f"{save_parent_dir}/index.html"
+
+    Parameters
+    ----------
+    nwide: int or None
+        number of images per row. If None, the montages are about square.
+
+    n_workers: int
+        number of processes that render the tiles
+
+    overwrite: bool
+        if False, only the tiles that show images that changed since the montage was made are rendered again. The
+        layout and images of each montage are recorded in f"{save_parent_dir}/{label}.json".
+    """
+
+    impaths = np.array(impaths)
+    im_ids = np.array(im_ids)
+    labels = np.array([str(label) for label in labels])
+
+    executor = None
+    if n_workers > 1:
+        # spawn rather than fork, since the parent has threads (e.g. the output writer and Prefect's)
+        executor = ProcessPoolExecutor(
+            max_workers=n_workers, mp_context=multiprocessing.get_context("spawn")
+        )
+
+    try:
+        for ulabel in np.unique(labels):
+            label_inds = labels == ulabel
+
+            images, tile_shape = get_tiles(
+                impaths[label_inds], im_ids[label_inds], verbose=verbose
+            )
+            if len(images) == 0:
+                continue
+
+            tile_y, tile_x, n_channels = tile_shape
+
+            label_nwide = nwide
+            if label_nwide is None:
+                label_nwide = int(np.ceil(np.sqrt(len(images) * tile_y / tile_x)))
+            label_nwide = min(label_nwide, len(images))
+
+            width = label_nwide * tile_x
+            height = int(np.ceil(len(images) / label_nwide)) * tile_y
+
+            record = {
+                "tile_size": tile_size,
+                "tile_format": tile_format,
+                "nwide": label_nwide,
+                "tile_shape": [tile_y, tile_x],
+                "n_channels": n_channels,
+                "width": width,
+                "height": height,
+                "max_level": get_max_level(width, height),
+                "images": images,
+            }
+
+            files_name = f"{ulabel}_files"
+            files_dir = f"{save_parent_dir}/{files_name}"
+            record_path = f"{save_parent_dir}/{ulabel}.json"
+            dzi_path = f"{save_parent_dir}/{ulabel}.dzi"
+
+            previous_record = None
+            if not overwrite and filesystem.file_index.exists(record_path):
+                with open(record_path, "r") as f:
+                    previous_record = json.load(f)
+
+            if previous_record == record and filesystem.file_index.exists(dzi_path):
+                if verbose:
+                    print("Skipping " + dzi_path)
+            else:
+                render_pyramid(
+                    record,
+                    previous_record,
+                    files_dir,
+                    executor=executor,
+                    verbose=verbose,
+                )
+
+                with open(dzi_path, "w") as f:
+                    f.write(
+                        DZI_TEMPLATE.format(
+                            format=tile_format,
+                            tile_size=tile_size,
+                            width=width,
+                            height=height,
+                        )
+                    )
+                filesystem.file_index.add(dzi_path)
+
+                # only recorded once the tiles are written, so an interrupted run renders them again
+                with open(record_path, "w") as f:
+                    json.dump(record, f)
+                filesystem.file_index.add(record_path)
+
+    finally:
+        if executor is not None:
+            executor.shutdown()
+
+    write_viewer(save_parent_dir)
+
+
+def get_pyramid_outputs(save_parent_dir, label):
+    # the record and .dzi that im2pyramid made for a label, or an empty list if it hasn't made them
+    outputs = [f"{save_parent_dir}/{label}.json", f"{save_parent_dir}/{label}.dzi"]
+    if not all(filesystem.file_index.exists(path) for path in outputs):
+        return list()
+
+    return outputs
+
+
+def write_viewer(save_parent_dir):
+    # writes index.html for all of the montages in save_parent_dir, including the ones of labels made by earlier runs
+    filesystem.file_index.invalidate(save_parent_dir)
+
+    pyramids = dict()
+    for filename in sorted(filesystem.file_index.listdir(save_parent_dir)):
+        if not filename.endswith(".dzi"):
+            continue
+
+        label = filename[: -len(".dzi")]
+        record_path = f"{save_parent_dir}/{label}.json"
+        if not filesystem.file_index.exists(record_path):
+            continue
+
+        with open(record_path, "r") as f:
+            record = json.load(f)
+
+        pyramids[label] = {
+            "files": f"{label}_files",
+            "format": record["tile_format"],
+            "tile_size": record["tile_size"],
+            "width": record["width"],
+            "height": record["height"],
+            "max_level": record["max_level"],
+            "n_images": len(record["images"]),
+        }
+
+    viewer_path = f"{save_parent_dir}/index.html"
+    with open(viewer_path, "w") as f:
+        f.write(VIEWER_TEMPLATE.format(pyramids=json.dumps(pyramids, indent=2)))
+    filesystem.file_index.add(viewer_path)
@@ -1,42 +1,130 @@
 import numpy as np
 import pandas as pd
 
+# the columns of the per-cell data that cell_data_to_summary_table uses
+SUMMARY_COLUMNS = [
+    "CellLineId",
+    "Clone",
+    "Gene",
+    "ProteinDisplayName",
+    "StructureShortName",
+    "FOVId",
+    "Workflow",
+]
 
-def cell_data_to_summary_table(cell_data):
-    # takes a per-cell data table and returns a summary table
+# the columns of the summary table with the unique values of each cell line, and the columns they are from
+SUMMARY_LABEL_COLUMNS = {
+    "Clone": "Clone",
+    "Gene": "Gene",
+    "ProteinDisplayName": "ProteinDisplayName",
+    "Structure Name": "StructureShortName",
+}
+
+
+def get_summary_counts(cell_data):
+    """
+    Returns the number of cells ("#cells") of each FOV, with its values of the other SUMMARY_COLUMNS.
 
-    u_workflows = np.unique(cell_data["Workflow"])
+    This is all that the summary table is made from, and each FOV is in a single plate, so the counts of a dataset are
+    the counts of each of its plates put together. See summary_table_from_counts.
+    """
 
-    cell_line_summary_table = {}
+    return (
+        cell_data.groupby(SUMMARY_COLUMNS, observed=True, sort=False, dropna=False)
+        .size()
+        .rename("#cells")
+        .reset_index()
+    )
 
-    for i, u_cell_line in enumerate(np.unique(cell_data.CellLineId)):
-        data_cell_line = cell_data[cell_data.CellLineId == u_cell_line]
 
-        cell_line_summary_table[i] = {}
-        cell_line_summary_table[i]["CellLineId"] = u_cell_line
-        cell_line_summary_table[i]["Clone"] = np.unique(data_cell_line.Clone)
-        cell_line_summary_table[i]["Gene"] = np.unique(data_cell_line.Gene)
-        cell_line_summary_table[i]["ProteinDisplayName"] = np.unique(
-            data_cell_line.ProteinDisplayName
-        )
-        cell_line_summary_table[i]["Structure Name"] = np.unique(
-            data_cell_line.StructureShortName
-        )
+def get_codes(values):
+    # integer codes of values (missing values included), and the value of each code
+    codes, uniques = pd.factorize(values)
+    uniques = np.asarray(uniques)
+
+    # missing values are coded -1, so they get the code after the others (use_na_sentinel needs pandas >= 1.5)
+    missing = codes == -1
+    if np.any(missing):
+        codes[missing] = len(uniques)
+        uniques = np.append(uniques, np.nan)
+
+    return codes, uniques
+
+
+def count_unique_pairs(codes, other_codes, n_codes, n_other_codes):
+    # the number of distinct other_codes of each code, as an (n_codes, n_other_codes) matrix of whether they occur
+    pairs = np.unique(codes.astype(np.int64) * n_other_codes + other_codes)
+
+    return pairs // n_other_codes, pairs % n_other_codes
+
+
+def summary_table_from_counts(counts):
+    """
+    Returns the summary table of each cell line from the per-FOV counts of get_summary_counts (of one or more plates)
+    """
+
+    if counts.shape[0] == 0:
+        return pd.DataFrame()
+
+    # everything is counted on integer codes, which is the same for categorical columns (each plate's counts can have
+    # different categories) and plain ones
+    line_codes, u_lines = get_codes(counts["CellLineId"])
+    fov_codes, u_fovs = get_codes(counts["FOVId"])
+    workflow_codes, u_workflows = get_codes(counts["Workflow"])
 
-        cell_line_summary_table[i]["#cells"] = len(data_cell_line)
-        cell_line_summary_table[i]["#fovs"] = len(np.unique(data_cell_line.FOVId))
+    n_lines = len(u_lines)
 
-        # breakdown of #FOVs/workflow
-        for u_workflow in u_workflows:
-            workflow_inds = data_cell_line["Workflow"] == u_workflow
+    # in the order of np.unique
+    line_order = np.argsort(u_lines, kind="stable")
+    workflow_order = np.argsort(u_workflows, kind="stable")
+
+    summary_table = {"CellLineId": u_lines[line_order]}
+
+    for summary_column, column in SUMMARY_LABEL_COLUMNS.items():
+        label_codes, u_labels = get_codes(counts[column])
+
+        pair_lines, pair_labels = count_unique_pairs(
+            line_codes, label_codes, n_lines, len(u_labels)
+        )
+        line_starts = np.searchsorted(pair_lines, np.arange(n_lines + 1))
 
-            cell_line_summary_table[i]["{} (#fovs)".format(u_workflow)] = len(
-                np.unique(data_cell_line[workflow_inds]["FOVId"])
+        # only the few distinct values of each cell line are sorted
+        summary_table[summary_column] = [
+            np.unique(
+                u_labels[pair_labels[line_starts[line] : line_starts[line + 1]]]  # noqa
             )
+            for line in line_order
+        ]
 
-    cell_line_summary_table = pd.DataFrame.from_dict(cell_line_summary_table).T
+    summary_table["#cells"] = np.bincount(
+        line_codes, weights=counts["#cells"].values, minlength=n_lines
+    ).astype(int)[line_order]
 
-    return cell_line_summary_table
+    pair_lines, _ = count_unique_pairs(line_codes, fov_codes, n_lines, len(u_fovs))
+    summary_table["#fovs"] = np.bincount(pair_lines, minlength=n_lines)[line_order]
+
+    # breakdown of #FOVs/workflow
+    line_workflow_codes = (
+        line_codes.astype(np.int64) * len(u_workflows) + workflow_codes
+    )
+    pair_line_workflows, _ = count_unique_pairs(
+        line_workflow_codes, fov_codes, n_lines * len(u_workflows), len(u_fovs)
+    )
+    workflow_fovs = np.bincount(
+        pair_line_workflows, minlength=n_lines * len(u_workflows)
+    ).reshape(n_lines, len(u_workflows))
+
+    for workflow in workflow_order:
+        summary_table["{} (#fovs)".format(u_workflows[workflow])] = workflow_fovs[
+            line_order, workflow
+        ]
+
+    return pd.DataFrame(summary_table).astype(object)
+
+
+def cell_data_to_summary_table(cell_data):
+    # takes a per-cell data table and returns a summary table
+    return summary_table_from_counts(get_summary_counts(cell_data))
 
 
 def plot_intensity_profiles(
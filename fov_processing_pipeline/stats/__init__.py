@@ -1,3 +1,4 @@
 from .stats import *  # noqa
 from . import z_intensity_profile  # noqa
 from . import pca  # noqa
+from . import plots  # noqa
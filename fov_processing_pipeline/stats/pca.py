@@ -1,76 +1,356 @@
+"""
+pca.py: PCA of the FOV stats.
+
+The stats are turned into a dense (FOVs, features) matrix a column at a time by get_feature_matrix, and z-scored before
+the PCA. Small matrices get a full PCA; above MAX_FULL_PCA_SIZE (FOVs x features) only the first n_components are
+found, with a randomized SVD. plot_from_files streams the stats from the per-FOV stats files instead, so that the fit
+doesn't need them all in memory: their features are written to PCA_features.npy (memory mapped) a chunk of FOVs at a
+time, an IncrementalPCA is fit to it a chunk at a time, and it is deleted once the FOVs are projected. Both make the
+same features from the same stats (see is_feature_column), and plot_from_files can interpolate the by-z stats like
+postprocess.zsize_qc does in wrappers.qc_stats.
+
+The fitted model (see save_model/load_model and transform) and the projection of each FOV are saved next to the plots,
+so they can be reused, e.g. to project new FOVs onto the same components.
+"""
+
 import os
+import pickle
 
 import pandas as pd
 import numpy as np
-import sklearn.preprocessing
-import sklearn.decomposition
-import matplotlib.pyplot as plt
-from matplotlib import cm
 
+from .. import filesystem, postprocess
+from . import z_intensity_profile
 
 FEATURE_NAME = "PCA"
 
+# how the array-valued stats are turned into features, see get_feature_matrix
+FEATURE_METHODS = ["mean", "z_profile", "percentiles"]
+PCA_METHODS = ["auto", "full", "randomized", "incremental"]
 
-def plot(
-    df_stats: pd.DataFrame, save_dir: str, suffix: str = None, labels: np.array = None
+# above this many (FOVs x features), "auto" finds only the first n_components, with a randomized SVD
+MAX_FULL_PCA_SIZE = 10 ** 7
+DEFAULT_N_COMPONENTS = 10
+
+# the z profiles are resampled to this many values by the "z_profile" features
+N_Z = 32
+
+# the defaults of stats.intensity_percentiles_by_channel
+PERCENTILES = [5, 25, 50, 75, 95]
+
+# number of FOVs read at a time by plot_from_files
+CHUNK_SIZE = 10000
+
+# Columns of the stats that aren't features, see is_feature_column
+NON_FEATURE_COLUMNS = ["FOVId", "ProteinDisplayName", "QC"]
+
+
+def is_feature_column(column):
+    # the IDs, labels, random numbers and QC flags that wrappers.load_stats and wrappers.qc_stats add to the stats
+    # aren't features
+    return column not in NON_FEATURE_COLUMNS and not column.endswith("_rng")
+
+
+def is_z_column(column):
+    return column.endswith("_by_z") or column.startswith(
+        z_intensity_profile.FEATURE_NAME
+    )
+
+
+def is_percentile_column(column):
+    return column.endswith("_Percentile_Intensities")
+
+
+def get_column_matrix(values):
+    """
+    Stacks a column of scalars or arrays into a (n_rows, max_length) float array, padded with NaN
+
+    Returns
+    -------
+    matrix: np.array
+
+    lengths: np.array
+        number of values of each row
+    """
+
+    if values.dtype != object:
+        matrix = values.astype(float)[:, np.newaxis]
+
+    elif len(values) > 0 and isinstance(values[0], str):
+        raise ValueError("stats must be numeric")
+
+    else:
+        try:
+            # all of the same length, which they usually are
+            matrix = np.stack(values).astype(float).reshape(len(values), -1)
+        except ValueError:
+            return z_intensity_profile.get_profile_matrix(
+                [np.atleast_1d(value) for value in values]
+            )
+
+    return matrix, np.full(matrix.shape[0], matrix.shape[1])
+
+
+def resample(matrix, lengths, n_z):
+    """
+    Linearly interpolates the first lengths[i] values of each row i of matrix to n_z evenly spaced values, like
+    np.interp(np.linspace(0, lengths[i] - 1, n_z), range(lengths[i]), matrix[i, : lengths[i]])
+    """
+
+    lengths = np.maximum(lengths, 1)[:, np.newaxis]
+
+    positions = np.linspace(0, 1, n_z)[np.newaxis, :] * (lengths - 1)
+    lower = np.floor(positions).astype(int)
+    upper = np.minimum(lower + 1, lengths - 1)
+    weights = positions - lower
+
+    rows = np.arange(matrix.shape[0])[:, np.newaxis]
+
+    return matrix[rows, lower] * (1 - weights) + matrix[rows, upper] * weights
+
+
+def get_feature_matrix(
+    df_stats: pd.DataFrame, method: str = "mean", n_z: int = N_Z, percentiles=None
 ):
     """
-    Plots whatever is in df_stats in a PCA plot.
+    Turns the stats into a dense float matrix, a column at a time (rather than a Python call per value)
 
     Parameters
     ----------
     df_stats: pd.DataFrame
-        pandas dataframe from im2stats
+        numeric stats, e.g. from wrappers.load_stats, of scalars or arrays
 
-    save_dir: str
-        directory in which plot is saved. File name is determined automatically
+    method: str
+        "mean": the mean of each column's values, one feature per column
+        "z_profile": the by-z stats and z intensity profiles of each FOV resampled to n_z values, one feature for each
+            z value
+        "percentiles": the percentile intensities of each channel at percentiles, one feature for each percentile
+        In each method, the other columns are their means.
 
-    suffix: str
-        suffix to append to the file name
+    n_z: int
+        number of z values of each profile of the "z_profile" features
+
+    percentiles: list
+        percentiles of the "percentiles" features, of those in the Intensity_Percentiles column (or PERCENTILES). All
+        of them if None.
 
+    Returns
+    -------
+    features: np.array
+        (FOVs, features) float64 array
+
+    feature_names: list of str
+    """
+
+    if method not in FEATURE_METHODS:
+        raise ValueError(
+            f"unrecognized feature method {method}, must be one of {FEATURE_METHODS}"
+        )
+
+    # im2stats has an Intensity_Percentiles column for each channel, so the columns are looked up by position
+    columns = list(df_stats.columns)
+
+    percentile_list = PERCENTILES
+    if "Intensity_Percentiles" in columns and df_stats.shape[0] > 0:
+        percentile_list = np.asarray(
+            df_stats.iloc[0, columns.index("Intensity_Percentiles")]
+        ).tolist()
+
+    if percentiles is None:
+        percentiles = percentile_list
+
+    missing = [p for p in percentiles if p not in percentile_list]
+    if len(missing) > 0:
+        raise ValueError(f"percentiles {missing} are not in {percentile_list}")
+
+    percentile_inds = [percentile_list.index(p) for p in percentiles]
+
+    features = list()
+    feature_names = list()
+    for i, column in enumerate(columns):
+        if not is_feature_column(column):
+            continue
+
+        matrix, lengths = get_column_matrix(df_stats.iloc[:, i].values)
+
+        if method == "z_profile" and is_z_column(column):
+            features.append(resample(matrix, lengths, n_z))
+            feature_names += [f"{column}_{i}" for i in range(n_z)]
+
+        elif method == "percentiles" and is_percentile_column(column):
+            features.append(matrix[:, percentile_inds])
+            feature_names += [f"{column}_{p}" for p in percentiles]
+
+        else:
+            if np.all(lengths == matrix.shape[1]):
+                features.append(np.mean(matrix, 1, keepdims=True))
+            else:
+                features.append(np.nanmean(matrix, 1, keepdims=True))
+            feature_names.append(column)
+
+    if len(features) == 0:
+        return np.zeros((df_stats.shape[0], 0)), feature_names
+
+    return np.concatenate(features, 1), feature_names
+
+
+def get_n_features(df_stats, method="mean", n_z=N_Z, percentiles=None):
+    # number of features of the stats, from their first row
+    return len(
+        get_feature_matrix(
+            df_stats.iloc[:1], method=method, n_z=n_z, percentiles=percentiles
+        )[1]
+    )
+
+
+def get_pca_method(n_samples, n_features, pca_method="auto"):
+    if pca_method not in PCA_METHODS:
+        raise ValueError(
+            f"unrecognized PCA method {pca_method}, must be one of {PCA_METHODS}"
+        )
+
+    if pca_method == "auto":
+        if n_samples * n_features <= MAX_FULL_PCA_SIZE:
+            return "full"
+
+        return "randomized"
+
+    return pca_method
+
+
+def fit_pca(features, pca_method="auto", n_components=None, random_state=0):
+    """
+    Z-scores features and fits a PCA to them
+
+    Parameters
+    ----------
+    features: np.array
+        (FOVs, features) array from get_feature_matrix
+
+    pca_method: str
+        "full": all of the components
+        "randomized": the first n_components, with a randomized SVD
+        "incremental": the first n_components, with an IncrementalPCA
+        "auto": "full", or "randomized" above MAX_FULL_PCA_SIZE
+
+    n_components: int
+        number of components. All of them if None for "full", and DEFAULT_N_COMPONENTS for the others.
+
+    Returns
+    -------
+    model: dict
+        the fitted "scaler" and "pca", and the "pca_method"
+    """
+
+    # imported here so that only the plotting stages pay for loading sklearn
+    import sklearn.preprocessing
+    import sklearn.decomposition
+
+    pca_method = get_pca_method(*features.shape, pca_method=pca_method)
+
+    if n_components is None and pca_method != "full":
+        n_components = DEFAULT_N_COMPONENTS
+    if n_components is not None:
+        n_components = min(n_components, *features.shape)
+
+    scaler = sklearn.preprocessing.StandardScaler().fit(features)
+    features = scaler.transform(features)
+
+    if pca_method == "incremental":
+        pca = sklearn.decomposition.IncrementalPCA(n_components=n_components)
+    else:
+        svd_solver = "randomized" if pca_method == "randomized" else "full"
+        pca = sklearn.decomposition.PCA(
+            n_components=n_components,
+            svd_solver=svd_solver,
+            random_state=random_state,
+        )
+
+    pca.fit(features)
+
+    return {"scaler": scaler, "pca": pca, "pca_method": pca_method}
+
+
+def transform(model, df_stats):
+    """
+    Projects stats onto the components of a model from fit_pca (with its feature parameters, see save_model)
     """
-    if not os.path.exists(save_dir):
-        os.makedirs(save_dir)
 
+    features, feature_names = get_feature_matrix(
+        df_stats,
+        method=model["feature_method"],
+        n_z=model["n_z"],
+        percentiles=model["percentiles"],
+    )
+
+    if feature_names != model["feature_names"]:
+        raise ValueError("the stats don't have the features the model was fit to")
+
+    return model["pca"].transform(model["scaler"].transform(features))
+
+
+def get_save_paths(save_dir, suffix=None):
     if suffix:
         suffix = "_{}".format(suffix)
     else:
         suffix = ""
 
-    template_str = "{save_dir}/{FEATURE_NAME}{prefix}{suffix}.png"
+    template_str = "{save_dir}/{FEATURE_NAME}{prefix}{suffix}{ext}"
 
-    template_dict = {
-        "save_dir": save_dir,
-        "prefix": "prefix",
-        "FEATURE_NAME": FEATURE_NAME,
-        "suffix": suffix,
+    return {
+        key: template_str.format(
+            save_dir=save_dir,
+            FEATURE_NAME=FEATURE_NAME,
+            prefix=prefix,
+            suffix=suffix,
+            ext=ext,
+        )
+        for key, prefix, ext in [
+            ("pcs", "_PCs", ".png"),
+            ("variation", "_variation", ".png"),
+            ("model", "_model", ".pkl"),
+            ("projections", "_projections", ".parquet"),
+            ("features", "_features", ".npy"),
+        ]
     }
 
-    template_dict["prefix"] = "_PCs"
-    save_path_pcs = template_str.format(**template_dict)
 
-    template_dict["prefix"] = "_variation"
-    save_path_var = template_str.format(**template_dict)
+def save_model(model, save_path):
+    with open(save_path, "wb") as f:
+        pickle.dump(model, f)
 
-    if labels is None:
-        labels = np.ones(df_stats.shape[0])
 
-    u_labels = np.unique(labels)
+def load_model(load_path):
+    with open(load_path, "rb") as f:
+        return pickle.load(f)
 
-    colors = cm.jet(np.linspace(0, 1, len(u_labels)))
 
-    # take the mean of any multi-element cells in the dataframe
-    pca_stats = df_stats.applymap(lambda x: np.mean(x)).values
+def save_projections(projections, save_path, ids=None, labels=None):
+    df_projections = pd.DataFrame(
+        projections,
+        columns=[f"PC{i + 1}" for i in range(projections.shape[1])],
+    )
+
+    if ids is not None:
+        df_projections.insert(0, "FOVId", np.asarray(ids))
+    if labels is not None:
+        df_projections.insert(1 if ids is not None else 0, "label", np.asarray(labels))
 
-    # z-score the data
-    scaler = sklearn.preprocessing.StandardScaler().fit(pca_stats)
-    pca_stats = scaler.transform(pca_stats)
+    df_projections.to_parquet(save_path)
 
-    # do the pca
-    pca = sklearn.decomposition.PCA()
 
-    pca.fit(pca_stats)
-    pca_stats = pca.transform(pca_stats)
+def plot_projections(projections, pca, labels, save_path_pcs, save_path_var):
+    # imported here so that only the plotting stages pay for loading matplotlib
+    import matplotlib.pyplot as plt
+    from matplotlib import cm
+
+    if labels is None:
+        labels = np.ones(projections.shape[0])
+    labels = np.asarray(labels)
+
+    u_labels = np.unique(labels)
+
+    colors = cm.jet(np.linspace(0, 1, len(u_labels)))
 
     plt.figure()
 
@@ -78,7 +358,10 @@ def plot(
         label_inds = labels == label
 
         plt.scatter(
-            pca_stats[label_inds, 0], pca_stats[label_inds, 1], color=color, label=label
+            projections[label_inds, 0],
+            projections[label_inds, 1],
+            color=color,
+            label=label,
         )
 
     lgd = plt.legend(bbox_to_anchor=(1.04, 1), loc="upper left")
@@ -92,10 +375,11 @@ def plot(
 
     n_components = len(pca.explained_variance_)
 
+    # of the total variance, also when only the first components were found
     plt.figure()
     plt.plot(
         np.arange(1, n_components + 1),
-        np.cumsum(pca.explained_variance_) / np.sum(pca.explained_variance_),
+        np.cumsum(pca.explained_variance_ratio_),
     )
     plt.xlabel("Component #")
     plt.ylabel("Cumulative explained variance")
@@ -106,4 +390,242 @@ def plot(
     plt.savefig(save_path_var)
     plt.close()
 
-    return
+
+def plot(
+    df_stats: pd.DataFrame,
+    save_dir: str,
+    suffix: str = None,
+    labels: np.array = None,
+    ids: np.array = None,
+    feature_method: str = "mean",
+    pca_method: str = "auto",
+    n_components: int = None,
+    n_z: int = N_Z,
+    percentiles: list = None,
+):
+    """
+    Plots whatever is in df_stats in a PCA plot, and saves the model and projections next to it.
+
+    Parameters
+    ----------
+    df_stats: pd.DataFrame
+        pandas dataframe from im2stats
+
+    save_dir: str
+        directory in which plot is saved. File name is determined automatically
+
+    suffix: str
+        suffix to append to the file name
+
+    labels, ids: np.array
+        label (the color in the plot) and FOVId of each row, saved with the projections
+
+    feature_method, n_z, percentiles:
+        see get_feature_matrix
+
+    pca_method, n_components:
+        see fit_pca
+
+    Returns
+    -------
+    model: dict
+        from fit_pca, with the feature parameters, as it is saved
+
+    """
+
+    if not os.path.exists(save_dir):
+        os.makedirs(save_dir)
+
+    save_paths = get_save_paths(save_dir, suffix)
+
+    features, feature_names = get_feature_matrix(
+        df_stats, method=feature_method, n_z=n_z, percentiles=percentiles
+    )
+
+    model = fit_pca(features, pca_method=pca_method, n_components=n_components)
+    model.update(
+        {
+            "feature_method": feature_method,
+            "n_z": n_z,
+            "percentiles": percentiles,
+            "feature_names": feature_names,
+        }
+    )
+
+    projections = model["pca"].transform(model["scaler"].transform(features))
+
+    save_model(model, save_paths["model"])
+    save_projections(projections, save_paths["projections"], ids=ids, labels=labels)
+
+    plot_projections(
+        projections, model["pca"], labels, save_paths["pcs"], save_paths["variation"]
+    )
+
+    return model
+
+
+def read_stats_chunks(stats_paths, chunk_size=CHUNK_SIZE):
+    """
+    Reads the stats files (from process_fov_row) chunk_size at a time. Missing files are skipped.
+
+    Yields
+    ------
+    inds: np.array
+        index in stats_paths of each row
+
+    df_stats: pd.DataFrame
+    """
+
+    for start in range(0, len(stats_paths), chunk_size):
+        inds = list()
+        stats_list = list()
+
+        for i in range(start, min(start + chunk_size, len(stats_paths))):
+            if filesystem.file_index.exists(stats_paths[i]):
+                with open(stats_paths[i], "rb") as f:
+                    stats_list.append(pickle.load(f))
+                inds.append(i)
+
+        if len(stats_list) > 0:
+            yield np.array(inds), pd.concat(stats_list, axis=0, ignore_index=True)
+
+
+def get_batches(features, chunk_size, min_size):
+    # chunk_size rows of features at a time, with a last chunk of fewer than min_size rows added to the one before it
+    n_rows = features.shape[0]
+
+    starts = list(range(0, n_rows, chunk_size))
+    if len(starts) > 1 and n_rows - starts[-1] < min_size:
+        starts.pop()
+
+    for start, end in zip(starts, starts[1:] + [n_rows]):
+        yield features[start:end]
+
+
+def plot_from_files(
+    stats_paths: list,
+    save_dir: str,
+    suffix: str = None,
+    labels: np.array = None,
+    ids: np.array = None,
+    feature_method: str = "mean",
+    n_components: int = DEFAULT_N_COMPONENTS,
+    n_z: int = N_Z,
+    percentiles: list = None,
+    chunk_size: int = CHUNK_SIZE,
+    z_size: int = None,
+):
+    """
+    Like plot, but of the stats in the stats files, with an IncrementalPCA, chunk_size FOVs at a time. Only the
+    projections (FOVs x n_components) are in memory all at once.
+
+    Parameters
+    ----------
+    stats_paths: list
+        the stats file of each FOV, see wrappers.get_save_paths. Missing files are skipped.
+
+    labels, ids: np.array
+        label and FOVId of the FOV of each stats file
+
+    z_size: int or None
+        if set, the by-z stats of each FOV are interpolated to this many z slices, like postprocess.zsize_qc does to
+        the stats of wrappers.qc_stats
+
+    Returns
+    -------
+    model: dict
+        see plot
+    """
+
+    # imported here so that only the plotting stages pay for loading sklearn
+    import sklearn.preprocessing
+    import sklearn.decomposition
+
+    if not os.path.exists(save_dir):
+        os.makedirs(save_dir)
+
+    save_paths = get_save_paths(save_dir, suffix)
+
+    # the files could have been written by other processes
+    filesystem.file_index.invalidate()
+
+    inds = np.array(
+        [i for i, path in enumerate(stats_paths) if filesystem.file_index.exists(path)],
+        dtype=int,
+    )
+    if len(inds) == 0:
+        raise ValueError("none of the stats files exist")
+
+    # read each file once, into a memory mapped feature matrix that the later passes read a chunk at a time. It is
+    # only needed for the fit, so it is deleted afterwards.
+    features = None
+    try:
+        feature_names = None
+        scaler = sklearn.preprocessing.StandardScaler()
+        for chunk_inds, df_stats in read_stats_chunks(
+            [stats_paths[i] for i in inds], chunk_size
+        ):
+            if z_size is not None:
+                df_stats = postprocess.zsize_qc(df_stats, set_size=z_size)
+
+            chunk_features, chunk_feature_names = get_feature_matrix(
+                df_stats, method=feature_method, n_z=n_z, percentiles=percentiles
+            )
+
+            if features is None:
+                feature_names = chunk_feature_names
+                features = np.lib.format.open_memmap(
+                    save_paths["features"],
+                    mode="w+",
+                    dtype="float64",
+                    shape=(len(inds), len(feature_names)),
+                )
+            elif chunk_feature_names != feature_names:
+                raise ValueError(
+                    f"the stats of {stats_paths[inds[chunk_inds[0]]]} don't have the same features as the first stats"
+                )
+
+            features[chunk_inds] = chunk_features
+            scaler.partial_fit(chunk_features)
+
+        n_components = min(n_components, *features.shape)
+
+        pca = sklearn.decomposition.IncrementalPCA(n_components=n_components)
+        for batch in get_batches(features, chunk_size, n_components):
+            pca.partial_fit(scaler.transform(batch))
+
+        model = {
+            "scaler": scaler,
+            "pca": pca,
+            "pca_method": "incremental",
+            "feature_method": feature_method,
+            "n_z": n_z,
+            "percentiles": percentiles,
+            "feature_names": feature_names,
+        }
+
+        projections = np.concatenate(
+            [
+                pca.transform(scaler.transform(batch))
+                for batch in get_batches(features, chunk_size, 1)
+            ]
+        )
+    finally:
+        del features
+        if os.path.exists(save_paths["features"]):
+            os.remove(save_paths["features"])
+        filesystem.file_index.discard(save_paths["features"])
+
+    if labels is not None:
+        labels = np.asarray(labels)[inds]
+    if ids is not None:
+        ids = np.asarray(ids)[inds]
+
+    save_model(model, save_paths["model"])
+    save_projections(projections, save_paths["projections"], ids=ids, labels=labels)
+
+    plot_projections(
+        projections, pca, labels, save_paths["pcs"], save_paths["variation"]
+    )
+
+    return model
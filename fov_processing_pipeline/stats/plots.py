@@ -0,0 +1,227 @@
+"""
+plots.py: The plots of wrappers.stats2plots, as separate jobs (one per protein and kind of plot, and the PCA) that
+can be rendered in parallel processes.
+
+Each job only gets the columns of the stats that its plot needs, and closes the figures that it opens, so that
+memory doesn't grow with the number of plots.
+"""
+
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+
+from . import pca, z_intensity_profile
+from .stats import plot_im_percentiles
+
+PLOT_KINDS = ["percentiles", "z_intensity_profile", "z_intensity_profile_uncentered"]
+
+
+def get_plot_columns(df_stats, kind):
+    # the columns of the stats that a kind of plot needs
+    if kind == "percentiles":
+        return ["FOVId"] + [
+            c for c in df_stats.columns if "Percentile_Intensities" in c
+        ]
+
+    return [
+        c for c in df_stats.columns if c.startswith(z_intensity_profile.FEATURE_NAME)
+    ]
+
+
+def get_plot_jobs(
+    df_stats: pd.DataFrame,
+    save_dir: str,
+    proteins: list = None,
+    stats_paths: list = None,
+):
+    """
+    Returns the jobs of the per-protein plots of proteins (all of them if None) and of the PCA of all of the stats,
+    biggest first
+
+    Parameters
+    ----------
+    stats_paths: list or None
+        the stats file of each row of df_stats. If set and the features of the PCA (FOVs x features) are more than
+        pca.MAX_FULL_PCA_SIZE, the PCA is fit to the files a chunk at a time (see pca.plot_from_files) rather than to
+        df_stats. The by-z stats in the files are interpolated to the number of z slices of df_stats, which are the
+        same for every FOV after wrappers.qc_stats, so that both make the same features.
+
+    Returns
+    -------
+    jobs: list of dicts
+        "kind" of plot, "protein", the stats "df" it needs and "save_dir", and the "stats_paths" of a PCA that is
+        fit to the files
+    """
+
+    u_proteins = np.unique(df_stats.ProteinDisplayName)
+    if proteins is not None:
+        u_proteins = [u_protein for u_protein in u_proteins if u_protein in proteins]
+
+    # the PCA is of all of the stats, so it takes the longest
+    pca_job = {
+        "kind": "pca",
+        "protein": None,
+        "df": df_stats,
+        "save_dir": save_dir,
+    }
+
+    if (
+        stats_paths is not None
+        and df_stats.shape[0] > 0
+        and df_stats.shape[0] * pca.get_n_features(df_stats) > pca.MAX_FULL_PCA_SIZE
+    ):
+        pca_job["df"] = df_stats[["FOVId", "ProteinDisplayName"]]
+        pca_job["stats_paths"] = list(stats_paths)
+
+        if "Ch0_mean_by_z" in df_stats.columns:
+            pca_job["z_size"] = len(df_stats["Ch0_mean_by_z"].iloc[0])
+
+    jobs = [pca_job]
+
+    protein_jobs = list()
+    for u_protein in u_proteins:
+        df_stats_tmp = df_stats[u_protein == df_stats.ProteinDisplayName]
+
+        for kind in PLOT_KINDS:
+            protein_jobs.append(
+                {
+                    "kind": kind,
+                    "protein": u_protein,
+                    "df": df_stats_tmp[get_plot_columns(df_stats, kind)],
+                    "save_dir": save_dir,
+                }
+            )
+
+    jobs += sorted(protein_jobs, key=lambda job: job["df"].shape[0], reverse=True)
+
+    return jobs
+
+
+def get_plot_key(job):
+    # identifies the plot of a job across runs, see cache.ArtifactCache
+    if job["protein"] is None:
+        return job["kind"]
+
+    return "{}/{}".format(job["kind"], job["protein"])
+
+
+def get_plot_dir(job):
+    if job["kind"] in ["z_intensity_profile", "z_intensity_profile_uncentered"]:
+        return "{}/{}".format(job["save_dir"], job["kind"])
+
+    return job["save_dir"]
+
+
+def get_plot_outputs(job):
+    # the files that render_plot writes for a job
+    kind, u_protein, save_dir = job["kind"], job["protein"], get_plot_dir(job)
+
+    if kind == "percentiles":
+        return [f"{save_dir}/fov_stats_{u_protein}.png"]
+
+    elif kind in ["z_intensity_profile", "z_intensity_profile_uncentered"]:
+        return list(z_intensity_profile.get_save_paths(save_dir, u_protein))
+
+    elif kind == "pca":
+        save_paths = pca.get_save_paths(save_dir)
+        return [save_paths[key] for key in ["pcs", "variation", "model", "projections"]]
+
+    raise ValueError(f"unrecognized kind of plot {kind}")
+
+
+def render_plot(job):
+    """
+    Renders the plot of a job from get_plot_jobs, and closes the figures it opened
+
+    Returns
+    -------
+    kind, protein: str
+        of the job
+    """
+
+    import matplotlib.pyplot as plt
+
+    open_figures = set(plt.get_fignums())
+
+    try:
+        kind, u_protein, df, save_dir = (
+            job["kind"],
+            job["protein"],
+            job["df"],
+            job["save_dir"],
+        )
+
+        if kind == "percentiles":
+            plot_im_percentiles(
+                df, save_path=f"{save_dir}/fov_stats_{u_protein}.png", title=u_protein
+            )
+
+        elif kind == "z_intensity_profile":
+            z_intensity_profile.plot(
+                df,
+                get_plot_dir(job),
+                suffix=u_protein,
+                center_on_channel="z_intensity_profile_Ch1",
+            )
+
+        elif kind == "z_intensity_profile_uncentered":
+            z_intensity_profile.plot(df, get_plot_dir(job), suffix=u_protein)
+
+        elif kind == "pca" and "stats_paths" in job:
+            pca.plot_from_files(
+                job["stats_paths"],
+                save_dir,
+                labels=df["ProteinDisplayName"].values,
+                ids=df["FOVId"].values,
+                z_size=job.get("z_size"),
+            )
+
+        elif kind == "pca":
+            # TODO do this in a better way... probably use well annotated anndata instead of Pandas
+            pca.plot(
+                df.drop(["FOVId", "ProteinDisplayName"], axis=1),
+                save_dir,
+                labels=df["ProteinDisplayName"],
+                ids=df["FOVId"],
+            )
+
+        else:
+            raise ValueError(f"unrecognized kind of plot {kind}")
+
+    finally:
+        for figure in set(plt.get_fignums()) - open_figures:
+            plt.close(figure)
+
+    return kind, u_protein
+
+
+def use_agg():
+    # the worker processes only save figures, so they don't need (or have) a display
+    import matplotlib
+
+    matplotlib.use("Agg")
+
+
+def render_plots(jobs, n_workers=1):
+    """
+    Renders the plots of jobs from get_plot_jobs, n_workers at the same time in separate processes
+    """
+
+    if n_workers <= 1 or len(jobs) <= 1:
+        for job in jobs:
+            render_plot(job)
+
+        return
+
+    # spawn rather than fork, since the parent has threads (e.g. the output writer and Prefect's)
+    executor = ProcessPoolExecutor(
+        max_workers=n_workers,
+        mp_context=multiprocessing.get_context("spawn"),
+        initializer=use_agg,
+    )
+
+    with executor:
+        # consuming the results raises the first exception of a job
+        list(executor.map(render_plot, jobs))
@@ -1,5 +1,4 @@
 import numpy as np
-import matplotlib.pyplot as plt
 import pandas as pd
 
 
@@ -56,54 +55,139 @@ def intensity_percentiles_by_channel(im, c, percentile_list=[5, 25, 50, 75, 95])
     return pd.DataFrame.from_dict([stats_out])
 
 
-def plot_im_percentiles(df, fov_flag=True, save_path=None, save_flag=False, title=None):
+# plot_im_percentiles shows at most this many tick labels, and above this many FOVs (or cells) percentile bands
+MAX_TICKS = 30
+MAX_PLOTTED_ROWS = 1000
+
+
+def get_tick_positions(n, max_ticks=MAX_TICKS):
+    # every n/max_ticks-th of range(n), so that the labels don't overlap
+    return np.arange(0, n, max(int(np.ceil(n / max_ticks)), 1))
+
+
+def plot_im_percentiles(
+    df,
+    fov_flag=True,
+    save_path=None,
+    save_flag=False,
+    title=None,
+    n_bins="auto",
+    max_ticks=MAX_TICKS,
+):
     ############################################
     # Given a df of stats for multiple cells, plot all intensity percentile data, assuming five percentiles used in
     # analysis.
     # Inputs:
     #   - df: statistics dataframe, containing image stats from a cell data dataframe
+    #   - n_bins: if set, consecutive rows are pooled into n_bins bins, and the median over each bin of each
+    #     percentile is drawn as bands instead of every row. "auto" is 100 bins above MAX_PLOTTED_ROWS rows, and
+    #     every row otherwise.
+    #   - max_ticks: maximum number of x tick labels
     # Returns:
     #   - Figure displaying intensities info:
     #     for each cell, all channels have their 5th, 25th, 50th, 75th, and 95th percentile intensities plotted
     ############################################
 
+    # imported here so that only the plotting stages pay for loading matplotlib
+    import matplotlib.pyplot as plt
+    from matplotlib.patches import PathPatch
+    from matplotlib.path import Path
+
     # get columns containing image percentile intensities
     int_pct_cols = [col for col in df.columns if "Percentile_Intensities" in col]
     n_ch = len(int_pct_cols)
+    n_rows = df.shape[0]
 
     # make a fig and set the color palette
-    fig = plt.figure()
-    palette = ["y", "m", "b", "k"]
-
-    # loop through cells and channels - for each
-    for row_ind in range(df.shape[0]):
-        for ch in range(n_ch):
-            vals = df["Ch" + str(ch) + "_Percentile_Intensities"].iloc[row_ind]
-            # print(vals)
-            color = palette[ch]
-            plt.scatter(row_ind, vals[2], color=color, marker="o")
-            # print(vals[0])
-            # print(vals[4])
-            plt.vlines(row_ind, ymin=vals[0], ymax=vals[4], color=color)
-            for p in [0, 1, 3, 4]:
-                plt.hlines(vals[p], xmin=row_ind - 0.2, xmax=row_ind + 0.2, color=color)
+    fig, ax = plt.subplots()
+    palette = ["y", "m", "b", "k"][:n_ch]
+
+    # (row, channel, percentile)
+    vals = np.stack(
+        [
+            np.stack(df["Ch" + str(ch) + "_Percentile_Intensities"].values)
+            for ch in range(n_ch)
+        ],
+        1,
+    ).reshape(n_rows, n_ch, -1)
+
+    if n_bins == "auto":
+        n_bins = 100 if n_rows > MAX_PLOTTED_ROWS else None
+
+    if n_bins is not None and n_rows > 0:
+        # the median of each percentile over each bin of rows, drawn at the middle of the bin
+        bins = np.array_split(np.arange(n_rows), min(n_bins, n_rows))
+        x = np.array([np.mean(inds) for inds in bins])
+        binned = np.stack([np.median(vals[inds], 0) for inds in bins])
+
+        for ch, color in enumerate(palette):
+            ax.fill_between(
+                x, binned[:, ch, 0], binned[:, ch, 4], color=color, alpha=0.2
+            )
+            ax.fill_between(
+                x, binned[:, ch, 1], binned[:, ch, 3], color=color, alpha=0.4
+            )
+            ax.plot(x, binned[:, ch, 2], color=color)
 
-    plt.ylabel("Intensity")
+    else:
+        # every row, with all of the marks of a channel in one scatter and one path
+        x = np.arange(n_rows)
+
+        for ch, color in enumerate(palette):
+            ch_vals = vals[:, ch]
+
+            ax.scatter(x, ch_vals[:, 2], color=color, marker="o")
+
+            # a line from the 5th to the 95th percentile of each row, and a tick at each of the other percentiles, as
+            # (xy, end, segment)
+            segments = [np.stack([[x, ch_vals[:, 0]], [x, ch_vals[:, 4]]], 1)]
+            for p in [0, 1, 3, 4]:
+                segments.append(
+                    np.stack([[x - 0.2, ch_vals[:, p]], [x + 0.2, ch_vals[:, p]]], 1)
+                )
+            segments = np.concatenate(segments, 2).transpose(2, 1, 0)
+
+            path = Path(
+                segments.reshape(-1, 2),
+                np.tile([Path.MOVETO, Path.LINETO], segments.shape[0]),
+            )
+            # add_patch would work out the data limits segment by segment
+            ax.add_artist(
+                PathPatch(
+                    path,
+                    fill=False,
+                    edgecolor=color,
+                    linewidth=plt.rcParams["lines.linewidth"],
+                )
+            )
+            ax.update_datalim(path.vertices)
+
+        ax.autoscale_view()
+
+    ax.set_ylabel("Intensity")
     if fov_flag:
         labels = df["FOVId"]
-        plt.xlabel("FOV Id")
+        ax.set_xlabel("FOV Id")
     else:
         labels = df["CellId"]
-        plt.xlabel("Cell Id")
-    plt.xticks(ticks=range(df.shape[0]), labels=labels)
+        ax.set_xlabel("Cell Id")
+
+    ticks = get_tick_positions(n_rows, max_ticks=max_ticks)
+    rotate = len(ticks) > 10
+    ax.set_xticks(ticks)
+    ax.set_xticklabels(np.asarray(labels)[ticks], rotation=90 if rotate else 0)
 
     if title:
-        plt.title(title)
+        ax.set_title(title)
 
     # plt.ylim([0.001, 50000])
-    plt.yscale("log")
+    ax.set_yscale("log")
+
+    if rotate:
+        # make room for the rotated labels
+        fig.tight_layout()
 
     if save_path:
-        plt.savefig(save_path)
+        fig.savefig(save_path)
 
     return fig
@@ -1,8 +1,6 @@
 import os
 import pandas as pd
 import numpy as np
-import matplotlib.pyplot as plt
-from matplotlib import cm
 
 from .utils import check_input
 
@@ -38,24 +36,89 @@ def im2stats(im, channel_names=None) -> pd.DataFrame:
     return df_stats
 
 
-def plot(
+def get_profile_matrix(profiles):
+    """
+    Stacks profiles of possibly different lengths into an (n_profiles, max_length) array, padded with NaN
+
+    Returns
+    -------
+    matrix: np.array
+
+    lengths: np.array
+        length of each profile
+    """
+
+    lengths = np.array([len(profile) for profile in profiles], dtype=int)
+
+    matrix = np.full((len(profiles), max(lengths, default=0)), np.nan)
+    if len(profiles) > 0:
+        matrix[np.arange(matrix.shape[1]) < lengths[:, np.newaxis]] = np.concatenate(
+            profiles
+        )
+
+    return matrix, lengths
+
+
+def align_profiles(
     df_stats: pd.DataFrame,
-    save_dir: str,
-    suffix: str,
+    columns: list,
     normalize_intensity=True,
     center_on_channel=None,
 ):
     """
-    Plots results from im2stats by individual FOV and as a mean over FOV
+    Puts the profiles of each channel on a common z axis
 
-    Parameters
-    ----------
-    df_stats: pd.DataFrame
-        pandas dataframe from im2stats
+    Returns
+    -------
+    z_vals: np.array
+        z-position of each column of the profiles. If center_on_channel is set, the positions are relative to the
+        maximum of center_on_channel in each FOV.
+
+    profiles: np.array
+        (n_channels, n_fov, n_z) profiles of each channel (in the order of columns) and FOV, NaN where a FOV has no
+        data at a z-position
+
+    starts: np.array
+        z-position of the first slice of each FOV
+
+    lengths: np.array
+        number of slices of each FOV
     """
 
-    if not os.path.exists(save_dir):
-        os.makedirs(save_dir)
+    matrices = list()
+    for column in columns:
+        matrix, lengths = get_profile_matrix(list(df_stats[column]))
+
+        if normalize_intensity:
+            matrix = matrix - np.nanmean(matrix, 1, keepdims=True)
+            matrix = matrix / np.nanstd(matrix, 1, keepdims=True)
+
+        matrices.append(matrix)
+
+    n_fovs, max_length = matrices[0].shape
+
+    starts = np.zeros(n_fovs, dtype=int)
+    if center_on_channel:
+        center_matrix, _ = get_profile_matrix(list(df_stats[center_on_channel]))
+        starts = -np.argmax(np.nan_to_num(center_matrix, nan=-np.inf), 1)
+
+    z_min = starts.min(initial=0)
+    n_z = (starts + lengths).max(initial=0) - z_min
+
+    # shift the slices of each FOV into place
+    valid = np.arange(max_length) < lengths[:, np.newaxis]
+    rows, cols = np.nonzero(valid)
+    cols = cols + (starts - z_min)[rows]
+
+    profiles = np.full((len(columns), n_fovs, n_z), np.nan)
+    for profile, matrix in zip(profiles, matrices):
+        profile[rows, cols] = matrix[valid]
+
+    return np.arange(z_min, z_min + n_z), profiles, starts, lengths
+
+
+def get_save_paths(save_dir, suffix):
+    # the paths of the plots of the mean profiles and of the profile of each FOV
 
     if suffix:
         suffix = "_{}".format(suffix)
@@ -75,15 +138,41 @@ def plot(
     template_dict["prefix"] = "_fov"
     fov_path = template_str.format(**template_dict)
 
+    return mean_path, fov_path
+
+
+def plot(
+    df_stats: pd.DataFrame,
+    save_dir: str,
+    suffix: str,
+    normalize_intensity=True,
+    center_on_channel=None,
+):
+    """
+    Plots results from im2stats by individual FOV and as a mean over FOV
+
+    Parameters
+    ----------
+    df_stats: pd.DataFrame
+        pandas dataframe from im2stats
+    """
+
+    # imported here so that only the plotting stages pay for loading matplotlib
+    import matplotlib.pyplot as plt
+    from matplotlib import cm
+    from matplotlib.collections import LineCollection
+    from matplotlib.lines import Line2D
+
+    if not os.path.exists(save_dir):
+        os.makedirs(save_dir)
+
+    mean_path, fov_path = get_save_paths(save_dir, suffix)
+
     # make sure we only use columns that are for this feature
     columns = [c for c in df_stats.columns if c.startswith(FEATURE_NAME)]
 
-    df_stats = df_stats[columns]
-
     colors = cm.jet(np.linspace(0, 1, len(columns)))
 
-    # figure out how many points are in each plot
-
     x_label_suffix = ""
     if center_on_channel:
         x_label_suffix = " (centered to {})".format(center_on_channel)
@@ -92,77 +181,66 @@ def plot(
     if normalize_intensity:
         y_label_suffix = " (normalized)"
 
-    # create dataframe to store final z indices and intensities with a channel marker
-    df_means = pd.DataFrame(columns=["z", "intensity", "ch"])
-
-    plt.figure()
-
-    label_flag = True
-    for i, row in df_stats.iterrows():
-
-        n_pts = len(row[columns[0]])
-
-        x_pos = np.arange(0, n_pts)
-
-        if center_on_channel:
-
-            # max_ind = np.average(x_pos, weights=row[center_on_channel])
-            max_ind = np.argmax(row[center_on_channel])
-
-            x_pos = x_pos - max_ind
-
-        for color, column in zip(colors, columns):
-            v = row[column]
-
-            if normalize_intensity:
-                # v = v / np.sum(v)
-
-                v = v - np.mean(v)
-                v = v / np.std(v)
-
-            if label_flag:
-                label = column
-            else:
-                label = None
-
-            df_tmp = pd.DataFrame({"z": x_pos, "intensity": v, "ch": column})
+    # the profiles of all of the FOVs, aligned on a common z axis
+    z_vals, profiles, starts, lengths = align_profiles(
+        df_stats,
+        columns,
+        normalize_intensity=normalize_intensity,
+        center_on_channel=center_on_channel,
+    )
+
+    # plot the profile of each FOV, as one collection of lines that are drawn FOV by FOV, each channel in its color
+    fig, ax = plt.subplots()
+
+    # the column of the first slice of each FOV
+    offsets = starts - z_vals[0]
+
+    segments = [
+        np.column_stack(
+            [
+                z_vals[offset : (offset + length)],  # noqa
+                profile[i, offset : (offset + length)],  # noqa
+            ]
+        )
+        for i, (offset, length) in enumerate(zip(offsets, lengths))
+        for profile in profiles
+    ]
 
-            df_means = df_means.append(df_tmp, ignore_index=True)
-            plt.plot(x_pos, v, color=color, label=label)
+    ax.add_collection(
+        LineCollection(segments, colors=np.tile(colors, (len(offsets), 1)))
+    )
+    ax.legend(
+        handles=[
+            Line2D([], [], color=color, label=column)
+            for color, column in zip(colors, columns)
+        ]
+    )
 
-        label_flag = False
+    ax.autoscale_view()
 
-    plt.legend()
-    plt.xlabel("z-position{}".format(x_label_suffix))
-    plt.ylabel("intensity{}".format(y_label_suffix))
+    ax.set_xlabel("z-position{}".format(x_label_suffix))
+    ax.set_ylabel("intensity{}".format(y_label_suffix))
 
-    plt.savefig(fov_path)
-    plt.close()
+    fig.savefig(fov_path)
+    plt.close(fig)
 
     # make plot of means for each channel
-    plt.figure()
-    for color, ch in zip(colors, range(len(columns))):
-        df_ch = df_means[df_means["ch"].str.contains(str(ch))]
-        z_vals = np.arange(min(df_ch["z"]), max(df_ch["z"]) + 1)
+    fig, ax = plt.subplots()
 
+    for color, column, profile in zip(colors, columns, profiles):
         # get mean and standard deviation by z index
-        means = []
-        stds = []
-        for z in z_vals:
-
-            means.append(np.mean(df_ch[df_ch["z"] == z]["intensity"]))
-            stds.append(np.std(df_ch[df_ch["z"] == z]["intensity"]))
+        means = np.nanmean(profile, 0)
+        stds = np.nanstd(profile, 0)
 
         # plot mean as a solid line and shade area +- standard deviation relative to mean
-        plt.plot(z_vals, means, color=color, label=df_ch["ch"].iloc[0])
-        y1 = [means[i] - stds[i] for i in range(len(means))]
-        y2 = [means[i] + stds[i] for i in range(len(means))]
-        plt.fill_between(z_vals, y1, y2, color=color, alpha=0.1)
-    plt.legend()
-    plt.xlabel("z-position{}".format(x_label_suffix))
-    plt.ylabel("intensity{}".format(y_label_suffix))
-
-    plt.savefig(mean_path)
-    plt.close()
+        ax.plot(z_vals, means, color=color, label=column)
+        ax.fill_between(z_vals, means - stds, means + stds, color=color, alpha=0.1)
+
+    ax.legend()
+    ax.set_xlabel("z-position{}".format(x_label_suffix))
+    ax.set_ylabel("intensity{}".format(y_label_suffix))
+
+    fig.savefig(mean_path)
+    plt.close(fig)
 
     return
@@ -4,6 +4,7 @@
 from pathlib import Path
 import pytest
 
+import numpy as np
 import pandas as pd
 
 from .. import wrappers
@@ -47,3 +48,25 @@ def demo_df_stats(demo_fov_data):
         stats = wrappers.im2stats(im)
         all_stats.append(stats)
     return pd.concat(all_stats, axis=1)
+
+
+@pytest.fixture
+def make_df_stats():
+    # makes a small stats table of n_fovs FOVs, with percentile and z profile stats of different lengths
+    def make(n_fovs, proteins, seed=0):
+        rng = np.random.default_rng(seed)
+
+        rows = list()
+        for fov_id in range(n_fovs):
+            row = {
+                "FOVId": fov_id,
+                "ProteinDisplayName": proteins[fov_id % len(proteins)],
+            }
+            for ch in range(4):
+                row[f"Ch{ch}_Percentile_Intensities"] = np.sort(rng.random(5)) * 1000
+                row[f"z_intensity_profile_Ch{ch}"] = rng.random(10 + fov_id % 3)
+            rows.append(row)
+
+        return pd.DataFrame(rows)
+
+    return make
@@ -0,0 +1,203 @@
+import hashlib
+import os
+import shutil
+
+import numpy as np
+
+from ... import filesystem
+from ...data import download, quilt, synthetic
+
+
+class LocalEntry:
+    # stand-in for a quilt3.PackageEntry of a local file, that fails the first n_failures fetches
+    def __init__(self, path, file_hash=None, n_failures=0):
+        self.path = path
+        self.size = os.path.getsize(path)
+        self.hash = file_hash
+        self.n_failures = n_failures
+        self.n_fetches = 0
+
+        if self.hash is None:
+            with open(path, "rb") as f:
+                self.hash = {
+                    "type": "SHA256",
+                    "value": hashlib.sha256(f.read()).hexdigest(),
+                }
+
+    def fetch(self, dest):
+        self.n_fetches += 1
+
+        if self.n_failures > 0:
+            self.n_failures -= 1
+
+            # leave a partial file behind
+            with open(dest, "wb") as f:
+                f.write(b"partial")
+            raise OSError("connection reset")
+
+        shutil.copy(self.path, dest)
+
+
+class LocalPackage(dict):
+    # stand-in for a quilt3.Package, with a metadata.csv entry that returns the cell table
+    def __init__(self, entries, cell_data, top_hash="abc123"):
+        super().__init__(entries)
+        self["metadata.csv"] = lambda: cell_data.copy()
+        self.top_hash = top_hash
+
+
+def make_files(tmpdir, n_files=4):
+    source_paths = list()
+    for i in range(n_files):
+        source_path = str(tmpdir.join(f"source_{i}.bin"))
+        with open(source_path, "wb") as f:
+            f.write(os.urandom(1000 + i))
+        source_paths.append(source_path)
+
+    return source_paths
+
+
+def test_download_files(tmpdir):
+    source_paths = make_files(tmpdir)
+    entries = [LocalEntry(source_path) for source_path in source_paths]
+    target_paths = [
+        str(tmpdir.join("target", f"target_{i}.bin")) for i in range(len(entries))
+    ]
+
+    # one file fails once and is retried
+    entries[1].n_failures = 1
+
+    download_failures = download.download_files(
+        entries, target_paths, n_workers=2, retry_delay=0
+    )
+
+    assert len(download_failures) == 0
+    for source_path, target_path in zip(source_paths, target_paths):
+        with open(source_path, "rb") as f_source, open(target_path, "rb") as f_target:
+            assert f_source.read() == f_target.read()
+        assert not os.path.exists(target_path + download.PARTIAL_SUFFIX)
+
+    assert entries[1].n_fetches == 2
+
+    # files that are already there are not downloaded again
+    download.download_files(entries, target_paths, n_workers=2)
+    assert [entry.n_fetches for entry in entries] == [1, 2, 1, 1]
+
+
+def test_download_files_changed(tmpdir, monkeypatch):
+    source_paths = make_files(tmpdir, n_files=3)
+    entries = [LocalEntry(source_path) for source_path in source_paths]
+    target_paths = [str(tmpdir.join("target", f"target_{i}.bin")) for i in range(3)]
+
+    download.download_files(entries, target_paths)
+    assert os.path.exists(str(tmpdir.join("target", download.RECORD_NAME)))
+
+    # a new version of file 0 in the package, with the same size
+    with open(source_paths[0], "wb") as f:
+        f.write(os.urandom(1000))
+    entries[0] = LocalEntry(source_paths[0])
+
+    # a file that was downloaded before it could be recorded, which is checked by its hash instead
+    os.remove(str(tmpdir.join("target", download.RECORD_NAME)))
+    filesystem.file_index.invalidate()
+
+    download.download_files(entries, target_paths)
+    assert [entry.n_fetches for entry in entries] == [1, 1, 1]
+
+    with open(source_paths[0], "rb") as f_source, open(target_paths[0], "rb") as f:
+        assert f_source.read() == f.read()
+
+    # and once they are recorded, nothing is hashed or downloaded again
+    with monkeypatch.context() as m:
+        m.setattr(download, "file_sha256", None)
+        download.download_files(entries, target_paths)
+    assert [entry.n_fetches for entry in entries] == [1, 1, 1]
+
+    # a new version of file 1, which doesn't match its record
+    with open(source_paths[1], "wb") as f:
+        f.write(os.urandom(1001))
+    entries[1] = LocalEntry(source_paths[1])
+
+    download.download_files(entries, target_paths)
+    assert [entry.n_fetches for entry in entries] == [1, 1, 1]
+    with open(source_paths[1], "rb") as f_source, open(target_paths[1], "rb") as f:
+        assert f_source.read() == f.read()
+
+
+def test_download_files_verification(tmpdir):
+    source_paths = make_files(tmpdir, n_files=2)
+    entries = [
+        LocalEntry(source_paths[0]),
+        LocalEntry(source_paths[1], file_hash={"type": "SHA256", "value": "0" * 64}),
+    ]
+    target_paths = [str(tmpdir.join(f"target_{i}.bin")) for i in range(len(entries))]
+
+    download_failures = download.download_files(
+        entries, target_paths, max_retries=1, retry_delay=0
+    )
+
+    # the corrupt file is tried again, reported, and never appears at its target path
+    assert len(download_failures) == 1
+    assert download_failures[0]["target_path"] == target_paths[1]
+    assert entries[1].n_fetches == 2
+    assert os.path.exists(target_paths[0])
+    assert not os.path.exists(target_paths[1])
+    assert not os.path.exists(target_paths[1] + download.PARTIAL_SUFFIX)
+
+
+def test_quilt_get_data_local_package(tmpdir):
+    # a local copy of a small synthetic dataset stands in for the quilt package
+    registry_dir = str(tmpdir.join("registry"))
+    synthetic.get_data(
+        save_dir=registry_dir, n_fovs=2, protein_list=["Lamin B1"], shape=(7, 4, 16, 16)
+    )
+    cell_data = synthetic.make_cell_data(
+        registry_dir, n_fovs=2, protein_list=["Lamin B1"]
+    )
+
+    source_paths = np.unique(cell_data["SourceReadPath"])
+    entries = {
+        os.path.basename(source_path): LocalEntry(source_path)
+        for source_path in source_paths
+    }
+    cell_data["SourceReadPath"] = [
+        os.path.basename(source_path) for source_path in cell_data["SourceReadPath"]
+    ]
+    package = LocalPackage(entries, cell_data)
+
+    save_dir = str(tmpdir.join("images"))
+    cell_data, fov_data = quilt.get_data(
+        save_dir=save_dir, n_fovs=2, protein_list=["Lamin B1"], package=package
+    )
+
+    assert fov_data.shape[0] == 2
+    for source_path, target_path in zip(
+        fov_data["SourceReadPath_quilt"], fov_data["SourceReadPath"]
+    ):
+        assert target_path == f"{save_dir}/{source_path}"
+        assert os.path.getsize(target_path) == entries[source_path].size
+
+
+def test_quilt_get_metadata_cache(tmpdir):
+    cell_data = synthetic.make_cell_data(str(tmpdir), n_fovs=2)
+    cache_dir = str(tmpdir.join("cache"))
+
+    package = LocalPackage(dict(), cell_data)
+    metadata = quilt.get_metadata(package, cache_dir=cache_dir)
+    assert os.path.exists(f"{cache_dir}/metadata_{package.top_hash}.parquet")
+
+    # the cache is used while the top hash is the same, without parsing metadata.csv
+    package["metadata.csv"] = None
+    metadata_cached = quilt.get_metadata(package, cache_dir=cache_dir)
+    assert np.all(metadata_cached["CellId"] == metadata["CellId"])
+    assert metadata_cached["ProteinDisplayName"].dtype == "category"
+
+    # and not once the package changes
+    package = LocalPackage(dict(), cell_data.iloc[0:3], top_hash="def456")
+    assert quilt.get_metadata(package, cache_dir=cache_dir).shape[0] == 3
+
+    # without leaving temporary files behind
+    assert sorted(os.listdir(cache_dir)) == [
+        "metadata_abc123.parquet",
+        "metadata_def456.parquet",
+    ]
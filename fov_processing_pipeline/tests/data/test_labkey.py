@@ -0,0 +1,122 @@
+import os
+
+import numpy as np
+import pandas as pd
+
+from ...data import labkey, synthetic
+
+
+class FakeDataset:
+    def __init__(self, cell_rows):
+        self.cell_rows = cell_rows
+
+    def get_pipeline_4_production_data(self):
+        return self.cell_rows
+
+
+class FakeLabKey:
+    # offline stand-in for an lkaccess.LabKey connection, that counts the queries
+    def __init__(self, cell_rows=None, tables=None):
+        self.dataset = FakeDataset(cell_rows)
+        self.tables = tables
+        self.n_queries = 0
+
+    def select_rows_as_list(self, schema_name, query_name, **kwargs):
+        self.n_queries += 1
+        return self.tables[query_name]
+
+
+def make_labkey(n_annotations=500, seed=0):
+    rng = np.random.default_rng(seed)
+
+    cell_data = synthetic.make_cell_data("images", n_fovs=5)
+    cell_data = cell_data.drop(["CellLine"], axis=1)
+
+    cell_line_rows = [
+        {
+            "CellLineId": cell_line_id,
+            "CellLineId/Name": f"AICS-{cell_line_id}",
+            "StructureId/Name": "structure",
+            "ProteinId/Name": "protein",
+        }
+        for cell_line_id in np.unique(cell_data["CellLineId"])
+    ]
+
+    # some cells have several annotations, and some have none
+    mito_rows = [
+        {
+            "CellId": int(rng.choice(cell_data["CellId"])),
+            "MitoticStateId": 1,
+            "MitoticStateId/Name": str(rng.choice(["M0", "Mitosis", "M1", "M2"])),
+            "Complete": True,
+        }
+        for i in range(n_annotations)
+    ]
+
+    lk = FakeLabKey(
+        cell_data.to_dict("records"), {"CellLineDefinition": cell_line_rows}
+    )
+    lk_mito = FakeLabKey(tables={"MitoticAnnotation": mito_rows})
+
+    return lk, lk_mito
+
+
+def test_get_cell_data():
+    lk, lk_mito = make_labkey()
+
+    data = labkey.get_cell_data(lk=lk, lk_mito=lk_mito)
+
+    # compare with looking up every cell in the annotation table
+    mito_data = pd.DataFrame(lk_mito.tables["MitoticAnnotation"])
+    mito_binary_inds = mito_data["MitoticStateId/Name"] == "Mitosis"
+    not_mito_inds = mito_data["MitoticStateId/Name"] == "M0"
+
+    for column, mito_data_subset in [
+        ("mito_state_binary", mito_data[mito_binary_inds | not_mito_inds]),
+        ("mito_state_resolved", mito_data[~mito_binary_inds]),
+    ]:
+        mito_states = list()
+        for cellId in data["CellId"]:
+            mito_state = mito_data_subset["MitoticStateId/Name"][
+                mito_data_subset["CellId"] == cellId
+            ].values
+            mito_states.append(mito_state[0] if len(mito_state) > 0 else "u")
+
+        assert np.all(data[column] == np.array(mito_states))
+        assert np.all(
+            data[f"{column}_ind"] == np.unique(mito_states, return_inverse=True)[1]
+        )
+
+    assert np.all(data["CellLineId/Name"] == "AICS-" + data["CellLineId"].astype(str))
+
+
+def test_get_cell_data_cache(tmpdir):
+    lk, lk_mito = make_labkey()
+    cache_dir = str(tmpdir)
+
+    data = labkey.get_cell_data(lk=lk, lk_mito=lk_mito, cache_dir=cache_dir)
+    assert (lk.n_queries, lk_mito.n_queries) == (1, 1)
+
+    # the cached responses are used until they expire
+    data_cached = labkey.get_cell_data(lk=lk, lk_mito=lk_mito, cache_dir=cache_dir)
+    assert (lk.n_queries, lk_mito.n_queries) == (1, 1)
+    assert data_cached.equals(data)
+
+    labkey.get_cell_data(lk=lk, lk_mito=lk_mito, cache_dir=cache_dir, cache_expiry=0)
+    assert (lk.n_queries, lk_mito.n_queries) == (2, 2)
+
+    # the responses of another server aren't mixed up with them
+    other_lk, other_lk_mito = make_labkey(seed=1)
+    labkey.get_cell_data(
+        lk=other_lk, lk_mito=other_lk_mito, host="staging", cache_dir=cache_dir
+    )
+    assert (other_lk.n_queries, other_lk_mito.n_queries) == (1, 0)
+
+    # and no temporary files are left behind
+    assert sorted(os.listdir(cache_dir)) == [
+        "labkey_aics_mitotic_annotation.pkl",
+        "labkey_production_cell_line_definition.pkl",
+        "labkey_production_pipeline_4_production_data.pkl",
+        "labkey_staging_cell_line_definition.pkl",
+        "labkey_staging_pipeline_4_production_data.pkl",
+    ]
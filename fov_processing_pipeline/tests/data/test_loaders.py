@@ -2,7 +2,10 @@ import os
 import pytest
 import warnings
 
-from ...data import quilt, labkey
+import numpy as np
+
+from ... import wrappers
+from ...data import quilt, labkey, local, sources, synthetic
 
 REQUIRED_COLUMNS = ["ProteinDisplayName", "SourceReadPath", "FOVId", "CellLine"]
 
@@ -24,3 +27,88 @@ def test_get_data(tmpdir, data_loader):
 
     assert cell_data.shape[0] == 0
     assert fov_data.shape[0] == 0
+
+
+def test_get_synthetic_data(tmpdir):
+    protein_list = ["Lamin B1", "Fibrillarin"]
+    n_fovs = 3
+    shape = (7, 8, 32, 48)
+
+    cell_data, fov_data = synthetic.get_data(
+        save_dir=str(tmpdir), n_fovs=n_fovs, protein_list=protein_list, shape=shape
+    )
+
+    for column in REQUIRED_COLUMNS + REQUIRED_COLUMNS_CELL:
+        assert column in cell_data.columns
+
+    for column in REQUIRED_COLUMNS:
+        assert column in fov_data.columns
+
+    assert fov_data.shape[0] == len(protein_list) * n_fovs
+    assert np.all(fov_data.groupby("ProteinDisplayName").size() == n_fovs)
+
+    # the images can be loaded by the pipeline, and the DNA is brightest in the middle of the stack
+    im, _ = wrappers.row2im(fov_data.iloc[0])
+    assert im.shape == (4, shape[2], shape[3], shape[1])
+    assert 0 < np.argmax(np.mean(im[1], axis=(0, 1))) < shape[1] - 1
+
+    # the images only depend on the seed and FOVId
+    im_again = synthetic.make_fov_image(
+        shape=shape,
+        n_cells=np.sum(cell_data["FOVId"] == fov_data["FOVId"].iloc[0]),
+        seed=[0, fov_data["FOVId"].iloc[0]],
+    )
+    assert np.all(im_again[[6, 5, 1, 3]] == np.transpose(im, [0, 3, 1, 2]))
+
+
+def test_get_local_data(tmpdir):
+    protein_list = ["Lamin B1", "Fibrillarin"]
+    shape = (7, 8, 32, 48)
+
+    data_dir = str(tmpdir.mkdir("local"))
+    cell_data, fov_data = synthetic.get_data(
+        save_dir=data_dir, n_fovs=2, protein_list=protein_list, shape=shape
+    )
+
+    # a manifest with paths relative to the data directory and without any channel numbers
+    manifest = cell_data[
+        ["CellId", "FOVId", "PlateId", "ProteinDisplayName", "CellLine"]
+    ].copy()
+    manifest["SourceReadPath"] = [
+        os.path.relpath(path, data_dir) for path in cell_data["SourceReadPath"]
+    ]
+    manifest.to_csv(f"{data_dir}/manifest.csv", index=False)
+
+    # FOVs without an image are skipped
+    os.remove(fov_data["SourceReadPath"].iloc[0])
+
+    with pytest.warns(UserWarning):
+        local_cell_data, local_fov_data = sources.get_data(
+            "local", str(tmpdir), protein_list=protein_list, data_dir=data_dir
+        )
+
+    for column in REQUIRED_COLUMNS + REQUIRED_COLUMNS_CELL:
+        assert column in local_cell_data.columns
+
+    assert local_fov_data.shape[0] == fov_data.shape[0] - 1
+    assert np.all(local_fov_data["SizeZ"] == shape[1])
+    assert np.all(local_fov_data["SizeX"] == shape[3])
+
+    # the images can be loaded by the pipeline
+    im, _ = wrappers.row2im(local_fov_data.iloc[0])
+    assert im.shape == (4, shape[2], shape[3], shape[1])
+
+    # the manifest has to say which plate each FOV is on
+    manifest.drop("PlateId", axis=1).to_csv(f"{data_dir}/manifest.csv", index=False)
+    with pytest.raises(ValueError):
+        local.get_data(data_dir=data_dir)
+
+
+def test_get_cache_dir(tmpdir, monkeypatch):
+    assert sources.get_cache_dir(str(tmpdir)) == str(tmpdir)
+
+    # the same for every run, wherever its results are
+    monkeypatch.setenv("XDG_CACHE_HOME", str(tmpdir))
+    assert sources.get_cache_dir() == os.path.join(
+        str(tmpdir), "fov_processing_pipeline"
+    )
@@ -1,3 +1,4 @@
+import pytest
 import numpy as np
 import pandas as pd
 
@@ -73,3 +74,102 @@ def test_trim_data_by_cellline_fov(demo_fov_data):
     # check that trimming to a larger number of fovs leaves it untouched
     trim_df = utils.trim_data_by_cellline_fov_count(demo_multi_fov_data, 5)
     assert trim_df.shape[0] == demo_multi_fov_data.shape[0]
+
+
+def test_shard_data(demo_fov_data):
+    n_rows = 100
+    n_shards = 7
+
+    demo_multi_fov_data = pd.concat([demo_fov_data] * n_rows)
+    demo_multi_fov_data["FOVId"] = np.arange(n_rows)
+
+    shards = [
+        utils.shard_data(demo_multi_fov_data, i, n_shards) for i in range(n_shards)
+    ]
+
+    # make sure the shards are disjoint and cover all of the data
+    shard_ids = np.hstack([shard["FOVId"] for shard in shards])
+    assert len(shard_ids) == n_rows
+    assert len(np.unique(shard_ids)) == n_rows
+
+    # make sure the shards are deterministic
+    assert np.all(
+        utils.shard_data(demo_multi_fov_data, 3, n_shards)["FOVId"]
+        == shards[3]["FOVId"]
+    )
+
+    with pytest.raises(ValueError):
+        utils.shard_data(demo_multi_fov_data, n_shards, n_shards)
+
+
+def test_save_load_table(tmpdir, demo_cell_data):
+    save_path = str(tmpdir.join("cell_data.parquet"))
+
+    utils.save_table(demo_cell_data, save_path)
+    cell_data = utils.load_table(save_path)
+
+    # the index and values survive the round trip, and the types of the columns are kept
+    assert np.all(cell_data.index == demo_cell_data.index)
+    assert np.all(cell_data.columns == demo_cell_data.columns)
+    assert np.all(cell_data["FOVId"] == demo_cell_data["FOVId"])
+    assert cell_data["FOVId"].dtype == demo_cell_data["FOVId"].dtype
+
+    for column in ["ProteinDisplayName", "CellLine", "Workflow", "SourceReadPath"]:
+        assert cell_data[column].dtype == "category"
+        assert np.all(cell_data[column].astype(str) == demo_cell_data[column])
+
+    # subsets of the table only have the categories they use
+    utils.save_table(cell_data.iloc[0:1], save_path)
+    assert len(utils.load_table(save_path)["SourceReadPath"].cat.categories) == 1
+
+
+def test_trim_data_matches_loop():
+    # compare with a straightforward loop over the cell lines
+    rng = np.random.default_rng(0)
+    n_cells = 2000
+    df = pd.DataFrame(
+        {
+            "CellLine": rng.choice(["AICS-10", "AICS-13", "AICS-57"], n_cells),
+            "FOVId": rng.integers(0, 300, n_cells),
+            "CellId": rng.permutation(n_cells),
+        }
+    )
+    # every FOV is from one cell line
+    df["CellLine"] = df.groupby("FOVId")["CellLine"].transform("first")
+    df["CellLine"] = df["CellLine"].astype("category")
+
+    for n_fovs in [1, 20, 1000]:
+        keep_fov_ids = list()
+        for cell_line in pd.unique(df["CellLine"]):
+            fov_ids = np.sort(pd.unique(df["FOVId"][df["CellLine"] == cell_line]))
+            keep_fov_ids.extend(fov_ids[:n_fovs])
+
+        df_trim = utils.trim_data_by_cellline_fov_count(df, n_fovs)
+        assert df_trim.equals(df[df["FOVId"].isin(keep_fov_ids)])
+
+    # the FOV table has the first row of every FOV, in order of FOVId
+    _, FOVId_index = np.unique(df["FOVId"], return_index=True)
+    fov_data = utils.cell_data_to_fov_data(df)
+    assert fov_data.equals(df.iloc[FOVId_index].drop(["CellId"], axis=1))
+
+
+def test_clean_columns_rng():
+    from ...utils import ids2rand, int2rand
+
+    cell_data = pd.DataFrame(
+        {"CellId": np.arange(100), "FOVId": np.arange(100) // 10, "CellLineId": 3}
+    )
+
+    # the splits don't change: every *_rng column is the same as it always was
+    pcg64_data = utils.clean_columns(cell_data.copy())
+    for id_column in ["CellId", "FOVId", "CellLineId"]:
+        assert np.all(
+            pcg64_data[f"{id_column}_rng"]
+            == [int2rand(int(i)) for i in pcg64_data[id_column]]
+        )
+
+    # unless the fast hash is asked for
+    hash_data = utils.clean_columns(cell_data.copy(), rng_method="hash")
+    assert np.all(
+        hash_data["CellId_rng"] == ids2rand(cell_data["CellId"], method="hash")
+    )
@@ -0,0 +1,222 @@
+import os
+
+import numpy as np
+import pandas as pd
+
+from .. import cache, filesystem, reports, wrappers
+from ..data import utils as data_utils
+
+
+def test_get_digest(tmpdir, make_df_stats):
+    df = make_df_stats(6, ["A", "B"])
+    digest = cache.get_digest(frames=[df], params={"kind": "test"})
+
+    assert digest == cache.get_digest(frames=[df.copy()], params={"kind": "test"})
+    assert digest != cache.get_digest(frames=[df], params={"kind": "other"})
+    assert digest != cache.get_digest(frames=[df.iloc[::-1]], params={"kind": "test"})
+
+    # a change deep inside an array of a stat, which str() would abbreviate
+    profile = np.zeros(2000)
+    df_long = pd.DataFrame({"profile": [profile, profile.copy()]})
+    df_long_changed = df_long.copy()
+    df_long_changed.at[1, "profile"] = np.concatenate([profile[:-1], [1]])
+    assert cache.get_digest(frames=[df_long]) != cache.get_digest(
+        frames=[df_long_changed]
+    )
+
+    # files by their size and modification time
+    path = str(tmpdir.join("input.txt"))
+    with open(path, "w") as f:
+        f.write("a")
+    filesystem.file_index.invalidate()
+    digest = cache.get_digest(paths=[path])
+
+    with open(path, "w") as f:
+        f.write("ab")
+    filesystem.file_index.invalidate()
+    assert digest != cache.get_digest(paths=[path])
+
+
+def test_artifact_cache(tmpdir):
+    cache_path = str(tmpdir.join("cache", "test.json"))
+    output_path = str(tmpdir.join("output.png"))
+
+    artifact_cache = cache.ArtifactCache(cache_path)
+    assert not artifact_cache.is_current("plot", "digest")
+
+    with open(output_path, "w") as f:
+        f.write("plot")
+    filesystem.file_index.invalidate()
+
+    artifact_cache.update("plot", "digest", [output_path])
+    artifact_cache.save()
+
+    artifact_cache = cache.ArtifactCache(cache_path)
+    assert artifact_cache.is_current("plot", "digest")
+    assert not artifact_cache.is_current("plot", "other digest")
+
+    # the artifact is made again if its files are gone
+    filesystem.file_index.remove(output_path)
+    assert not artifact_cache.is_current("plot", "digest")
+
+
+def test_stats2plots_cache(tmpdir, make_df_stats):
+    parent_dir = str(tmpdir)
+    plot_dir = f"{parent_dir}/{wrappers.QC_DIR}/plots"
+
+    df_stats = make_df_stats(12, ["A", "B", "C"])
+    wrappers.stats2plots.run(df_stats, parent_dir)
+
+    plot_paths = [
+        os.path.join(root, filename)
+        for root, _, filenames in os.walk(plot_dir)
+        for filename in filenames
+    ]
+    for plot_path in plot_paths:
+        os.utime(plot_path, ns=(0, 0))
+
+    def get_changed():
+        return {
+            os.path.relpath(plot_path, plot_dir)
+            for plot_path in plot_paths
+            if os.stat(plot_path).st_mtime_ns != 0
+        }
+
+    # nothing changed, so nothing is made again
+    filesystem.file_index.invalidate()
+    wrappers.stats2plots.run(df_stats, parent_dir)
+    assert get_changed() == set()
+
+    # an FOV of protein B was added, so only B's plots (and the PCA of all of them) are made again
+    df_stats = pd.concat(
+        [df_stats, make_df_stats(14, ["A", "B", "C"], seed=1).iloc[[13]]],
+        ignore_index=True,
+    )
+    filesystem.file_index.invalidate()
+    wrappers.stats2plots.run(df_stats, parent_dir)
+
+    changed = get_changed()
+    assert "fov_stats_B.png" in changed
+    assert "z_intensity_profile/z_intensity_profile_mean_B.png" in changed
+    assert "PCA_PCs.png" in changed
+    assert "fov_stats_A.png" not in changed
+    assert "z_intensity_profile_uncentered/z_intensity_profile_fov_C.png" not in changed
+
+    # unless overwrite
+    for plot_path in plot_paths:
+        os.utime(plot_path, ns=(0, 0))
+    filesystem.file_index.invalidate()
+    wrappers.stats2plots.run(df_stats, parent_dir, overwrite=True)
+    assert len(get_changed()) == len(plot_paths)
+
+    # a sync that only removed an FOV has no proteins to remake, but the PCA of all of the FOVs changed
+    for plot_path in plot_paths:
+        os.utime(plot_path, ns=(0, 0))
+    filesystem.file_index.invalidate()
+    wrappers.stats2plots.run(df_stats.iloc[1:], parent_dir, proteins=[])
+    assert "PCA_PCs.png" in get_changed()
+    assert "fov_stats_A.png" not in get_changed()
+
+
+def test_stats2plots_pca_from_files(tmpdir, monkeypatch, make_df_stats):
+    import pickle
+
+    from .. import postprocess
+    from ..stats import pca
+
+    parent_dir = str(tmpdir)
+    plot_dir = f"{parent_dir}/{wrappers.QC_DIR}/plots"
+
+    # the stats in the files, with different numbers of z slices
+    df_raw = make_df_stats(12, ["A", "B"]).drop(["FOVId", "ProteinDisplayName"], axis=1)
+    for ch in range(4):
+        df_raw[f"Ch{ch}_mean_by_z"] = [np.arange(9 + i % 3) + ch for i in range(12)]
+        df_raw[f"Ch{ch}_std_by_z"] = [np.ones(9 + i % 3) for i in range(12)]
+
+    stats_paths = list()
+    for i in range(df_raw.shape[0]):
+        stats_path = str(tmpdir.join(f"stats_{i}.pkl"))
+        with open(stats_path, "wb") as f:
+            pickle.dump(df_raw.iloc[[i]].reset_index(drop=True), f)
+        stats_paths.append(stats_path)
+
+    # and as they are after load_stats and qc_stats
+    df_stats = df_raw.copy()
+    df_stats["FOVId"] = np.arange(12)
+    df_stats["FOVId_rng"] = np.linspace(0, 1, 12)
+    df_stats["ProteinDisplayName"] = ["A", "B"] * 6
+    df_stats = postprocess.zsize_qc(postprocess.fov_qc(df_stats))
+
+    # the FOVs in a different order than the stats
+    fov_data = df_stats[["FOVId", "ProteinDisplayName"]].iloc[::-1]
+    stats_paths = stats_paths[::-1]
+
+    wrappers.stats2plots.run(df_stats, parent_dir)
+    in_memory_model = pca.load_model(f"{plot_dir}/PCA_model.pkl")
+
+    # too big to fit in memory
+    monkeypatch.setattr(pca, "MAX_FULL_PCA_SIZE", 0)
+    wrappers.stats2plots.run(
+        df_stats, parent_dir, fov_data=fov_data, stats_paths=stats_paths
+    )
+
+    model = pca.load_model(f"{plot_dir}/PCA_model.pkl")
+    assert model["pca_method"] == "incremental"
+    assert not os.path.exists(f"{plot_dir}/PCA_features.npy")
+
+    # the same features as the PCA of the stats in memory, without the IDs, random numbers and QC flags
+    assert model["feature_names"] == in_memory_model["feature_names"]
+    assert "FOVId_rng" not in model["feature_names"]
+    assert "QC" not in model["feature_names"]
+
+    df_projections = pd.read_parquet(f"{plot_dir}/PCA_projections.parquet")
+    assert list(df_projections.FOVId) == list(df_stats.FOVId)
+
+    # the PCA is made again when a stats file changes
+    os.utime(f"{plot_dir}/PCA_PCs.png", ns=(0, 0))
+    os.utime(stats_paths[0], ns=(0, 0))
+    wrappers.stats2plots.run(
+        df_stats, parent_dir, fov_data=fov_data, stats_paths=stats_paths
+    )
+    assert os.stat(f"{plot_dir}/PCA_PCs.png").st_mtime_ns != 0
+
+
+def test_summary_table_cache(tmpdir):
+    from .test_reports import make_cell_data
+
+    parent_dir = str(tmpdir)
+    summary_path = f"{parent_dir}/{wrappers.QC_DIR}/summary.csv"
+    counts_dir = f"{parent_dir}/{wrappers.QC_DIR}/{wrappers.SUMMARY_COUNTS_DIR}"
+
+    cell_data = make_cell_data(300)
+    wrappers.cell_data_to_summary_table.run(cell_data, summary_path)
+
+    counts_paths = [f"{counts_dir}/plate_{plate_id}.parquet" for plate_id in range(3)]
+    for path in counts_paths + [summary_path]:
+        os.utime(path, ns=(0, 0))
+
+    # nothing changed
+    filesystem.file_index.invalidate()
+    wrappers.cell_data_to_summary_table.run(cell_data, summary_path)
+    assert os.stat(summary_path).st_mtime_ns == 0
+
+    # cells were added to plate 1, so only its counts are counted again
+    new_cells = make_cell_data(40, seed=1)
+    new_cells = new_cells[new_cells.PlateId == 1]
+    cell_data = data_utils.set_column_types(
+        pd.concat([cell_data, new_cells], ignore_index=True)
+    )
+
+    filesystem.file_index.invalidate()
+    wrappers.cell_data_to_summary_table.run(cell_data, summary_path)
+
+    assert [os.stat(path).st_mtime_ns != 0 for path in counts_paths] == [
+        False,
+        True,
+        False,
+    ]
+
+    summary_table = pd.read_csv(summary_path, index_col=0)
+    assert summary_table["#cells"].sum() == cell_data.shape[0]
+    with open(summary_path) as f:
+        assert f.read() == reports.cell_data_to_summary_table(cell_data).to_csv()
@@ -0,0 +1,99 @@
+import errno
+import threading
+import time
+
+import pytest
+
+from .. import failures
+
+
+def test_call_with_retries():
+    n_calls = list()
+
+    def flaky():
+        n_calls.append(1)
+        if len(n_calls) < 3:
+            raise OSError(errno.EIO, "Input/output error")
+        return "done"
+
+    # make sure we keep trying on transient errors
+    assert failures.call_with_retries(flaky, max_retries=2, retry_delay=0) == "done"
+    assert len(n_calls) == 3
+
+    # make sure we give up after max_retries
+    n_calls.clear()
+    with pytest.raises(OSError):
+        failures.call_with_retries(flaky, max_retries=1, retry_delay=0)
+    assert len(n_calls) == 2
+
+    # make sure non-transient errors are raised right away
+    n_calls.clear()
+
+    def broken():
+        n_calls.append(1)
+        raise ValueError("corrupt")
+
+    with pytest.raises(ValueError):
+        failures.call_with_retries(broken, max_retries=5, retry_delay=0)
+    assert len(n_calls) == 1
+
+    # or errors of the filesystem that won't go away
+    n_calls.clear()
+
+    def missing():
+        n_calls.append(1)
+        raise FileNotFoundError(errno.ENOENT, "No such file or directory")
+
+    with pytest.raises(FileNotFoundError):
+        failures.call_with_retries(missing, max_retries=5, retry_delay=0)
+    assert len(n_calls) == 1
+
+
+def test_is_transient_error():
+    assert failures.is_transient_error(OSError(errno.ESTALE, "Stale file handle"))
+    assert failures.is_transient_error(TimeoutError("timed out"))
+    assert failures.is_transient_error(ConnectionResetError())
+    assert not failures.is_transient_error(
+        PermissionError(errno.EACCES, "Permission denied")
+    )
+    assert not failures.is_transient_error(
+        NotADirectoryError(errno.ENOTDIR, "Not a directory")
+    )
+    assert not failures.is_transient_error(ValueError("corrupt"))
+    assert failures.is_transient_error(ValueError("corrupt"), (Exception,))
+
+
+def test_run_with_timeout():
+    assert failures.run_with_timeout(lambda x: x + 1, 1, 1) == 2
+
+    with pytest.raises(TimeoutError):
+        failures.run_with_timeout(time.sleep, 0.01, 1)
+
+    # the thread that was left running is handed back
+    release = threading.Event()
+    abandoned = list()
+    with pytest.raises(TimeoutError):
+        failures.run_with_timeout(release.wait, 0.01, abandoned=abandoned)
+
+    assert len(abandoned) == 1 and abandoned[0].is_alive()
+    release.set()
+    abandoned[0].join()
+
+
+def test_is_resource_error():
+    assert failures.is_resource_error(MemoryError())
+    assert failures.is_resource_error(OSError(errno.ENOSPC, "No space left on device"))
+    assert not failures.is_resource_error(OSError(errno.EIO, "Input/output error"))
+    assert not failures.is_resource_error(ValueError("corrupt"))
+
+
+def test_save_load_failures(tmpdir):
+    failure_paths = ["{}/failed_{}.json".format(tmpdir, i) for i in range(3)]
+
+    failures.save_failure(failure_paths[1], 1, ValueError("corrupt"))
+
+    df_failures = failures.load_failures(failure_paths)
+
+    assert df_failures.shape[0] == 1
+    assert df_failures["FOVId"].iloc[0] == 1
+    assert df_failures["exception"].iloc[0] == "ValueError"
@@ -0,0 +1,122 @@
+import os
+import threading
+
+from ..filesystem import FileIndex
+
+
+def test_file_index(tmpdir):
+    plate_dir = f"{tmpdir}/plate_1"
+    os.makedirs(plate_dir)
+    with open(f"{plate_dir}/stats_1.pkl", "wb") as f:
+        f.write(b"1234")
+
+    file_index = FileIndex()
+
+    assert file_index.exists(f"{plate_dir}/stats_1.pkl")
+    assert not file_index.exists(f"{plate_dir}/stats_2.pkl")
+    assert file_index.getsize(f"{plate_dir}/stats_1.pkl") == 4
+    assert file_index.getsize(f"{plate_dir}/stats_2.pkl") is None
+    assert not file_index.exists(f"{tmpdir}/plate_2/stats_3.pkl")
+
+    # the listing is cached, so files written behind its back aren't seen
+    open(f"{plate_dir}/stats_2.pkl", "w").close()
+    assert not file_index.exists(f"{plate_dir}/stats_2.pkl")
+
+    # until they are added, or the directory is listed again
+    file_index.add(f"{plate_dir}/stats_2.pkl")
+    assert file_index.exists(f"{plate_dir}/stats_2.pkl")
+    assert file_index.getsize(f"{plate_dir}/stats_2.pkl") == 0
+
+    open(f"{plate_dir}/stats_4.pkl", "w").close()
+    file_index.invalidate(plate_dir)
+    assert file_index.exists(f"{plate_dir}/stats_4.pkl")
+
+    file_index.remove(f"{plate_dir}/stats_4.pkl")
+    assert not file_index.exists(f"{plate_dir}/stats_4.pkl")
+    assert not os.path.exists(f"{plate_dir}/stats_4.pkl")
+
+    # directories that didn't exist when they were listed
+    file_index.makedirs(f"{tmpdir}/plate_2")
+    assert os.path.isdir(f"{tmpdir}/plate_2")
+    file_index.add(f"{tmpdir}/plate_2/stats_3.pkl")
+    assert file_index.exists(f"{tmpdir}/plate_2/stats_3.pkl")
+    assert sorted(file_index.listdir(plate_dir)) == ["stats_1.pkl", "stats_2.pkl"]
+
+
+def test_file_index_stale(tmpdir):
+    plate_dir = f"{tmpdir}/qc/plate_1"
+    os.makedirs(plate_dir)
+    stats_path = f"{plate_dir}/stats_1.pkl"
+    with open(stats_path, "wb") as f:
+        f.write(b"1234")
+
+    file_index = FileIndex()
+    assert file_index.getmtime_ns(stats_path) is not None
+
+    # rewritten by another process, which the size and modification time follow
+    with open(stats_path, "wb") as f:
+        f.write(b"12345678")
+    os.utime(stats_path, ns=(0, 0))
+    assert file_index.getsize(stats_path) == 8
+    assert file_index.getmtime_ns(stats_path) == 0
+
+    # deleted by another process
+    os.remove(stats_path)
+    assert file_index.stat(stats_path) is None
+    assert not file_index.exists(stats_path)
+
+    # the listings of the directories in an invalidated directory are forgotten too
+    open(stats_path, "w").close()
+    file_index.invalidate(f"{tmpdir}/qc")
+    assert file_index.exists(stats_path)
+
+
+def test_file_index_start_run(tmpdir):
+    plate_dir = f"{tmpdir}/plate_1"
+    os.makedirs(plate_dir)
+
+    file_index = FileIndex()
+    file_index.start_run("run_1")
+    assert not file_index.exists(f"{plate_dir}/proj_1.png")
+
+    # the FOVs of a run share the listing
+    open(f"{plate_dir}/proj_1.png", "w").close()
+    file_index.start_run("run_1")
+    assert not file_index.exists(f"{plate_dir}/proj_1.png")
+
+    # and it is listed again in the next run
+    file_index.start_run("run_2")
+    assert file_index.exists(f"{plate_dir}/proj_1.png")
+
+
+def test_file_index_makedirs_threads(tmpdir, monkeypatch):
+    index = FileIndex()
+    directory = str(tmpdir.join("new"))
+    path = os.path.join(directory, "a.txt")
+
+    # a thread that is slow to make the directory, while another one makes it and writes a file to it
+    made, added = threading.Event(), threading.Event()
+    makedirs = os.makedirs
+
+    def slow_makedirs(*args, **kwargs):
+        makedirs(*args, **kwargs)
+        if threading.current_thread() is not threading.main_thread():
+            made.set()
+            added.wait(10)
+
+    monkeypatch.setattr(os, "makedirs", slow_makedirs)
+
+    thread = threading.Thread(target=index.makedirs, args=(directory,))
+    thread.start()
+    made.wait(10)
+
+    index.makedirs(directory)
+    with open(path, "w") as f:
+        f.write("a")
+    index.add(path)
+
+    added.set()
+    thread.join()
+
+    # the slow thread doesn't forget the file
+    assert index.exists(path)
@@ -2,7 +2,10 @@ from .. import utils
 from aicsimageio import writers
 import os
 import numpy as np
+import pytest
+from PIL import Image
 
+from fov_processing_pipeline import filesystem
 from fov_processing_pipeline.reports import im2bigim
 
 
@@ -30,3 +33,152 @@ def test_im2bigim(tmpdir, demo_fov_data, demo_row_image):
         os.makedirs(bigim_dir)
 
     im2bigim(im_paths, im_ids, labels, bigim_dir)
+
+
+def test_im2bigim_layout(tmpdir):
+    rng = np.random.default_rng(0)
+
+    # images of two different sizes, and one that is missing
+    ims = list()
+    im_paths = list()
+    for i in range(7):
+        im = rng.integers(0, 200, size=(50 if i != 3 else 40, 60, 3), dtype="uint8")
+        im_path = "{}/proj_{}.png".format(tmpdir, i)
+        Image.fromarray(im).save(im_path)
+
+        ims.append(im)
+        im_paths.append(im_path)
+
+    im_paths.append("{}/proj_missing.png".format(tmpdir))
+
+    bigim_dir = str(tmpdir.mkdir("bigim"))
+
+    im2bigim(
+        im_paths,
+        np.arange(8),
+        ["A"] * 8,
+        bigim_dir,
+        nwide=3,
+        ndeep=2,
+        memmap_dir=tmpdir,
+    )
+
+    # 7 images, 3 per row and 2 rows per page
+    page_0 = np.asarray(Image.open("{}/diagnostics_A_0.png".format(bigim_dir)))
+    page_1 = np.asarray(Image.open("{}/diagnostics_A_1.png".format(bigim_dir)))
+
+    assert page_0.shape == (100, 180, 3)
+    assert page_1.shape == (50, 180, 3)
+
+    # each image is in its place (away from its label), and the smaller one is padded
+    assert np.all(page_0[50 + 30 : 50 + 40, 40:60] == ims[3][30:, 40:])  # noqa
+    assert np.all(page_0[50 + 40 : 100, 0:60] == 0)  # noqa
+    assert np.all(page_0[50 + 30 : 100, 60 + 40 : 120] == ims[4][30:, 40:])  # noqa
+    assert np.all(page_1[30:, 40:60] == ims[6][30:, 40:])
+    assert np.all(page_1[:, 60:] == 0)
+
+    # the memory mapped pages are removed once they are saved
+    assert not any(f.endswith(".canvas") for f in os.listdir(str(tmpdir)))
+
+
+def test_im2bigim_parallel_and_skip(tmpdir):
+    rng = np.random.default_rng(1)
+
+    im_paths = list()
+    for i in range(10):
+        im = rng.integers(0, 200, size=(30, 40, 3), dtype="uint8")
+        im_path = "{}/proj_{}.png".format(tmpdir, i)
+        Image.fromarray(im).save(im_path)
+
+        im_paths.append(im_path)
+
+    labels = ["A"] * 6 + ["B"] * 4
+
+    serial_dir = str(tmpdir.mkdir("serial"))
+    parallel_dir = str(tmpdir.mkdir("parallel"))
+
+    im2bigim(im_paths, np.arange(10), labels, serial_dir, nwide=2, ndeep=2)
+    im2bigim(
+        im_paths,
+        np.arange(10),
+        labels,
+        parallel_dir,
+        nwide=2,
+        ndeep=2,
+        n_workers=2,
+        max_bytes=30 * 80 * 3 * 4,
+    )
+
+    page_names = sorted(f for f in os.listdir(serial_dir) if f.endswith(".png"))
+    assert page_names == [
+        "diagnostics_A_0.png",
+        "diagnostics_A_1.png",
+        "diagnostics_B_0.png",
+    ]
+
+    for page_name in page_names:
+        assert np.all(
+            np.asarray(Image.open("{}/{}".format(serial_dir, page_name)))
+            == np.asarray(Image.open("{}/{}".format(parallel_dir, page_name)))
+        )
+
+    def page_mtimes():
+        return {
+            page_name: os.stat("{}/{}".format(serial_dir, page_name)).st_mtime_ns
+            for page_name in page_names
+        }
+
+    # nothing changed, so nothing is rendered again
+    for page_name in page_names:
+        os.utime("{}/{}".format(serial_dir, page_name), ns=(0, 0))
+
+    im2bigim(
+        im_paths, np.arange(10), labels, serial_dir, nwide=2, ndeep=2, overwrite=False
+    )
+    assert all(mtime == 0 for mtime in page_mtimes().values())
+
+    # only the page with the changed image is
+    os.utime(im_paths[5], ns=(10 ** 9, 10 ** 9))
+    filesystem.file_index.invalidate()
+
+    im2bigim(
+        im_paths, np.arange(10), labels, serial_dir, nwide=2, ndeep=2, overwrite=False
+    )
+    mtimes = page_mtimes()
+    assert mtimes["diagnostics_A_0.png"] == 0
+    assert mtimes["diagnostics_A_1.png"] != 0
+    assert mtimes["diagnostics_B_0.png"] == 0
+
+    # pages beyond the new number of pages are removed
+    im2bigim(
+        im_paths[:8],
+        np.arange(8),
+        ["A"] * 8,
+        serial_dir,
+        nwide=2,
+        ndeep=2,
+        overwrite=False,
+    )
+    assert not os.path.exists("{}/diagnostics_A_2.png".format(serial_dir))
+
+
+def test_make_canvas(tmpdir):
+    from fov_processing_pipeline.reports.im2bigim import make_canvas
+
+    # the file of a memory mapped page is there for as long as the page is used
+    with make_canvas((4, 5, 3), memmap_dir=str(tmpdir)) as canvas:
+        canvas[1, 2] = 7
+        canvas.flush()
+
+        (canvas_name,) = os.listdir(str(tmpdir))
+        with open(str(tmpdir.join(canvas_name)), "rb") as f:
+            assert f.read()[(1 * 5 + 2) * 3] == 7
+
+    assert os.listdir(str(tmpdir)) == []
+
+    # and removed even if rendering fails
+    with pytest.raises(ValueError):
+        with make_canvas((4, 5, 3), memmap_dir=str(tmpdir)):
+            raise ValueError("corrupt")
+
+    assert os.listdir(str(tmpdir)) == []
@@ -0,0 +1,26 @@
+import subprocess
+import sys
+
+import pytest
+
+# dependencies that only some stages need, and should only be loaded by those stages
+HEAVY_MODULES = ["matplotlib", "sklearn", "quilt3", "lkaccess", "aicsimageio"]
+
+
+@pytest.mark.parametrize(
+    "module", ["fov_processing_pipeline.wrappers", "fov_processing_pipeline.bin.process"]
+)
+def test_lazy_imports(module):
+    code = "import sys; import {}; print(' '.join(sys.modules))".format(module)
+
+    output = subprocess.run(
+        [sys.executable, "-c", code],
+        check=True,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE,
+        universal_newlines=True,
+    )
+    loaded_modules = output.stdout.split()
+
+    for heavy_module in HEAVY_MODULES:
+        assert heavy_module not in loaded_modules
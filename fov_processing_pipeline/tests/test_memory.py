@@ -0,0 +1,106 @@
+import threading
+import time
+
+import numpy as np
+from aicsimageio import writers
+
+from .. import memory
+
+
+def test_estimate_fov_memory(tmpdir):
+    im = np.zeros([1, 4, 5, 30, 20], dtype="uint16")
+
+    im_path = "{}/tmp_im.ome.tiff".format(tmpdir)
+    with writers.OmeTiffWriter(im_path, overwrite_file=True) as writer:
+        writer.save(im, dimension_order="TCZYX")
+
+    dims, dtype = memory.read_image_header(im_path)
+
+    assert dims["C"] == 4
+    assert dims["Z"] == 5
+    assert dims["Y"] == 30
+    assert dims["X"] == 20
+    assert dtype == np.uint16
+
+    # must be at least as big as the image itself
+    assert memory.estimate_fov_memory(im_path) >= im.nbytes
+
+
+def test_get_memory_class():
+    memory_classes = memory.get_memory_classes(16e9)
+
+    assert memory_classes == [2e9, 4e9, 8e9, 16e9]
+
+    assert memory.get_memory_class(1, memory_classes) == 2e9
+    assert memory.get_memory_class(5e9, memory_classes) == 8e9
+    assert memory.get_memory_class(8e9, memory_classes) == 8e9
+
+    # things that are too big go in the biggest class
+    assert memory.get_memory_class(100e9, memory_classes) == 16e9
+
+
+def test_memory_budget():
+    budget = memory.MemoryBudget(10)
+
+    n_bytes_used = list()
+
+    def work(n_bytes):
+        with budget.reserve(n_bytes):
+            n_bytes_used.append(budget.n_bytes_used)
+            time.sleep(0.01)
+
+    # the 20 byte job is bigger than the whole budget, so it should run alone
+    threads = [threading.Thread(target=work, args=(n,)) for n in [4, 4, 4, 20, 6]]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert len(n_bytes_used) == len(threads)
+    assert np.max(n_bytes_used) <= 10
+    assert budget.n_bytes_used == 0
+
+    # no budget means no waiting
+    with memory.MemoryBudget().reserve(100):
+        pass
+
+
+def test_memory_budget_hold_for():
+    budget = memory.MemoryBudget(10)
+
+    # a thread that was started in the context and is still running keeps the bytes
+    release = threading.Event()
+    thread = threading.Thread(target=release.wait)
+
+    hold_for = list()
+    with budget.reserve(6, hold_for=hold_for):
+        thread.start()
+        hold_for.append(thread)
+
+    assert budget.n_bytes_used == 6
+
+    release.set()
+    thread.join()
+    for _ in range(100):
+        if budget.n_bytes_used == 0:
+            break
+        time.sleep(0.01)
+
+    assert budget.n_bytes_used == 0
+
+
+def test_reservation_split():
+    budget = memory.MemoryBudget(10)
+
+    with budget.reserve(6) as reservation:
+        write_reservation = reservation.split(4)
+        assert write_reservation.n_bytes == 4
+
+        # can't take more than is left
+        assert reservation.split(8).n_bytes == 2
+
+    # the split bytes are held until they are released
+    assert budget.n_bytes_used == 6
+
+    write_reservation.release()
+    assert budget.n_bytes_used == 2
@@ -0,0 +1,84 @@
+import os
+import pickle
+import threading
+
+import pytest
+
+from ..output import OutputWriter, write_pickle
+
+
+def write_fail(path, obj):
+    with open(path, "w") as f:
+        f.write("half of a file")
+
+    raise OSError("disk full")
+
+
+def test_output_writer(tmpdir):
+    writer = OutputWriter(n_workers=2)
+
+    records = list()
+    writer.submit(
+        [("stats_write", f"{tmpdir}/stats.pkl", write_pickle, {"a": 1})],
+        records=records,
+        FOVId=1,
+    )
+    writer.flush()
+
+    with open(f"{tmpdir}/stats.pkl", "rb") as f:
+        assert pickle.load(f) == {"a": 1}
+
+    assert records[0]["stage"] == "stats_write"
+    assert records[0]["FOVId"] == 1
+
+    # if a file of a group fails, the rest of the group is removed, and nothing half-written is left behind
+    writer.submit(
+        [
+            ("stats_write", f"{tmpdir}/stats_2.pkl", write_pickle, {"a": 2}),
+            ("png_write", f"{tmpdir}/proj_2.png", write_fail, None),
+        ]
+    )
+    with pytest.raises(OSError):
+        writer.flush()
+
+    assert sorted(os.listdir(tmpdir)) == ["stats.pkl"]
+
+    # unless the error is handled
+    errors = list()
+    writer.submit(
+        [("png_write", f"{tmpdir}/proj_3.png", write_fail, None)],
+        on_error=errors.append,
+    )
+    writer.flush()
+
+    assert len(errors) == 1
+
+
+def test_output_writer_backpressure(tmpdir):
+    writer = OutputWriter(n_workers=2, max_bytes=10)
+
+    release = threading.Event()
+
+    def write_slow(path, obj):
+        release.wait()
+        write_pickle(path, obj)
+
+    writer.submit([("stats_write", f"{tmpdir}/1.pkl", write_slow, 1)], n_bytes=8)
+
+    # the second write doesn't fit in the budget, so it has to wait for the first
+    second = threading.Thread(
+        target=writer.submit,
+        args=([("stats_write", f"{tmpdir}/2.pkl", write_pickle, 2)],),
+        kwargs={"n_bytes": 8},
+    )
+    second.start()
+    second.join(timeout=0.2)
+    assert second.is_alive()
+
+    release.set()
+    second.join(timeout=5)
+    assert not second.is_alive()
+
+    writer.flush()
+    assert writer.n_bytes_queued == 0
+    assert os.path.exists(f"{tmpdir}/2.pkl")
@@ -0,0 +1,96 @@
+import json
+import os
+import time
+
+import numpy as np
+
+from .. import profiling
+
+
+def test_measure():
+    records = list()
+
+    with profiling.measure("sleep", records, FOVId=1):
+        time.sleep(0.01)
+
+    assert len(records) == 1
+    assert records[0]["stage"] == "sleep"
+    assert records[0]["FOVId"] == 1
+    assert records[0]["wall_time"] >= 0.01
+
+    for metric in profiling.METRICS:
+        assert metric in records[0]
+
+    # make sure a stage is recorded even if it fails
+    try:
+        with profiling.measure("fail", records):
+            raise ValueError
+    except ValueError:
+        pass
+
+    assert records[-1]["stage"] == "fail"
+
+
+def test_profiled():
+    @profiling.profiled
+    def my_stage(x):
+        return x + 1
+
+    assert my_stage(1) == 2
+
+    records = profiling.pop_task_records()
+    assert len(records) == 1
+    assert records[0]["stage"] == "my_stage"
+    assert profiling.pop_task_records() is None
+
+
+def test_attach_records():
+    from prefect import Flow, task
+
+    @task(state_handlers=[profiling.attach_records])
+    @profiling.profiled
+    def my_stage(x):
+        return x + 1
+
+    with Flow("test") as flow:
+        results = my_stage.map([1, 2, 3])
+
+    state = flow.run()
+
+    # the results are unchanged, and the records come back in the states
+    assert state.result[results].result == [2, 3, 4]
+
+    records = profiling.get_state_records(state.result[results])
+    assert [record["stage"] for record in records] == ["my_stage"] * 3
+
+
+def test_save_report(tmpdir):
+    records = list()
+    for fov_id in range(10):
+        for stage in ["row2im", "im2stats"]:
+            with profiling.measure(stage, records, FOVId=fov_id):
+                time.sleep(0.05 * (fov_id == 7))
+
+    with profiling.measure("load_stats", records):
+        pass
+
+    report = profiling.save_report(records, str(tmpdir), run_wall_time=1.0)
+
+    for file_name in [
+        "performance.json",
+        "performance.html",
+        "performance_records.csv",
+    ]:
+        assert os.path.exists("{}/{}".format(tmpdir, file_name))
+
+    with open("{}/performance.json".format(tmpdir), "r") as f:
+        assert json.load(f) == report
+
+    assert report["stages"]["row2im"]["count"] == 10
+    assert report["stages"]["load_stats"]["count"] == 1
+
+    # FOV 7 was the slow one
+    assert list(report["slowest_fovs"])[0] == "7"
+
+    df_summary = profiling.summarize(profiling.pd.DataFrame(records))
+    assert np.all(df_summary["wall_time_p50"] <= df_summary["wall_time_max"])
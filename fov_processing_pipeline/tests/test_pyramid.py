@@ -0,0 +1,132 @@
+import os
+
+import numpy as np
+from PIL import Image
+
+from fov_processing_pipeline import filesystem, utils
+from fov_processing_pipeline.reports import im2pyramid
+from fov_processing_pipeline.reports import pyramid
+
+
+def read_level(files_dir, level, width, height, max_level, tile_size):
+    # stitches the tiles of a level back together
+    level_y, level_x = pyramid.get_level_shape(width, height, level, max_level)
+
+    im = np.zeros((level_y, level_x, 3), dtype="uint8")
+    for row in range(int(np.ceil(level_y / tile_size))):
+        for column in range(int(np.ceil(level_x / tile_size))):
+            tile = np.asarray(
+                Image.open(pyramid.get_tile_path(files_dir, level, column, row))
+            )
+            y, x = row * tile_size, column * tile_size
+            im[y : (y + tile.shape[0]), x : (x + tile.shape[1])] = tile  # noqa
+
+    return im
+
+
+def write_images(tmpdir, n, seed):
+    rng = np.random.default_rng(seed)
+
+    im_paths = list()
+    for i in range(n):
+        im = rng.integers(0, 200, size=(30, 50, 3), dtype="uint8")
+        im_path = "{}/proj_{}.png".format(tmpdir, i)
+        Image.fromarray(im).save(im_path)
+
+        im_paths.append(im_path)
+
+    return im_paths
+
+
+def test_im2pyramid(tmpdir):
+    im_paths = write_images(tmpdir, 7, 0)
+
+    save_dir = str(tmpdir.mkdir("pyramid"))
+    im2pyramid(im_paths, np.arange(7), ["A"] * 7, save_dir, nwide=3, tile_size=32)
+
+    # 3 x 3 images of 50 x 30
+    width, height = 150, 90
+    max_level = pyramid.get_max_level(width, height)
+    assert max_level == 8
+
+    files_dir = "{}/A_files".format(save_dir)
+    full = read_level(files_dir, max_level, width, height, max_level, 32)
+
+    # each image is in its place (away from its ID), and the empty spots are black
+    im_4 = np.asarray(Image.open(im_paths[4]))
+    assert np.all(full[30 + 25 : 60, 50 + 30 : 100] == im_4[25:, 30:])  # noqa
+    assert np.all(full[60:, 50:] == 0)
+
+    # each level is the one above it at half the size
+    above = full
+    for level in range(max_level - 1, -1, -1):
+        im = read_level(files_dir, level, width, height, max_level, 32)
+        assert np.all(im == utils.downsample(above))
+
+        above = im
+
+    assert above.shape == (1, 1, 3)
+
+    assert os.path.exists("{}/A.dzi".format(save_dir))
+    with open("{}/index.html".format(save_dir)) as f:
+        assert '"A_files"' in f.read()
+
+
+def test_im2pyramid_update(tmpdir):
+    im_paths = write_images(tmpdir, 12, 1)
+    labels = ["A"] * 12
+
+    save_dir = str(tmpdir.mkdir("pyramid"))
+    im2pyramid(im_paths, np.arange(12), labels, save_dir, nwide=4, tile_size=32)
+
+    files_dir = "{}/A_files".format(save_dir)
+    tile_paths = [
+        "{}/{}/{}".format(files_dir, level, filename)
+        for level in os.listdir(files_dir)
+        for filename in os.listdir("{}/{}".format(files_dir, level))
+    ]
+    for tile_path in tile_paths:
+        os.utime(tile_path, ns=(0, 0))
+
+    # only the tiles that show the changed image are rendered again
+    Image.fromarray(np.full((30, 50, 3), 255, dtype="uint8")).save(im_paths[0])
+    filesystem.file_index.invalidate()
+
+    im2pyramid(
+        im_paths,
+        np.arange(12),
+        labels,
+        save_dir,
+        nwide=4,
+        tile_size=32,
+        overwrite=False,
+    )
+
+    max_level = pyramid.get_max_level(200, 90)
+    changed = {
+        tile_path for tile_path in tile_paths if os.stat(tile_path).st_mtime_ns != 0
+    }
+    assert "{}/{}/0_0.png".format(files_dir, max_level) in changed
+    assert "{}/{}/5_0.png".format(files_dir, max_level) not in changed
+    assert "{}/0/0_0.png".format(files_dir) in changed
+    assert len(changed) < len(tile_paths)
+
+    # and the result is the same as rendering everything, in parallel
+    rendered_dir = str(tmpdir.mkdir("rendered"))
+    im2pyramid(
+        im_paths,
+        np.arange(12),
+        labels,
+        rendered_dir,
+        nwide=4,
+        tile_size=32,
+        n_workers=2,
+    )
+
+    for level in range(max_level + 1):
+        assert np.all(
+            read_level(files_dir, level, 200, 90, max_level, 32)
+            == read_level(
+                "{}/A_files".format(rendered_dir), level, 200, 90, max_level, 32
+            )
+        )
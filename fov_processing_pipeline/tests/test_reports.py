@@ -0,0 +1,95 @@
+import numpy as np
+import pandas as pd
+
+from .. import reports
+from ..data import utils as data_utils
+
+
+def make_cell_data(n_cells, seed=0):
+    rng = np.random.default_rng(seed)
+
+    cell_line_ids = rng.integers(0, 5, n_cells)
+    fov_ids = rng.integers(0, 40, n_cells)
+
+    cell_data = pd.DataFrame(
+        {
+            "CellLineId": cell_line_ids,
+            "Clone": cell_line_ids % 2 + rng.integers(0, 2, n_cells),
+            "Gene": np.array(["A", "B", "C", "D", "E"])[cell_line_ids],
+            "ProteinDisplayName": np.array(["a", "b", "c", "d", "e"])[cell_line_ids],
+            "StructureShortName": np.array(["x", "y"])[cell_line_ids % 2],
+            "FOVId": fov_ids,
+            "PlateId": fov_ids % 3,
+            "Workflow": np.array(["Pipeline 4", "Pipeline 4.1", "Pipeline 4.2"])[
+                rng.integers(0, 3, n_cells)
+            ],
+        }
+    )
+
+    # cell line 4 only has cells of two of the workflows
+    cell_data = cell_data[
+        (cell_data.CellLineId != 4) | (cell_data.Workflow != "Pipeline 4.2")
+    ]
+
+    return data_utils.set_column_types(cell_data)
+
+
+def test_cell_data_to_summary_table():
+    cell_data = make_cell_data(500)
+
+    summary_table = reports.cell_data_to_summary_table(cell_data)
+
+    assert list(summary_table.columns) == [
+        "CellLineId",
+        "Clone",
+        "Gene",
+        "ProteinDisplayName",
+        "Structure Name",
+        "#cells",
+        "#fovs",
+        "Pipeline 4 (#fovs)",
+        "Pipeline 4.1 (#fovs)",
+        "Pipeline 4.2 (#fovs)",
+    ]
+    assert list(summary_table.CellLineId) == list(range(5))
+
+    for i, cell_line_id in enumerate(range(5)):
+        data_cell_line = cell_data[cell_data.CellLineId == cell_line_id]
+        row = summary_table.iloc[i]
+
+        assert np.all(row["Clone"] == np.unique(data_cell_line.Clone))
+        assert np.all(row["Gene"] == np.unique(data_cell_line.Gene))
+        assert row["#cells"] == data_cell_line.shape[0]
+        assert row["#fovs"] == data_cell_line.FOVId.nunique()
+
+        for workflow in ["Pipeline 4", "Pipeline 4.1", "Pipeline 4.2"]:
+            assert (
+                row[f"{workflow} (#fovs)"]
+                == data_cell_line[data_cell_line.Workflow == workflow].FOVId.nunique()
+            )
+
+    assert summary_table.iloc[4]["Pipeline 4.2 (#fovs)"] == 0
+
+    # the same from the counts of each plate
+    counts = pd.concat(
+        [
+            reports.get_summary_counts(data_utils.set_column_types(plate_data))
+            for _, plate_data in cell_data.groupby("PlateId")
+        ],
+        ignore_index=True,
+    )
+    assert counts.shape[0] < cell_data.shape[0]
+    assert reports.summary_table_from_counts(counts).to_csv() == summary_table.to_csv()
+
+
+def test_get_codes():
+    # missing values get a code of their own
+    codes, uniques = reports.get_codes(pd.Series(["a", None, "b", "a", None]))
+
+    assert list(codes) == [0, 2, 1, 0, 2]
+    assert list(uniques[:2]) == ["a", "b"]
+    assert pd.isna(uniques[2])
+
+    codes, uniques = reports.get_codes(pd.Series([3, 4, 3]))
+    assert list(codes) == [0, 1, 0]
+    assert list(uniques) == [3, 4]
@@ -1,8 +1,10 @@
+import os
+
 import pytest
 import numpy as np
 import pandas as pd
 
-from ..stats import z_intensity_profile
+from ..stats import pca, plots, stats, z_intensity_profile
 
 
 def test_z_intensity_profile(tmpdir, demo_row_image):
@@ -30,3 +32,198 @@ def test_z_intensity_profile(tmpdir, demo_row_image):
         z_intensity_profile.im2stats(np.expand_dims(demo_row_image, 0))
 
     z_intensity_profile.plot(fov_stats, tmpdir, "test")
+
+
+def test_render_plots(tmpdir, make_df_stats):
+    import matplotlib.pyplot as plt
+
+    df_stats = make_df_stats(8, ["A", "B"])
+
+    jobs = plots.get_plot_jobs(df_stats, str(tmpdir), proteins=["B"])
+    assert [job["kind"] for job in jobs] == ["pca"] + plots.PLOT_KINDS
+    assert all(job["protein"] == "B" for job in jobs[1:])
+
+    # the jobs only get the columns they need
+    assert list(jobs[1]["df"].columns) == ["FOVId"] + [
+        f"Ch{ch}_Percentile_Intensities" for ch in range(4)
+    ]
+
+    serial_dir = tmpdir.mkdir("serial")
+    plots.render_plots(plots.get_plot_jobs(df_stats, str(serial_dir)))
+
+    # every figure is closed
+    assert len(plt.get_fignums()) == 0
+
+    parallel_dir = tmpdir.mkdir("parallel")
+    plots.render_plots(plots.get_plot_jobs(df_stats, str(parallel_dir)), n_workers=2)
+
+    def list_files(directory):
+        return sorted(
+            os.path.relpath(os.path.join(root, filename), directory)
+            for root, _, filenames in os.walk(directory)
+            for filename in filenames
+        )
+
+    assert list_files(str(serial_dir)) == list_files(str(parallel_dir))
+    assert "fov_stats_A.png" in list_files(str(serial_dir))
+    assert "PCA_PCs.png" in list_files(str(serial_dir))
+
+
+def test_align_profiles():
+    df_stats = pd.DataFrame(
+        {
+            "z_intensity_profile_Ch0": [
+                np.array([1.0, 3, 2]),
+                np.array([0.0, 0, 1, 5]),
+            ],
+            "z_intensity_profile_Ch1": [
+                np.array([1.0, 2, 3]),
+                np.array([4.0, 3, 2, 1]),
+            ],
+        }
+    )
+    columns = list(df_stats.columns)
+
+    z_vals, profiles, starts, lengths = z_intensity_profile.align_profiles(
+        df_stats, columns, normalize_intensity=False, center_on_channel=columns[0]
+    )
+
+    # centered on the maximum of Ch0 of each FOV
+    assert np.all(z_vals == np.arange(-3, 2))
+    assert np.all(starts == [-1, -3])
+    assert np.all(lengths == [3, 4])
+
+    nan = np.nan
+    expected_ch1 = np.array([[nan, nan, 1, 2, 3], [4, 3, 2, 1, nan]])
+    assert np.allclose(profiles[1], expected_ch1, equal_nan=True)
+
+    # normalized per FOV, like the plots
+    _, profiles, _, _ = z_intensity_profile.align_profiles(df_stats, columns)
+    assert np.allclose(np.nanmean(profiles, 2), 0)
+    assert np.allclose(np.nanstd(profiles, 2), 1)
+
+
+def test_plot_im_percentiles(tmpdir, make_df_stats):
+    import matplotlib.pyplot as plt
+
+    assert list(stats.get_tick_positions(10, max_ticks=30)) == list(range(10))
+    assert list(stats.get_tick_positions(100, max_ticks=30)) == list(range(0, 100, 4))
+
+    df_stats = make_df_stats(50, ["A"])
+    columns = ["FOVId"] + [f"Ch{ch}_Percentile_Intensities" for ch in range(4)]
+
+    # every row, with a single path of marks per channel
+    save_path = str(tmpdir.join("rows.png"))
+    fig = stats.plot_im_percentiles(df_stats[columns], save_path=save_path)
+    assert os.path.exists(save_path)
+    assert len(fig.axes[0].patches) == 4
+    assert len(fig.axes[0].get_xticks()) <= stats.MAX_TICKS
+    plt.close(fig)
+
+    # percentile bands of bins of rows
+    save_path = str(tmpdir.join("bins.png"))
+    fig = stats.plot_im_percentiles(df_stats[columns], save_path=save_path, n_bins=10)
+    assert os.path.exists(save_path)
+    assert len(fig.axes[0].patches) == 0
+    assert all(len(line.get_xdata()) == 10 for line in fig.axes[0].lines)
+    plt.close(fig)
+
+
+def test_pca_feature_matrix(make_df_stats):
+    df_stats = make_df_stats(9, ["A"]).drop(["FOVId", "ProteinDisplayName"], axis=1)
+
+    # like im2stats, with an Intensity_Percentiles column for each channel
+    percentiles = pd.DataFrame(
+        {"Intensity_Percentiles": [np.array(pca.PERCENTILES)] * 9}
+    )
+    df_stats = pd.concat([df_stats, percentiles, percentiles], axis=1)
+
+    # the same as the mean of each value, even of profiles of different lengths
+    features, feature_names = pca.get_feature_matrix(df_stats)
+    assert feature_names == list(df_stats.columns)
+    assert np.allclose(features, df_stats.applymap(lambda x: np.mean(x)).values)
+
+    features, feature_names = pca.get_feature_matrix(df_stats, "z_profile", n_z=7)
+    column = "z_intensity_profile_Ch2"
+    profile = df_stats[column].iloc[4]
+    inds = [feature_names.index(f"{column}_{i}") for i in range(7)]
+    assert np.allclose(
+        features[4, inds],
+        np.interp(np.linspace(0, len(profile) - 1, 7), range(len(profile)), profile),
+    )
+
+    features, feature_names = pca.get_feature_matrix(
+        df_stats, "percentiles", percentiles=[25, 95]
+    )
+    column = "Ch1_Percentile_Intensities"
+    assert np.all(
+        features[:, feature_names.index(f"{column}_95")]
+        == np.stack(df_stats[column])[:, 4]
+    )
+
+    with pytest.raises(ValueError):
+        pca.get_feature_matrix(df_stats, "percentiles", percentiles=[99])
+
+
+def test_pca_plot_from_files(tmpdir, make_df_stats):
+    import pickle
+
+    # stats with most of their variance along one direction
+    rng = np.random.default_rng(1)
+    df_stats = make_df_stats(60, ["A", "B"])
+    for ch in range(4):
+        column = f"Ch{ch}_Percentile_Intensities"
+        df_stats[column] = list(
+            np.stack(df_stats[column]) * 0.01
+            + np.linspace(0, 1, 60)[:, np.newaxis] * (ch + 1)
+            + rng.random((60, 5)) * 0.01
+        )
+
+    stats_paths = list()
+    for i in range(df_stats.shape[0]):
+        stats_path = str(tmpdir.join(f"stats_{i}.pkl"))
+        if i != 3:
+            with open(stats_path, "wb") as f:
+                pickle.dump(
+                    df_stats.iloc[[i]].drop(["FOVId", "ProteinDisplayName"], axis=1), f
+                )
+        stats_paths.append(stats_path)
+
+    save_dir = str(tmpdir.join("streamed"))
+    model = pca.plot_from_files(
+        stats_paths,
+        save_dir,
+        labels=df_stats.ProteinDisplayName,
+        ids=df_stats.FOVId,
+        feature_method="percentiles",
+        n_components=3,
+        chunk_size=16,
+    )
+    assert model["pca"].n_components_ == 3
+
+    # the missing stats are skipped
+    df_projections = pd.read_parquet(f"{save_dir}/PCA_projections.parquet")
+    assert list(df_projections.FOVId) == [i for i in range(60) if i != 3]
+    assert os.path.exists(f"{save_dir}/PCA_PCs.png")
+
+    # the feature matrix is only needed for the fit
+    assert not os.path.exists(f"{save_dir}/PCA_features.npy")
+
+    # the same first component as a PCA of all of the stats in memory
+    in_memory_dir = str(tmpdir.join("in_memory"))
+    in_memory_model = pca.plot(
+        df_stats.drop([3]).drop(["FOVId", "ProteinDisplayName"], axis=1),
+        in_memory_dir,
+        feature_method="percentiles",
+    )
+    assert in_memory_model["pca_method"] == "full"
+
+    df_in_memory = pd.read_parquet(f"{in_memory_dir}/PCA_projections.parquet")
+    assert np.abs(np.corrcoef(df_in_memory.PC1, df_projections.PC1)[0, 1]) > 0.99
+
+    # and the saved model projects stats onto the same components
+    loaded_model = pca.load_model(f"{save_dir}/PCA_model.pkl")
+    projections = pca.transform(
+        loaded_model, df_stats.drop(["FOVId", "ProteinDisplayName"], axis=1)
+    )
+    assert np.allclose(projections[4], df_projections[["PC1", "PC2", "PC3"]].iloc[3])
@@ -0,0 +1,59 @@
+import numpy as np
+from PIL import Image
+
+from fov_processing_pipeline import filesystem, thumbnails
+from fov_processing_pipeline.reports import im2bigim
+
+
+def test_make_thumbnails():
+    im = np.arange(2 * 20 * 3, dtype="uint8").reshape(2, 20, 3)
+    im = np.tile(im, (5, 1, 1))
+
+    im_thumbnails = thumbnails.make_thumbnails(im)
+
+    assert im_thumbnails["level_2"].shape == (5, 10, 3)
+    assert im_thumbnails["level_4"].shape == (3, 5, 3)
+    assert im_thumbnails["level_8"].shape == (2, 3, 3)
+
+    # block means
+    assert np.all(
+        im_thumbnails["level_2"][0, 0]
+        == np.round(im[:2, :2].reshape(-1, 3).mean(0)).astype("uint8")
+    )
+
+    # projections in [0, 1] are scaled like they are in the PNG
+    im_float = thumbnails.make_thumbnails(im / 255)
+    assert np.all(im_float["level_4"] == im_thumbnails["level_4"])
+
+    assert thumbnails.get_factor((100, 400)) == 1
+    assert thumbnails.get_factor((100, 400), (0, 100)) == 4
+    assert thumbnails.get_factor((100, 400), (0, 1000)) == 1
+
+
+def test_read_projection(tmpdir):
+    rng = np.random.default_rng(0)
+    im = rng.integers(0, 255, size=(37, 50, 3), dtype="uint8")
+
+    proj_path = "{}/proj_1234.png".format(tmpdir)
+    Image.fromarray(im).save(proj_path)
+
+    thumbnail_path = thumbnails.get_thumbnail_path(proj_path)
+    assert thumbnail_path == "{}/thumbs_1234.npz".format(tmpdir)
+
+    # without thumbnails, the PNG is downsampled
+    filesystem.file_index.invalidate()
+    from_png = thumbnails.read_projection(proj_path, 4)
+
+    thumbnails.write_thumbnails(thumbnail_path, thumbnails.make_thumbnails(im))
+    filesystem.file_index.add(thumbnail_path)
+
+    assert np.all(thumbnails.read_projection(proj_path, 4) == from_png)
+    assert np.all(thumbnails.read_projection(proj_path) == im)
+
+    # the montage is made from the thumbnails
+    bigim_dir = str(tmpdir.mkdir("bigim"))
+    im2bigim([proj_path] * 3, np.arange(3), ["A"] * 3, bigim_dir, tile_width=20)
+
+    page = np.asarray(Image.open("{}/diagnostics_A_0.png".format(bigim_dir)))
+    # 1/4 would be 13 wide
+    assert page.shape == (19, 3 * 25, 3)
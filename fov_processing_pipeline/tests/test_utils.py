@@ -1,3 +1,5 @@
+import argparse
+import pytest
 import os
 from aicsimageio import writers
 import numpy as np
@@ -80,3 +82,39 @@ def test_rowim2proj(tmpdir, demo_row_image):
         "{}/tmp_rowim.png".format(tmpdir), overwrite_file=True
     ) as writer:
         writer.save(im_proj)
+
+
+def test_str2shard():
+    assert utils.str2shard("0/1") == (0, 1)
+    assert utils.str2shard("4/300") == (4, 300)
+
+    for v in ["1/1", "-1/2", "1", "a/b", "0/0"]:
+        with pytest.raises(argparse.ArgumentTypeError):
+            utils.str2shard(v)
+
+
+def test_str2bytes():
+    assert utils.str2bytes("16GB") == 16e9
+    assert utils.str2bytes("512mb") == 512e6
+    assert utils.str2bytes("1e9") == 1e9
+
+    with pytest.raises(argparse.ArgumentTypeError):
+        utils.str2bytes("lots")
+
+
+def test_ids2rand():
+    ids = np.array([7649, 3, 7649, 0, 2 ** 40, 3, 12345678])
+
+    # the default method gives exactly the same values as int2rand
+    rands = utils.ids2rand(ids)
+    assert np.all(rands == np.array([utils.int2rand(int(i)) for i in ids]))
+
+    # the hash is deterministic, depends on the seed, and is in [0, 1)
+    rands = utils.ids2rand(np.arange(100000), method="hash")
+    assert np.all(rands == utils.ids2rand(np.arange(100000), method="hash"))
+    assert np.all(rands != utils.ids2rand(np.arange(100000), method="hash", seed=1))
+    assert np.all((rands >= 0) & (rands < 1))
+    assert np.abs(np.mean(rands) - 0.5) < 0.01
+
+    with pytest.raises(ValueError):
+        utils.ids2rand(ids, method="nonexistent method")
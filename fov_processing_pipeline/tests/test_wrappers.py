@@ -1,4 +1,5 @@
 from unittest import mock
+import time
 import pytest
 import os
 import numpy as np
@@ -7,6 +8,9 @@ import pandas as pd
 from aicsimageio import imread
 
 from .. import wrappers
+from .. import profiling
+from ..data import synthetic
+from ..memory import MemoryBudget
 
 # Because all of the functions in wrappers.py a @task decorator, they need to be run with
 # wrappers.function_name(<inputs>)
@@ -173,3 +177,152 @@ def test_data_splits(demo_fov_data, tmpdir):
             split_column="this column doesnt exist",
             id_column=id_column,
         )
+
+
+def test_process_fov_row_quarantine(demo_fov_row, tmpdir):
+    # make an image that can't be read
+    im_path = "{}/corrupt.ome.tiff".format(tmpdir)
+    with open(im_path, "w") as f:
+        f.write("not an image")
+
+    fov_row = demo_fov_row.copy()
+    fov_row["SourceReadPath"] = im_path
+
+    stats_path = "{}/plate/stats.pkl".format(tmpdir)
+    proj_path = "{}/plate/proj.png".format(tmpdir)
+    failure_path = "{}/plate/failed.json".format(tmpdir)
+
+    # the failure should be recorded rather than raised
+    wrappers.process_fov_row.run(
+        fov_row, stats_path, proj_path, failure_path, load_retries=0
+    )
+
+    assert os.path.exists(failure_path)
+    assert not os.path.exists(stats_path)
+
+    # without a failure path, the error is raised
+    with pytest.raises(Exception):
+        wrappers.process_fov_row.run(fov_row, stats_path, proj_path, load_retries=0)
+
+
+def test_process_fov_row_resource_error(tmpdir):
+    fov_row = pd.Series({"FOVId": 1, "SourceReadPath": "{}/im.ome.tiff".format(tmpdir)})
+
+    stats_path = "{}/plate/stats.pkl".format(tmpdir)
+    proj_path = "{}/plate/proj.png".format(tmpdir)
+    failure_path = "{}/plate/failed.json".format(tmpdir)
+
+    # running out of memory isn't the FOV's fault, so it is raised rather than quarantined
+    with mock.patch.object(wrappers, "row2im", side_effect=MemoryError()):
+        with pytest.raises(MemoryError):
+            wrappers.process_fov_row.run(
+                fov_row, stats_path, proj_path, failure_path, load_retries=0
+            )
+
+    assert not os.path.exists(failure_path)
+
+
+def test_save_load_data_sync(tmpdir):
+    data_dir = str(tmpdir.mkdir("local"))
+    cell_data, fov_data = synthetic.get_data(
+        save_dir=data_dir, n_fovs=3, protein_list=["Lamin B1"], shape=(7, 4, 16, 16)
+    )
+
+    manifest = cell_data[
+        ["CellId", "FOVId", "PlateId", "ProteinDisplayName", "CellLine"]
+    ].copy()
+    manifest["SourceReadPath"] = cell_data["SourceReadPath"]
+    manifest[manifest["FOVId"] != 3].to_csv(f"{data_dir}/manifest.csv", index=False)
+
+    dataset_kwargs = {"data_dir": data_dir}
+
+    wrappers.save_load_data.run(
+        tmpdir, dataset="local", dataset_kwargs=dataset_kwargs, sync=True
+    )
+    assert wrappers.load_sync(tmpdir)["pending"] == [1, 2]
+
+    # pretend FOVs 1 and 2 were processed
+    for plate_id, fov_id in zip(fov_data["PlateId"], fov_data["FOVId"]):
+        stats_path, proj_path, _ = wrappers.get_fov_result_paths(
+            tmpdir, plate_id, fov_id
+        )
+        os.makedirs(os.path.dirname(proj_path), exist_ok=True)
+        for path in [stats_path, proj_path]:
+            open(path, "w").close()
+    wrappers.finish_sync.run(tmpdir)
+
+    # FOV 3 is added, and the image of FOV 1 is replaced upstream
+    os.utime(fov_data["SourceReadPath"].iloc[0], ns=(0, 0))
+    manifest.to_csv(f"{data_dir}/manifest.csv", index=False)
+
+    _, fov_data = wrappers.save_load_data.run(
+        tmpdir, dataset="local", dataset_kwargs=dataset_kwargs, sync=True
+    )
+
+    sync_state = wrappers.load_sync(tmpdir)
+    assert sync_state["new"] == [3]
+    assert sync_state["changed"] == [1]
+    assert sync_state["pending"] == [1, 3]
+    assert sync_state["proteins"] == ["Lamin B1"]
+
+    # the results of the changed FOV are gone, the others are kept
+    assert not os.path.exists(wrappers.get_fov_result_paths(tmpdir, 1100, 1)[1])
+    assert os.path.exists(wrappers.get_fov_result_paths(tmpdir, 1100, 2)[1])
+
+    sync_fov_data = wrappers.get_sync_fovs.run(tmpdir, fov_data)
+    assert list(sync_fov_data["FOVId"]) == [1, 3]
+
+    # nothing changed since
+    wrappers.save_load_data.run(
+        tmpdir, dataset="local", dataset_kwargs=dataset_kwargs, sync=True
+    )
+    assert wrappers.load_sync(tmpdir)["new"] == []
+    assert wrappers.load_sync(tmpdir)["pending"] == [1, 3]
+
+
+def test_save_load_data_csv(tmpdir):
+    # a results directory from before the tables were stored as Parquet
+    cell_data, fov_data = synthetic.get_data(
+        save_dir=str(tmpdir.mkdir("images")), n_fovs=2, shape=(7, 4, 16, 16)
+    )
+
+    raw_dir = tmpdir.mkdir(wrappers.RAW_DIR)
+    cell_data.to_csv(f"{raw_dir}/cell_data.csv")
+    fov_data.to_csv(f"{raw_dir}/fov_data.csv")
+
+    # the tables are converted rather than retrieved again
+    with mock.patch.object(wrappers.data.sources, "get_data") as mocked_get_data:
+        loaded_cell_data, loaded_fov_data = wrappers.save_load_data.run(tmpdir)
+
+    assert not mocked_get_data.called
+    assert os.path.exists(f"{raw_dir}/cell_data.parquet")
+    assert list(loaded_fov_data["FOVId"]) == list(fov_data["FOVId"])
+    assert loaded_cell_data.shape == cell_data.shape
+
+
+def test_process_fov_row_deferred_writes(tmpdir):
+    _, fov_data = synthetic.get_data(
+        save_dir=str(tmpdir.mkdir("images")), n_fovs=1, shape=(7, 4, 16, 16)
+    )
+    fov_row = fov_data.iloc[0]
+
+    stats_path = "{}/plate/stats.pkl".format(tmpdir)
+    proj_path = "{}/plate/proj.png".format(tmpdir)
+
+    with mock.patch.object(wrappers.memory, "memory_budget", MemoryBudget(2 ** 30)):
+        wrappers.process_fov_row.run(
+            fov_row, stats_path, proj_path, wait_for_writes=False
+        )
+        records = profiling.pop_task_records()
+        wrappers.flush_outputs.run()
+
+        # the memory of the results is held until they are written (and released right after, by the writer)
+        for _ in range(100):
+            if wrappers.memory.memory_budget.n_bytes_used == 0:
+                break
+            time.sleep(0.01)
+
+        assert wrappers.memory.memory_budget.n_bytes_used == 0
+
+    assert os.path.exists(proj_path)
+    assert "png_write" in [record["stage"] for record in records]
@@ -0,0 +1,106 @@
+"""
+thumbnails.py: Downsampled levels of the projection of each FOV.
+
+Next to f"proj_{FOVId}.png", process_fov_row writes f"thumbs_{FOVId}.npz" with the projection at 1/2, 1/4 and 1/8 of
+its size, each made by a 2x2 block mean of the level above it while the projection is still in memory. Each level is
+a separate (compressed) member of the .npz, so reading one doesn't decode the others. Things that show projections
+smaller than they are (e.g. montages) read them with read_projection, which picks the smallest level that is big
+enough, and falls back to the full resolution PNG for FOVs that have no thumbnails.
+"""
+
+import os
+
+import numpy as np
+
+from . import filesystem, utils
+
+# the levels, as the factor each side is divided by
+THUMBNAIL_FACTORS = [2, 4, 8]
+
+
+def get_thumbnail_path(proj_path):
+    directory, name = os.path.split(proj_path)
+
+    if name.startswith("proj_"):
+        name = name[len("proj_") :]  # noqa
+
+    return os.path.join(directory, "thumbs_" + os.path.splitext(name)[0] + ".npz")
+
+
+def make_thumbnails(im_proj):
+    """
+    Returns {f"level_{factor}": image} of a (Y, X, C) projection (uint8, or float in [0, 1]) for each of
+    THUMBNAIL_FACTORS
+    """
+
+    thumbnails = dict()
+
+    im = im_proj
+    if np.issubdtype(im.dtype, np.floating):
+        # values in [0, 1], scaled the way they are in the PNG
+        im = np.round(im * 255).astype("uint8")
+    factor = 1
+    for thumbnail_factor in THUMBNAIL_FACTORS:
+        while factor < thumbnail_factor:
+            im = utils.downsample(im)
+            factor *= 2
+
+        thumbnails[f"level_{thumbnail_factor}"] = im
+
+    return thumbnails
+
+
+def write_thumbnails(path, thumbnails):
+    # for output.OutputWriter
+    with open(path, "wb") as f:
+        np.savez_compressed(f, **thumbnails)
+
+
+def get_factor(shape, min_size=None):
+    """
+    Returns the biggest of 1 and THUMBNAIL_FACTORS that keeps an image of shape (Y, X) at least min_size (Y, X) big
+    """
+
+    if min_size is None:
+        return 1
+
+    factor = 1
+    for thumbnail_factor in THUMBNAIL_FACTORS:
+        level_shape = [int(np.ceil(size / thumbnail_factor)) for size in shape[:2]]
+        if any(
+            size < min_level_size for size, min_level_size in zip(level_shape, min_size)
+        ):
+            break
+
+        factor = thumbnail_factor
+
+    return factor
+
+
+def read_projection(proj_path, factor=1):
+    """
+    Returns the (Y, X, C) projection of an FOV at 1/factor of its size, from its thumbnails if they are there
+    """
+
+    if factor != 1:
+        thumbnail_path = get_thumbnail_path(proj_path)
+
+        if filesystem.file_index.exists(thumbnail_path):
+            with np.load(thumbnail_path) as thumbnails:
+                key = f"level_{factor}"
+                if key in thumbnails.files:
+                    return thumbnails[key]
+
+    from PIL import Image
+
+    with Image.open(proj_path) as im:
+        im = np.asarray(im)
+
+    if im.ndim == 2:
+        im = im[:, :, np.newaxis]
+
+    while factor > 1:
+        im = utils.downsample(im)
+        factor //= 2
+
+    return im
@@ -1,7 +1,6 @@
 import numpy as np
 from numpy.random import Generator, PCG64
 import argparse
-import matplotlib.pyplot as plt
 
 
 def int2rand(id):
@@ -10,6 +9,59 @@ def int2rand(id):
     return rg.random()
 
 
+def _splitmix64(x):
+    # the SplitMix64 mixing function, on an array of uint64s
+    with np.errstate(over="ignore"):
+        x = x + np.uint64(0x9E3779B97F4A7C15)
+        x = (x ^ (x >> np.uint64(30))) * np.uint64(0xBF58476D1CE4E5B9)
+        x = (x ^ (x >> np.uint64(27))) * np.uint64(0x94D049BB133111EB)
+        x = x ^ (x >> np.uint64(31))
+
+    return x
+
+
+def ids2rand(ids, method="pcg64", seed=0):
+    """
+    Psuedorandomly deterministically converts an array of IDs (integers) to random numbers between 0 and 1
+
+    Parameters
+    ----------
+    ids: array-like of ints
+        IDs to convert
+
+    method: str
+        "pcg64": the same values as int2rand. int2rand is called once for each unique ID, so repeated IDs (e.g. the
+            FOVId of every cell in an FOV) are cheap.
+        "hash": a counter-based hash (SplitMix64) of the IDs and seed. Much faster, but the values are different from
+            int2rand, so only use this for new datasets.
+
+    seed: int
+        mixed into the hash for the "hash" method
+
+    Returns
+    -------
+    rands: np.array
+        float64 array of numbers in [0, 1), one for each ID
+    """
+
+    ids = np.asarray(ids, dtype=np.int64)
+
+    if method == "pcg64":
+        u_ids, u_inds = np.unique(ids, return_inverse=True)
+        u_rands = np.array([int2rand(int(u_id)) for u_id in u_ids], dtype=np.float64)
+
+        return u_rands[u_inds].reshape(ids.shape)
+
+    elif method == "hash":
+        x = ids.astype(np.uint64) ^ _splitmix64(np.array([seed], dtype=np.uint64))
+
+        # the top 53 bits, which is what fits in a float64 mantissa
+        return (_splitmix64(x) >> np.uint64(11)).astype(np.float64) * 2.0 ** -53
+
+    else:
+        raise ValueError(f'method must be "pcg64" or "hash", got {method}')
+
+
 def str2bool(v):
     if v.lower() in ("yes", "true", "t", "y", "1"):
         return True
@@ -19,6 +71,40 @@ def str2bool(v):
         raise argparse.ArgumentTypeError("Boolean value expected.")
 
 
+def str2shard(v):
+    # parses a shard string of the form "i/N" into the tuple (i, N), where 0 <= i < N
+    try:
+        shard_index, n_shards = [int(s) for s in v.split("/")]
+    except ValueError:
+        raise argparse.ArgumentTypeError('Shard of the form "i/N" expected.')
+
+    if n_shards < 1 or shard_index < 0 or shard_index >= n_shards:
+        raise argparse.ArgumentTypeError(
+            f"Shard index must be in the range [0, N), got {shard_index}/{n_shards}."
+        )
+
+    return shard_index, n_shards
+
+
+def str2bytes(v):
+    # parses a size string like "16GB", "512MB" or "1e9" into a number of bytes
+    units = {"KB": 1e3, "MB": 1e6, "GB": 1e9, "TB": 1e12, "B": 1}
+
+    v = v.strip().upper()
+
+    for unit, multiplier in units.items():
+        if v.endswith(unit):
+            v = v[: -len(unit)]
+            break
+    else:
+        multiplier = 1
+
+    try:
+        return int(float(v) * multiplier)
+    except ValueError:
+        raise argparse.ArgumentTypeError('Size like "16GB" expected.')
+
+
 def im2proj(im, color_transform=None):
     # im is a CYXZ numpy array
     #
@@ -35,7 +121,9 @@ def im2proj(im, color_transform=None):
             color_transform = np.array([[1, 1, 1]])
         else:
             # pick colors from HSV
-            color_transform = plt.get_cmap("jet")(np.linspace(0, 1, n_channels))[:, 0:3]
+            from matplotlib import cm
+
+            color_transform = cm.jet(np.linspace(0, 1, n_channels))[:, 0:3]
 
     if len(im.shape) == 4:
         im_xy = np.max(im, 3)
@@ -96,3 +184,14 @@ def rowim2proj(im, ch_order=None):
     im_trans = im2proj(im[bf_inds], color_transform=np.array([[1, 1, 1]]))
 
     return np.concatenate([im_fluor, im_trans], 1)
+
+
+def downsample(im):
+    # mean of each 2x2 block of a (Y, X, C) image, with the last row or column repeated if the size is odd
+    im = np.pad(
+        im, ((0, im.shape[0] % 2), (0, im.shape[1] % 2), (0, 0)), mode="edge"
+    ).astype("float32")
+
+    im = (im[0::2, 0::2] + im[1::2, 0::2] + im[0::2, 1::2] + im[1::2, 1::2]) / 4
+
+    return np.round(im).astype("uint8")
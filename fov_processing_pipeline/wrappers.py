@@ -1,26 +1,52 @@
 """
 wrappers.py: Base functions for the FOV processing pipeline called by process.py.
 
-Most functions have an @task decoration for Prefect pipelining.
+Most functions have an @task decoration for Prefect pipelining. The timing records of the stages that are decorated
+with @profiling.profiled (and of process_fov_row) are sent back in the states of their tasks, see profiling.py.
 
 Each function performs a spcific task, and they should be listed in pipeline order. The file directory organization
 should be controlled by this file (e.g. no paths other than "parent_dir" should need to be specified.)
 
 """
 
+import json
 import os
 import warnings
 import pandas as pd
 import pickle
 import numpy as np
-from aicsimageio import imread, writers
 from prefect import task
 
-from . import data, utils, stats, reports, postprocess
-
+from . import (
+    data,
+    utils,
+    stats,
+    reports,
+    postprocess,
+    memory,
+    failures,
+    profiling,
+    cache,
+    filesystem,
+    output,
+    thumbnails,
+)
 
 RAW_DIR = "raw"
 QC_DIR = "qc"
+PERFORMANCE_DIR = "performance"
+
+# the digests that the plots and reports were made from, one file per step, in QC_DIR, see cache.py
+CACHE_DIR = "cache"
+
+# the per-FOV counts of each plate that the summary table is made from, in QC_DIR
+SUMMARY_COUNTS_DIR = "summary_counts"
+
+# what the last sync found, and the FOVs and proteins that still have to be processed, in RAW_DIR
+SYNC_FILENAME = "sync.json"
+
+# montage PNGs (reports.im2bigim) or zoomable montages (reports.im2pyramid)
+DIAGNOSTICS_FORMATS = ["pages", "pyramid"]
 
 
 def row2im(df_row, ch_order=["BF", "DNA", "Cell", "Struct"]):
@@ -28,6 +54,8 @@ def row2im(df_row, ch_order=["BF", "DNA", "Cell", "Struct"]):
     # Default order is: Brightfield, DNA, Membrane, Structure
     #
     # load all channels of all z-stacks and transpose to order: c, y, x, z
+    from aicsimageio import imread
+
     im = imread(df_row.SourceReadPath).squeeze()
     im = np.transpose(im, [0, 2, 3, 1])
 
@@ -72,13 +100,26 @@ def im2stats(im):
     return results
 
 
-@task
+@task(state_handlers=[profiling.attach_records])
+@profiling.profiled
 def save_load_data(
-    parent_dir, protein_list=None, n_fovs=100, overwrite=False, dataset="quilt"
+    parent_dir,
+    protein_list=None,
+    n_fovs=100,
+    overwrite=False,
+    dataset="quilt",
+    dataset_kwargs=None,
+    sync=False,
+    cache_dir=None,
 ):
     """
     Retreives or loads data.
 
+    With `sync`, the data are retrieved again even if the tables exist, and compared with the stored tables by FOVId
+    and source fingerprint (see data.utils.get_fov_fingerprints). The results of FOVs that changed or were removed
+    upstream are deleted, and the new and changed FOVs are recorded in {RAW_DIR}/{SYNC_FILENAME} (see get_sync_fovs)
+    so only they are processed.
+
     Parameters
     ----------
     parent_dir: str
@@ -91,7 +132,17 @@ def save_load_data(
         do we overwrite the files if they exist? (i.e. do you want to put new results in an old directory)
 
     dataset: str
-        can be "quilt" or "labkey"
+        name of a data source in data.sources.DATA_SOURCES, i.e. "quilt", "labkey", "synthetic" or "local"
+
+    dataset_kwargs: dict or None
+        extra keyword arguments for the data source, e.g. {"data_dir": ...} for "local"
+
+    sync: bool
+        update the stored tables with the new and changed FOVs from the data source
+
+    cache_dir: str or None
+        directory of the caches (e.g. of the quilt metadata) that are shared between runs, see
+        data.sources.get_cache_dir
 
     Returns
     -------
@@ -107,36 +158,207 @@ def save_load_data(
     if not os.path.exists(save_dir):
         os.makedirs(save_dir)
 
-    cell_data_path = f"{save_dir}/cell_data.csv"
-    fov_data_path = f"{save_dir}/fov_data.csv"
+    cell_data_path = f"{save_dir}/cell_data.parquet"
+    fov_data_path = f"{save_dir}/fov_data.parquet"
 
-    if not os.path.exists(cell_data_path) or overwrite:
+    if not os.path.exists(cell_data_path) and not overwrite:
+        # results from before the tables were stored as Parquet
+        data.utils.convert_csv_tables(save_dir)
 
-        if dataset == "labkey":
-            cell_data, fov_data = data.labkey.get_data(
-                protein_list=protein_list, n_fovs=n_fovs
-            )
-        elif dataset == "quilt":
-            image_dir = f"{save_dir}/images/"
-            cell_data, fov_data = data.quilt.get_data(
-                save_dir=image_dir,
-                protein_list=protein_list,
-                n_fovs=n_fovs,
-                overwrite=overwrite,
-            )
-        else:
-            raise ValueError(f"unrecognized dataset parameter {dataset}")
+    if not os.path.exists(cell_data_path) or overwrite or sync:
+
+        cell_data, fov_data = data.sources.get_data(
+            dataset,
+            save_dir,
+            protein_list=protein_list,
+            n_fovs=n_fovs,
+            overwrite=overwrite,
+            cache_dir=cache_dir,
+            **(dataset_kwargs or dict()),
+        )
+
+        fov_data = data.utils.add_fov_fingerprints(fov_data, cell_data)
+
+        # so the types are the same whether the tables were just made or loaded
+        cell_data = data.utils.set_column_types(cell_data)
+        fov_data = data.utils.set_column_types(fov_data)
+
+        if sync:
+            sync_fov_results(parent_dir, fov_data, overwrite=overwrite)
 
-        cell_data.to_csv(cell_data_path)
-        fov_data.to_csv(fov_data_path)
+        data.utils.save_table(cell_data, cell_data_path)
+        data.utils.save_table(fov_data, fov_data_path)
 
     else:
-        cell_data = pd.read_csv(cell_data_path)
-        fov_data = pd.read_csv(fov_data_path)
+        cell_data = data.utils.load_table(cell_data_path)
+        fov_data = data.utils.load_table(fov_data_path)
 
     return cell_data, fov_data
 
 
+def load_sync(parent_dir):
+    sync_path = f"{parent_dir}/{RAW_DIR}/{SYNC_FILENAME}"
+
+    if not os.path.exists(sync_path):
+        return {"new": [], "changed": [], "removed": [], "pending": [], "proteins": []}
+
+    with open(sync_path, "r") as f:
+        return json.load(f)
+
+
+def save_sync(parent_dir, sync_state):
+    # written to a temporary file first, so an interrupted run doesn't lose the pending FOVs
+    sync_path = f"{parent_dir}/{RAW_DIR}/{SYNC_FILENAME}"
+
+    with open(f"{sync_path}.tmp", "w") as f:
+        json.dump(sync_state, f, indent=2)
+
+    os.replace(f"{sync_path}.tmp", sync_path)
+
+
+def sync_fov_results(parent_dir, fov_data, overwrite=False):
+    """
+    Compares fov_data with the stored FOV table, deletes the results of the FOVs that changed or were removed, and
+    adds the new and changed FOVs and their proteins to the pending ones in {RAW_DIR}/{SYNC_FILENAME}
+
+    Returns
+    -------
+    sync_state: dict
+        the FOVIds that are "new", "changed" and "removed" since the stored table, the FOVIds that are "pending"
+        processing and the "proteins" whose plots and diagnostics have to be remade
+    """
+
+    fov_data_path = f"{parent_dir}/{RAW_DIR}/fov_data.parquet"
+
+    if os.path.exists(fov_data_path) and not overwrite:
+        old_fov_data = data.utils.load_table(fov_data_path)
+
+        if data.utils.FINGERPRINT_COLUMN not in old_fov_data.columns:
+            # tables from before fingerprints were stored
+            old_cell_data = data.utils.load_table(
+                f"{parent_dir}/{RAW_DIR}/cell_data.parquet"
+            )
+            old_fov_data = data.utils.add_fov_fingerprints(old_fov_data, old_cell_data)
+    else:
+        old_fov_data = fov_data.iloc[:0]
+
+    changes = data.utils.diff_fov_data(old_fov_data, fov_data)
+
+    # the results of changed and removed FOVs are stale
+    stale_fov_data = old_fov_data[
+        old_fov_data["FOVId"].isin(changes["changed"] + changes["removed"])
+    ]
+    for plate_id, fov_id in zip(stale_fov_data["PlateId"], stale_fov_data["FOVId"]):
+        stats_path, proj_path, failure_path = get_fov_result_paths(
+            parent_dir, plate_id, fov_id
+        )
+        thumbnail_path = thumbnails.get_thumbnail_path(proj_path)
+
+        for path in [stats_path, proj_path, thumbnail_path, failure_path]:
+            filesystem.file_index.remove(path)
+
+    previous_sync_state = load_sync(parent_dir)
+
+    pending = set(previous_sync_state["pending"]) | set(
+        changes["new"] + changes["changed"]
+    )
+    pending -= set(changes["removed"])
+
+    proteins = set(previous_sync_state["proteins"])
+    proteins |= set(
+        fov_data["ProteinDisplayName"][
+            fov_data["FOVId"].isin(changes["new"] + changes["changed"])
+        ]
+    )
+    proteins |= set(
+        old_fov_data["ProteinDisplayName"][
+            old_fov_data["FOVId"].isin(changes["removed"])
+        ]
+    )
+
+    sync_state = dict(changes)
+    sync_state["pending"] = sorted(int(fov_id) for fov_id in pending)
+    sync_state["proteins"] = sorted(str(protein) for protein in proteins)
+
+    save_sync(parent_dir, sync_state)
+
+    warnings.warn(
+        "Sync found {} new, {} changed and {} removed FOVs.".format(
+            len(changes["new"]), len(changes["changed"]), len(changes["removed"])
+        )
+    )
+
+    return sync_state
+
+
+@task
+def get_sync_fovs(parent_dir, fov_data):
+    # Returns the FOVs in fov_data that are new or changed since they were last processed, see save_load_data
+    return fov_data[fov_data["FOVId"].isin(load_sync(parent_dir)["pending"])]
+
+
+@task
+def get_sync_proteins(parent_dir):
+    # Returns the proteins with new, changed or removed FOVs since their plots and diagnostics were last made
+    return load_sync(parent_dir)["proteins"]
+
+
+@task
+def finish_sync(parent_dir):
+    # Clears the pending FOVs and proteins once they have been processed and the aggregates have been remade
+
+    sync_state = load_sync(parent_dir)
+    sync_state["pending"] = list()
+    sync_state["proteins"] = list()
+
+    save_sync(parent_dir, sync_state)
+
+
+@task
+def shard_data(fov_data, shard=None, shard_column="FOVId"):
+    """
+    Returns the subset of fov_data that belongs to a shard, so independent jobs can process disjoint sets of FOVs.
+
+    Parameters
+    ----------
+    fov_data: pandas.DataFrame
+        Dataframe where each row corresponds to an FOV
+
+    shard: tuple of ints or None
+        (shard_index, n_shards). If None, all of fov_data is returned.
+
+    shard_column: str
+        Integer column to partition on. See data.utils.shard_data
+
+    Returns
+    -------
+    fov_data: pandas.DataFrame
+        Dataframe of the FOVs in this shard
+    """
+
+    if shard is None:
+        return fov_data
+
+    shard_index, n_shards = shard
+
+    return data.utils.shard_data(
+        fov_data, shard_index, n_shards, shard_column=shard_column
+    )
+
+
+def get_fov_result_paths(parent_dir, plate_id, fov_id):
+    # The stats, projection and failure record paths of an FOV. The thumbnails of the projection are next to it, see
+    # thumbnails.get_thumbnail_path
+
+    plate_dir = f"{parent_dir}/{QC_DIR}/plate_{plate_id}"
+
+    return (
+        f"{plate_dir}/stats_{fov_id}.pkl",
+        f"{plate_dir}/proj_{fov_id}.png",
+        f"{plate_dir}/failed_{fov_id}.json",
+    )
+
+
 @task
 def get_save_paths(parent_dir, fov_data):
     # Sets up the save paths for all of the results
@@ -147,23 +369,85 @@ def get_save_paths(parent_dir, fov_data):
 
     summary_path = f"{save_dir}/summary.csv"
 
-    stats_paths = [
-        f"{save_dir}/plate_{row.PlateId}/stats_{row.FOVId}.pkl"
-        for i, row in fov_data.iterrows()
-    ]
-    proj_paths = [
-        f"{save_dir}/plate_{row.PlateId}/proj_{row.FOVId}.png"
-        for i, row in fov_data.iterrows()
+    result_paths = [
+        get_fov_result_paths(parent_dir, plate_id, fov_id)
+        for plate_id, fov_id in zip(fov_data["PlateId"], fov_data["FOVId"])
     ]
 
-    return summary_path, stats_paths, proj_paths
+    stats_paths = [paths[0] for paths in result_paths]
+    proj_paths = [paths[1] for paths in result_paths]
+    failure_paths = [paths[2] for paths in result_paths]
+
+    return summary_path, stats_paths, proj_paths, failure_paths
+
+
+def get_artifact_cache(parent_dir, name):
+    # the ArtifactCache of a step, see cache.py
+    return cache.ArtifactCache(f"{parent_dir}/{QC_DIR}/{CACHE_DIR}/{name}.json")
 
 
 @task
-def cell_data_to_summary_table(cell_data, summary_path):
-    cell_line_summary_table = reports.cell_data_to_summary_table(cell_data)
+def cell_data_to_summary_table(cell_data, summary_path, overwrite=False):
+    # The summary table is made from the per-FOV counts of each plate (see reports.get_summary_counts), which are kept
+    # in {QC_DIR}/{SUMMARY_COUNTS_DIR}. Only the plates whose cells changed are counted again, and the table is only
+    # remade if any of them changed (or overwrite), see cache.py
+
+    parent_dir = os.path.dirname(os.path.dirname(os.path.abspath(summary_path)))
+
+    summary_cache = get_artifact_cache(parent_dir, "summary_table")
+
+    counts_dir = f"{parent_dir}/{QC_DIR}/{SUMMARY_COUNTS_DIR}"
+    # the summary table and counts could have been made by another process since this one listed them
+    filesystem.file_index.invalidate(os.path.dirname(os.path.abspath(summary_path)))
+    filesystem.file_index.invalidate(counts_dir)
+    filesystem.file_index.makedirs(counts_dir)
+
+    plate_inds = cell_data.groupby("PlateId", sort=True, observed=True).indices
+    plate_digests = cache.get_group_digests(
+        cell_data[reports.SUMMARY_COLUMNS], plate_inds
+    )
+    plate_keys = {plate_id: f"plate_{plate_id}" for plate_id in plate_digests}
+
+    digest = cache.get_digest(
+        params={plate_keys[plate_id]: d for plate_id, d in plate_digests.items()}
+    )
+    if not overwrite and summary_cache.is_current(summary_path, digest):
+        return
+
+    counts = list()
+    for plate_id, plate_digest in plate_digests.items():
+        key = plate_keys[plate_id]
+        counts_path = f"{counts_dir}/{key}.parquet"
+
+        if overwrite or not summary_cache.is_current(key, plate_digest):
+            plate_counts = reports.get_summary_counts(
+                cell_data.iloc[plate_inds[plate_id]]
+            )
+            plate_counts.to_parquet(counts_path)
+            filesystem.file_index.add(counts_path)
+
+            summary_cache.update(key, plate_digest, [counts_path])
+        else:
+            plate_counts = pd.read_parquet(counts_path)
+
+        counts.append(plate_counts)
+
+    # the counts of plates that are no longer in the data
+    for key in list(summary_cache.records.keys()):
+        if key.startswith("plate_") and key not in plate_keys.values():
+            summary_cache.remove(key)
+
+    if len(counts) > 0:
+        counts = pd.concat(counts, ignore_index=True)
+    else:
+        counts = reports.get_summary_counts(cell_data)
+
+    cell_line_summary_table = reports.summary_table_from_counts(counts)
     cell_line_summary_table.to_csv(summary_path)
 
+    summary_cache.update(summary_path, digest, [summary_path])
+    summary_cache.save()
+
 
 @task
 def get_data_rows(fov_data):
@@ -171,45 +455,225 @@ def get_data_rows(fov_data):
 
 
 @task
-def process_fov_row(fov_row, stats_path, proj_path, overwrite=False):
+def get_memory_estimates(fov_data):
+    # Estimates the peak memory in bytes that process_fov_row uses for each FOV, from the image headers
+    return [
+        memory.estimate_fov_memory(image_path) for image_path in fov_data.SourceReadPath
+    ]
+
+
+@task
+def select_memory_class(
+    fov_rows,
+    stats_paths,
+    proj_paths,
+    failure_paths,
+    memory_estimates,
+    memory_class,
+    memory_classes,
+):
+    # Returns the process_fov_row arguments for the FOVs that belong to memory_class
+
+    inds = [
+        i
+        for i, memory_estimate in enumerate(memory_estimates)
+        if memory.get_memory_class(memory_estimate, memory_classes) == memory_class
+    ]
+
+    return (
+        [fov_rows[i] for i in inds],
+        [stats_paths[i] for i in inds],
+        [proj_paths[i] for i in inds],
+        [failure_paths[i] for i in inds],
+        [memory_estimates[i] for i in inds],
+    )
+
+
+@task(state_handlers=[profiling.attach_records])
+def process_fov_row(
+    fov_row,
+    stats_path,
+    proj_path,
+    failure_path=None,
+    overwrite=False,
+    memory_estimate=None,
+    load_timeout=None,
+    load_retries=2,
+    load_retry_delay=10,
+    wait_for_writes=True,
+    run_id=None,
+):
     # Performs atomic operations on a data row that corresponds to a single FOV
     #
     # fov_row - pandas dataframe row (from data.get_data() frunction)
     # stats_path - save path for image statistics
-    # proj_path - save path for projection image
+    # proj_path - save path for projection image. Its thumbnails are saved next to it, see thumbnails.py
+    # failure_path - save path for the failure record. If the FOV fails, it is recorded here and skipped on later
+    #                runs unless overwrite is True. If None, failures are raised. Running out of memory, disk space or
+    #                file handles (see failures.is_resource_error) is always raised, since it isn't the FOV's fault.
     # overwrite - overwrite local data
+    # memory_estimate - estimated peak memory in bytes, used to stay within the memory budget of this process
+    # load_timeout - seconds to wait for the image to load before trying again
+    # load_retries - number of times to try loading the image again after an I/O error or timeout
+    # load_retry_delay - seconds to wait before the first retry, doubled for each retry after that
+    # wait_for_writes - wait until the stats and projection are written before returning. If False, they are written
+    #                   in the background while the next FOV is processed, and flush_outputs has to be run in this
+    #                   process before the results are used.
+    # run_id - ID of the flow run. The directory listings of this process are forgotten once per run, so that the
+    #          FOVs of a run share one listing of each plate directory, see filesystem.py
+    #
+    # The timing records of each step (see profiling.measure) are the records of the task, see
+    # profiling.set_task_records. If wait_for_writes is False, the records of the writes are appended to them when
+    # they finish, so they are only complete after flush_outputs.
+
+    records = list()
+    profiling.set_task_records(records)
 
-    if os.path.exists(proj_path) and ~overwrite:
+    # the existence checks are looked up in a listing of each plate directory, see filesystem.py
+    file_index = filesystem.file_index
+    if run_id is not None:
+        file_index.start_run(run_id)
+
+    if file_index.exists(proj_path) and not overwrite:
         return
 
-    proj_dir = os.path.dirname(proj_path)
-    if not os.path.exists(proj_dir):
-        os.makedirs(proj_dir)
+    if failure_path is not None and file_index.exists(failure_path):
+        if not overwrite:
+            warnings.warn(
+                f"Skipping quarantined FOV {fov_row.FOVId}, see {failure_path}"
+            )
+            return
+
+        file_index.remove(failure_path)
+
+    file_index.makedirs(os.path.dirname(proj_path))
+    file_index.makedirs(os.path.dirname(stats_path))
+
+    if memory_estimate is None and memory.memory_budget.n_bytes is not None:
+        memory_estimate = memory.estimate_fov_memory(fov_row.SourceReadPath)
+
+    thumbnail_path = thumbnails.get_thumbnail_path(proj_path)
+
+    def quarantine(e):
+        # don't leave half of the results around for load_stats to pick up
+        for path in [stats_path, thumbnail_path, proj_path]:
+            file_index.remove(path)
+
+        if failures.is_resource_error(e):
+            # e.g. out of memory or disk space, so the FOV could succeed on another run
+            raise e
+
+        failures.save_failure(failure_path, fov_row.FOVId, e)
+        file_index.add(failure_path)
+        warnings.warn(f"FOV {fov_row.FOVId} failed and was quarantined: {e!r}")
+
+    # loads that timed out keep running (and using their memory) in the background, so the memory is reserved until
+    # they finish
+    abandoned_loads = list()
+
+    try:
+        with memory.memory_budget.reserve(
+            memory_estimate, hold_for=abandoned_loads
+        ) as reservation:
+            with profiling.measure("row2im", records, FOVId=fov_row.FOVId):
+                im, ch = failures.call_with_retries(
+                    row2im,
+                    fov_row,
+                    timeout=load_timeout,
+                    max_retries=load_retries,
+                    retry_delay=load_retry_delay,
+                    abandoned=abandoned_loads,
+                )
+
+            with profiling.measure("im2stats", records, FOVId=fov_row.FOVId):
+                stats = im2stats(im)
+
+            with profiling.measure("rowim2proj", records, FOVId=fov_row.FOVId):
+                im_proj = utils.rowim2proj(im, ch)
+
+            with profiling.measure("thumbnails", records, FOVId=fov_row.FOVId):
+                # the projection is (C, X, Y), the way PngWriter takes it
+                im_thumbnails = thumbnails.make_thumbnails(im_proj.transpose(2, 1, 0))
+
+            # the stats are pickled and the projection PNG is encoded in the background, see output.py. This only
+            # blocks if too much is waiting to be written. The PNG is written last, since its existence marks the FOV
+            # as done.
+            write_bytes = (
+                int(stats.memory_usage(deep=True).sum())
+                + im_proj.nbytes
+                + sum(thumbnail.nbytes for thumbnail in im_thumbnails.values())
+            )
+            with profiling.measure("write_submit", records, FOVId=fov_row.FOVId):
+                write = output.output_writer.submit(
+                    [
+                        ("stats_write", stats_path, output.write_pickle, stats),
+                        (
+                            "thumbnails_write",
+                            thumbnail_path,
+                            thumbnails.write_thumbnails,
+                            im_thumbnails,
+                        ),
+                        ("png_write", proj_path, output.write_png, im_proj),
+                    ],
+                    n_bytes=write_bytes,
+                    on_error=quarantine if failure_path is not None else None,
+                    records=records,
+                    FOVId=fov_row.FOVId,
+                )
+
+            # the results that are waiting to be written still count against the memory budget
+            write_reservation = reservation.split(write_bytes)
+            write.add_done_callback(lambda _: write_reservation.release())
+
+        if wait_for_writes:
+            write.result()
+
+    except Exception as e:
+        if failure_path is None:
+            raise
+
+        quarantine(e)
 
-    stats_dir = os.path.dirname(stats_path)
-    if not os.path.exists(stats_dir):
-        os.makedirs(stats_dir)
+    return
 
-    im, ch = row2im(fov_row)
-    stats = im2stats(im)
 
-    with open(stats_path, "wb") as f:
-        pickle.dump(stats, f)
+@task
+def flush_outputs():
+    # Waits until the results that process_fov_row is writing in the background in this process are written
+    output.output_writer.flush()
 
-    im_proj = utils.rowim2proj(im, ch)
 
-    with writers.PngWriter(proj_path) as writer:
-        writer.save(im_proj)
+@task
+def save_failures(failure_paths, parent_dir):
+    # Gathers the records of all of the FOVs that failed into a single table
 
-    return
+    save_path = f"{parent_dir}/{QC_DIR}/failed_fovs.csv"
 
+    # the FOVs could have been processed in other processes
+    filesystem.file_index.invalidate()
 
-@task
+    df_failures = failures.load_failures(failure_paths)
+    df_failures.to_csv(save_path)
+
+    if df_failures.shape[0] > 0:
+        warnings.warn(
+            f"{df_failures.shape[0]} FOVs failed and were skipped. See {save_path}"
+        )
+
+    return df_failures
+
+
+@task(state_handlers=[profiling.attach_records])
+@profiling.profiled
 def load_stats(df, stats_paths):
     # consolidate stats?
+
+    # the FOVs could have been processed in other processes
+    filesystem.file_index.invalidate()
+
     stats_list = list()
     for i, stats_path in enumerate(stats_paths):
-        if os.path.exists(stats_path):
+        if filesystem.file_index.exists(stats_path):
             with open(stats_path, "rb") as f:
                 stats = pickle.load(f)
 
@@ -225,7 +689,8 @@ def load_stats(df, stats_paths):
     return df_stats
 
 
-@task
+@task(state_handlers=[profiling.attach_records])
+@profiling.profiled
 def qc_stats(df_stats, save_parent):
     """
     Given a stats dataframe, check for any FOV's that have their brightest average intensity for a zslice in the
@@ -257,8 +722,17 @@ def qc_stats(df_stats, save_parent):
     return df_stats
 
 
-@task
-def stats2plots(df_stats: pd.DataFrame, parent_dir: str):
+@task(state_handlers=[profiling.attach_records])
+@profiling.profiled
+def stats2plots(
+    df_stats: pd.DataFrame,
+    parent_dir: str,
+    proteins: list = None,
+    n_workers: int = 1,
+    overwrite: bool = False,
+    fov_data: pd.DataFrame = None,
+    stats_paths: list = None,
+):
     """
     general stats to plots function, saves results to parent_dir
 
@@ -267,60 +741,183 @@ def stats2plots(df_stats: pd.DataFrame, parent_dir: str):
     df_stats: pd.DataFrame
         Big dataframe of statistics determined by the combination of data2stats and load_stats
 
+    proteins: list or None
+        only remake the per-protein plots of these proteins (e.g. the ones a sync found changes for). If None, all
+        plots are made. The plots of all of the FOVs (the PCA) are always made if their stats changed, e.g. when a sync
+        only removed FOVs.
+
+    n_workers: int
+        number of plots to render at the same time, each (protein, kind of plot) in a separate process, see
+        stats.plots
+
+    overwrite: bool
+        if False, the plots whose stats (the rows and columns of df_stats that they are made from) didn't change since
+        they were made are not made again, see cache.py
+
+    fov_data, stats_paths: pd.DataFrame, list
+        the stats file of each FOV (see get_save_paths). If set, a PCA of more features than
+        stats.pca.MAX_FULL_PCA_SIZE is fit to the files a chunk at a time, rather than to df_stats, see
+        stats.plots.get_plot_jobs. Only the fit streams: df_stats (from load_stats and qc_stats) is still all in
+        memory.
+
     """
 
     save_dir = f"{parent_dir}/{QC_DIR}/plots/"
     if not os.path.exists(save_dir):
         os.makedirs(save_dir)
 
-    u_proteins = np.unique(df_stats.ProteinDisplayName)
+    # the plots are rendered in other processes, see filesystem.py
+    filesystem.file_index.invalidate(save_dir)
 
-    for u_protein in u_proteins:
-        df_stats_tmp = df_stats[u_protein == df_stats.ProteinDisplayName]
+    if stats_paths is not None:
+        fov_stats_paths = dict(zip(fov_data["FOVId"], stats_paths))
+        stats_paths = [fov_stats_paths[fov_id] for fov_id in df_stats["FOVId"]]
 
-        stats.plot_im_percentiles(
-            df_stats_tmp,
-            save_path=f"{save_dir}/fov_stats_{u_protein}.png",
-            title=u_protein,
-        )
-
-        stats.z_intensity_profile.plot(
-            df_stats_tmp,
-            f"{save_dir}/z_intensity_profile",
-            suffix=u_protein,
-            center_on_channel="z_intensity_profile_Ch1",
-        )
+    jobs = stats.plots.get_plot_jobs(
+        df_stats, save_dir, proteins=proteins, stats_paths=stats_paths
+    )
 
-        stats.z_intensity_profile.plot(
-            df_stats_tmp,
-            f"{save_dir}/z_intensity_profile_uncentered",
-            suffix=u_protein,
+    plot_cache = get_artifact_cache(parent_dir, "plots")
+
+    todo = list()
+    for job in jobs:
+        key = stats.plots.get_plot_key(job)
+        digest = cache.get_digest(
+            frames=[job["df"]],
+            paths=job.get("stats_paths", ()),
+            params={
+                "kind": job["kind"],
+                "protein": job["protein"],
+                "z_size": job.get("z_size"),
+            },
         )
 
-    # drop the non feature data
+        if overwrite or not plot_cache.is_current(key, digest):
+            todo.append((job, key, digest))
 
-    # TODO do this in a better way... probably use well annotated anndata instead of Pandas
+    stats.plots.render_plots([job for job, _, _ in todo], n_workers=n_workers)
 
-    stats.pca.plot(
-        df_stats.drop(["FOVId", "ProteinDisplayName"], axis=1),
-        save_dir,
-        labels=df_stats["ProteinDisplayName"],
-    )
+    # only recorded once the plots are made, so an interrupted run makes them again
+    for job, key, digest in todo:
+        plot_cache.update(key, digest, stats.plots.get_plot_outputs(job))
 
+    if len(todo) > 0:
+        plot_cache.save()
 
-@task
-def im2diagnostics(fov_data, proj_paths, parent_dir, overwrite=False):
 
-    warnings.warn("Overwrite checking currently not implemented.")
+@task(state_handlers=[profiling.attach_records])
+@profiling.profiled
+def im2diagnostics(
+    fov_data,
+    proj_paths,
+    parent_dir,
+    overwrite=False,
+    proteins=None,
+    n_workers=1,
+    max_bytes=None,
+    diagnostics_format="pages",
+    tile_width=None,
+):
+    # proteins - only remake the diagnostics of these proteins, see stats2plots
+    # n_workers, max_bytes - number of pages rendered at the same time and their memory limit, see reports.im2bigim
+    # overwrite - if False, only the proteins whose projections changed since their diagnostics were made (see
+    #   cache.py), and of those only the pages whose images changed, are remade
+    # diagnostics_format - "pages" for montage PNGs, or "pyramid" for zoomable montages, see reports.im2pyramid
+    # tile_width - show the FOVs on the pages at the smallest thumbnail level that is at least this wide
+
+    if diagnostics_format not in DIAGNOSTICS_FORMATS:
+        raise ValueError(
+            f"unrecognized diagnostics_format {diagnostics_format}, must be one of {DIAGNOSTICS_FORMATS}"
+        )
 
     save_dir = f"{parent_dir}/{QC_DIR}/diagnostics"
+    if diagnostics_format == "pyramid":
+        save_dir = f"{save_dir}/pyramid"
+
     if not os.path.exists(save_dir):
         os.makedirs(save_dir)
 
-    reports.im2bigim(proj_paths, fov_data.FOVId, fov_data.ProteinDisplayName, save_dir)
+    if proteins is not None:
+        protein_inds = fov_data.ProteinDisplayName.isin(proteins).values
 
+        fov_data = fov_data[protein_inds]
+        proj_paths = [
+            proj_path
+            for proj_path, protein_ind in zip(proj_paths, protein_inds)
+            if protein_ind
+        ]
 
-@task
+        if fov_data.shape[0] == 0:
+            return
+
+    # the projections are written by the workers, and the pages are rendered in other processes, see filesystem.py
+    for directory in {os.path.dirname(proj_path) for proj_path in proj_paths}:
+        filesystem.file_index.invalidate(directory)
+    filesystem.file_index.invalidate(save_dir)
+
+    diagnostics_cache = get_artifact_cache(
+        parent_dir, f"diagnostics_{diagnostics_format}"
+    )
+
+    labels = np.array([str(label) for label in fov_data.ProteinDisplayName])
+    proj_paths = np.array(proj_paths, dtype=object)
+
+    # the diagnostics of a protein are made from its FOVs' projections and thumbnails
+    digests = dict()
+    for label in np.unique(labels):
+        label_inds = labels == label
+        label_proj_paths = list(proj_paths[label_inds])
+
+        digest = cache.get_digest(
+            frames=[fov_data.loc[label_inds, ["FOVId"]]],
+            paths=label_proj_paths
+            + [thumbnails.get_thumbnail_path(path) for path in label_proj_paths],
+            params={"tile_width": tile_width},
+        )
+
+        if overwrite or not diagnostics_cache.is_current(label, digest):
+            digests[label] = digest
+
+    if len(digests) == 0:
+        return
+
+    changed_inds = np.isin(labels, list(digests.keys()))
+    fov_data = fov_data[changed_inds]
+    proj_paths = list(proj_paths[changed_inds])
+
+    if diagnostics_format == "pyramid":
+        reports.im2pyramid(
+            proj_paths,
+            fov_data.FOVId,
+            fov_data.ProteinDisplayName,
+            save_dir,
+            n_workers=n_workers,
+            overwrite=overwrite,
+        )
+        get_outputs = reports.get_pyramid_outputs
+
+    else:
+        reports.im2bigim(
+            proj_paths,
+            fov_data.FOVId,
+            fov_data.ProteinDisplayName,
+            save_dir,
+            n_workers=n_workers,
+            max_bytes=max_bytes,
+            overwrite=overwrite,
+            tile_width=tile_width,
+        )
+        get_outputs = reports.get_page_outputs
+
+    for label, digest in digests.items():
+        outputs = get_outputs(save_dir, label)
+        if len(outputs) > 0:
+            diagnostics_cache.update(label, digest, outputs)
+    diagnostics_cache.save()
+
+
+@task(state_handlers=[profiling.attach_records])
+@profiling.profiled
 def data_splits(
     df_stats,
     parent_dir,
@@ -329,6 +926,7 @@ def data_splits(
     group_column="ProteinDisplayName",
     split_column="FOVId_rng",
     id_column="FOVId",
+    overwrite=False,
 ):
     """
     Given a stats dataframe, split each unique entry of `group_column` into groups based on the `split_column random
@@ -358,6 +956,10 @@ def data_splits(
     id_column: str
         Column corresponding to unique ids
 
+    overwrite: bool
+        if False, the split files are only written again if df_stats or the splits changed since they were written,
+        see cache.py
+
     Returns
     -------
     splits_dict
@@ -380,6 +982,9 @@ def data_splits(
     if not os.path.exists(save_dir):
         os.makedirs(save_dir)
 
+    # the splits could have been written by another process since this one listed them, see filesystem.py
+    filesystem.file_index.invalidate(save_dir)
+
     if group_column is not None:
         group = df_stats[group_column].values
     else:
@@ -399,7 +1004,20 @@ def data_splits(
     assert np.max(splits) <= (len(split_names) - 1)
     assert not np.any(splits == -1)
 
+    splits_cache = get_artifact_cache(parent_dir, "data_splits")
+    digest = cache.get_digest(
+        frames=[df_stats],
+        params={
+            "split_names": split_names,
+            "split_amounts": split_amounts,
+            "group_column": group_column,
+            "split_column": split_column,
+        },
+    )
+    write_splits = overwrite or not splits_cache.is_current("data_splits", digest)
+
     splits_dict = {}
+    save_paths = list()
 
     for u_group in np.unique(group):
         u_group_inds = group == u_group
@@ -410,7 +1028,9 @@ def data_splits(
             split_inds = (splits == i) & u_group_inds
 
             save_path = f"{save_dir}/{u_group}_{split_name}.csv"
-            df_stats.iloc[split_inds].to_csv(save_path)
+            if write_splits:
+                df_stats.iloc[split_inds].to_csv(save_path)
+            save_paths.append(save_path)
 
             splits_dict[u_group][split_name] = {}
             splits_dict[u_group][split_name]["save_path"] = save_path
@@ -419,4 +1039,46 @@ def data_splits(
                 split_inds
             ]
 
+    if write_splits:
+        splits_cache.update("data_splits", digest, save_paths)
+        splits_cache.save()
+
     return splits_dict
+
+
+def save_performance_report(
+    task_records, parent_dir, run_wall_time=None, run_name=None
+):
+    """
+    Saves the timing and memory report for a run in f"{parent_dir}/{QC_DIR}/{PERFORMANCE_DIR}"
+
+    Parameters
+    ----------
+    task_records: list of lists
+        the records of each task, from the states of process_fov_row and the @profiling.profiled stages (see
+        profiling.get_state_records). The records of writes that process_fov_row left to the background
+        (wait_for_writes=False) are only in them after flush_outputs, and not at all if the state was sent back from
+        another process (e.g. a Dask worker) before then.
+
+    parent_dir: str
+        save directory of results
+
+    run_wall_time: float
+        wall time of the whole run in seconds
+
+    run_name: str or None
+        if set, the report is saved in a subdirectory with this name (e.g. for each shard)
+
+    Returns
+    -------
+    report: dict
+        the summary that was saved as performance.json
+    """
+
+    save_dir = f"{parent_dir}/{QC_DIR}/{PERFORMANCE_DIR}"
+    if run_name is not None:
+        save_dir = f"{save_dir}/{run_name}"
+
+    records = [record for records in task_records for record in records]
+
+    return profiling.save_report(records, save_dir, run_wall_time=run_wall_time)
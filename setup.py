@@ -61,6 +61,7 @@ requirements = [
     "matplotlib",
     "aicsimageio",
     "scikit-learn",
+    "pyarrow",  # for the Parquet data tables
     "prefect==0.9.2",
     "quilt3==3.1.8",
     "docutils==0.15",
@@ -100,6 +101,7 @@ setup(
         "console_scripts": [
             "fpp_process=fov_processing_pipeline.bin.process:main",
             "fpp_scheduler=fov_processing_pipeline.bin.distributed_scheduler:main",
+            "fpp_benchmark=fov_processing_pipeline.bin.benchmark:main",
         ],
     },
     install_requires=requirements,